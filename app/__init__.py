@@ -1,10 +1,7 @@
-from app.settings import config
+from functools import wraps
 import cherrypy
 
 
-cherrypy.config.update(config.config)
-
-
 class allow(object):
     def __init__(self, methods=None):
         if not methods:
@@ -12,13 +9,12 @@ class allow(object):
         self.methods = methods
 
     def __call__(self, f):
+        @wraps(f)
         def wrapped_f(*args, **kwargs):
             method = cherrypy.request.method.upper()
             if method not in self.methods:
                 cherrypy.response.headers['Allow'] = ", ".join(self.methods)
                 raise cherrypy.HTTPError(405)
+            return f(*args, **kwargs)
 
-        return f
-
-from app import application
-from app.application import root, socket_root
\ No newline at end of file
+        return wrapped_f
@@ -1,22 +1,22 @@
 from app import settings
-import os
-from cherrypy.lib.static import serve_file
 from cherrypy import expose
 import cherrypy
 from app import allow
+from app.assets import AssetStore, Static, serve_asset
 from app.auth import require
+from app.monitoring import Metrics
+from common import Ratings
 
-
-def _serve(*args):
-    return serve_file(os.path.join(settings.current_dir, 'static', *args))
+assets = AssetStore(settings.static_dir).load()
+# most players /api/leaderboard returns at once
+LEADERBOARD_PAGE = 100
 
 
 class Root(object):
     @allow(methods=["GET", "HEAD"])
     @expose
     def index(self):
-        print(cherrypy.request.cookie)
-        return _serve("templates", "index.html")
+        return serve_asset(assets, "templates/index.html")
 
 
 class Api(object):
@@ -54,6 +54,28 @@ class Api(object):
         if username:
             cherrypy.request.login = None
 
+    @allow(methods=["GET"])
+    @expose
+    @cherrypy.tools.json_out()
+    def leaderboard(self, start=0, count=20):
+        try:
+            start, count = int(start), int(count)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "start and count must be integers")
+        start = max(start, 0)
+        count = min(max(count, 1), LEADERBOARD_PAGE)
+        top = Ratings().top(start, count)
+        return [{"player": player, "rating": rating} for player, rating in top]
+
+    @allow(methods=["GET"])
+    @expose
+    @cherrypy.tools.json_out()
+    def rating(self, player):
+        _ratings = Ratings()
+        result = _ratings.get(player)
+        result["rank"] = _ratings.rank(player)
+        return result
+
     @expose
     @cherrypy.tools.json_out()
     @cherrypy.tools.json_in()
@@ -71,8 +93,11 @@ class SocketRoot(object):
     def index(self, id, u):
         cool_socket = cherrypy.request.ws_handler
         cool_socket.session_id = id
-        cool_socket.username = u
+        # the login of the session, u comes from the client
+        cool_socket.username = cherrypy.request.login
 
 root = Root()
 root.api = Api()
-socket_root = SocketRoot()
\ No newline at end of file
+root.metrics = Metrics()
+socket_root = SocketRoot()
+static_root = Static(assets)
\ No newline at end of file
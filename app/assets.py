@@ -0,0 +1,193 @@
+"""
+Static files loaded once at startup and served from memory.
+
+Every file gets a content hashed name (lib/angular.js ->
+lib/angular.3f2a9c1e.js). Html files have their static/ references rewritten
+to the hashed names, so browsers can keep hashed files forever and only
+revalidate the html. Compressible files also get gzip and, when the brotli
+module is installed, brotli variants built up front; the variant is picked
+from Accept-Encoding. Responses carry strong ETags and Last-Modified and
+answer conditional requests with 304.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+import cherrypy
+from cherrypy import expose
+from app import allow
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = ("text/", "application/javascript", "application/json",
+                "image/svg+xml", "application/vnd.ms-fontobject",
+                "font/ttf", "application/x-font-ttf")
+# hashed names never change content
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+_static_reference = re.compile(r"""(["'])static/([^"'?#]+)""")
+
+
+class Asset(object):
+    __slots__ = ("path", "content_type", "etag", "last_modified", "variants")
+
+    def __init__(self, path: str, body: bytes, mtime: float):
+        self.path = path
+        self.content_type = mimetypes.guess_type(path)[0] or \
+            "application/octet-stream"
+        self.etag = hashlib.sha1(body).hexdigest()[:16]
+        self.last_modified = int(mtime)
+        self.variants = {"identity": body}
+        if self.content_type.startswith(COMPRESSIBLE):
+            self._compress(body)
+
+    def _compress(self, body: bytes):
+        compressed = gzip.compress(body, 9)
+        if len(compressed) < len(body):
+            self.variants["gzip"] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(body)
+            if len(compressed) < len(body):
+                self.variants["br"] = compressed
+
+    def encoding(self, accept_encoding: str) -> str:
+        """
+            Smallest variant the client accepts
+        """
+        accepted = set()
+        for token in accept_encoding.split(","):
+            name, _, params = token.strip().partition(";")
+            if params.replace(" ", "") not in ("q=0", "q=0.0"):
+                accepted.add(name.strip().lower())
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and \
+                    (encoding in accepted or "*" in accepted):
+                return encoding
+        return "identity"
+
+    def variant_etag(self, encoding: str) -> str:
+        # strong etags differ per representation
+        if encoding == "identity":
+            return '"%s"' % self.etag
+        return '"%s-%s"' % (self.etag, encoding)
+
+
+class AssetStore(object):
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+        # request path -> (Asset, immutable)
+        self.assets = {}
+        # plain path -> hashed path
+        self.hashed = {}
+
+    def load(self):
+        files = {}
+        for directory, _, names in os.walk(self.root_dir):
+            for name in names:
+                full_path = os.path.join(directory, name)
+                path = os.path.relpath(full_path, self.root_dir)
+                path = path.replace(os.sep, "/")
+                with open(full_path, "rb") as f:
+                    files[path] = f.read(), os.path.getmtime(full_path)
+        for path, (body, mtime) in files.items():
+            if not path.endswith(".html"):
+                self.add(path, body, mtime)
+        # html last, its references to the other files get hashed
+        for path, (body, mtime) in files.items():
+            if path.endswith(".html"):
+                html = body.decode("utf-8")
+                # the html changes when a file it points to does
+                mtime = max([mtime] + [files[i][1] for i in
+                                       self.references(html) if i in files])
+                self.add(path, self.rewrite(html).encode("utf-8"), mtime)
+        return self
+
+    def add(self, path: str, body: bytes, mtime: float) -> Asset:
+        asset = Asset(path, body, mtime)
+        base, ext = os.path.splitext(path)
+        hashed = "%s.%s%s" % (base, asset.etag[:8], ext)
+        self.assets[path] = (asset, False)
+        self.assets[hashed] = (asset, True)
+        self.hashed[path] = hashed
+        return asset
+
+    def url(self, path: str) -> str:
+        return self.hashed.get(path, path)
+
+    def references(self, html: str) -> list:
+        """
+            Paths of the static/ references
+        """
+        return [m.group(2) for m in _static_reference.finditer(html)]
+
+    def rewrite(self, html: str) -> str:
+        """
+            Point static/ references to the hashed names
+        """
+        return _static_reference.sub(
+            lambda m: "%sstatic/%s" % (m.group(1), self.url(m.group(2))), html)
+
+    def get(self, path: str) -> tuple:
+        return self.assets.get(path, (None, False))
+
+
+def _not_modified(asset: Asset, etag: str) -> bool:
+    headers = cherrypy.request.headers
+    if_none_match = headers.get("If-None-Match")
+    if if_none_match is not None:
+        tags = {i.strip().replace("W/", "") for i in if_none_match.split(",")}
+        return etag in tags or "*" in tags
+    if_modified_since = headers.get("If-Modified-Since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return asset.last_modified <= since
+    return False
+
+
+def serve_asset(store: AssetStore, path: str) -> bytes:
+    asset, immutable = store.get(path)
+    if asset is None:
+        raise cherrypy.NotFound()
+    encoding = asset.encoding(
+        cherrypy.request.headers.get("Accept-Encoding", ""))
+    etag = asset.variant_etag(encoding)
+    headers = cherrypy.response.headers
+    headers["ETag"] = etag
+    headers["Last-Modified"] = formatdate(asset.last_modified, usegmt=True)
+    headers["Cache-Control"] = IMMUTABLE if immutable else REVALIDATE
+    headers["Vary"] = "Accept-Encoding"
+    if _not_modified(asset, etag):
+        cherrypy.response.status = 304
+        return b""
+    body = asset.variants[encoding]
+    headers["Content-Type"] = asset.content_type
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    headers["Content-Length"] = str(len(body))
+    return body
+
+
+class Static(object):
+    _cp_config = {
+        'tools.sessions.on': False,
+        'tools.auth.on': False,
+        'tools.encode.on': False,
+        'tools.gzip.on': False,
+    }
+
+    def __init__(self, store: AssetStore):
+        self.store = store
+
+    @allow(methods=["GET", "HEAD"])
+    @expose
+    def default(self, *path):
+        return serve_asset(self.store, "/".join(path))
@@ -0,0 +1,91 @@
+import os
+import time
+from functools import wraps
+import cherrypy
+from cherrypy import expose
+from app import allow, settings
+from metrics import registry, profiler
+
+STARTED = time.time()
+
+
+def _request_key() -> str:
+    return "request:" + cherrypy.request.path_info
+
+
+def profile_request():
+    """
+        Profile the request if its path has been enabled through
+        /metrics/profile?key=request:/the/path
+    """
+    key = _request_key()
+    profile = profiler.start(key)
+    if profile is not None:
+        cherrypy.request.hooks.attach(
+            'on_end_request', lambda: profiler.stop(key, profile))
+
+cherrypy.tools.profile = cherrypy.Tool('on_start_resource', profile_request)
+
+
+def _private(f):
+    """
+        404 for the handler unless the request came in on a private port,
+        anything but the public SERVER_PORTS: the health port of a prefork
+        worker or of the single process server, bound to 127.0.0.1
+    """
+    @wraps(f)
+    def wrapped_f(*args, **kwargs):
+        if cherrypy.request.local.port in settings.SERVER_PORTS:
+            raise cherrypy.NotFound()
+        return f(*args, **kwargs)
+    return wrapped_f
+
+
+class Metrics(object):
+    _cp_config = {
+        'tools.sessions.on': False,
+        'tools.auth.on': False,
+        'tools.profile.on': False,
+    }
+
+    @allow(methods=["GET"])
+    @expose
+    def index(self):
+        cherrypy.response.headers['Content-Type'] = 'text/plain'
+        return registry.render()
+
+    @allow(methods=["POST"])
+    @expose
+    @_private
+    def profile(self, key, on="1"):
+        """
+            Switch profiling on/off for a game id or "request:<path>"
+        """
+        if on == "1":
+            if not profiler.enable(key):
+                raise cherrypy.HTTPError(
+                    409, "%d keys profiled already" % profiler.max_keys)
+        else:
+            profiler.disable(key)
+        return key
+
+    @allow(methods=["GET"])
+    @expose
+    @_private
+    def report(self, key, clear="0"):
+        cherrypy.response.headers['Content-Type'] = 'text/plain'
+        report = profiler.report(key)
+        if clear == "1":
+            profiler.clear(key)
+        return report
+
+    @allow(methods=["GET"])
+    @expose
+    @cherrypy.tools.json_out()
+    def health(self):
+        """
+            Polled by the prefork supervisor on the worker's private port
+        """
+        return {"pid": os.getpid(),
+                "uptime": time.time() - STARTED,
+                "metrics": registry.snapshot()}
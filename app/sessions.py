@@ -0,0 +1,142 @@
+"""
+Session backends for tools.sessions. The file backend locks and hits the disk
+on every authenticated request, these keep the lookup in memory.
+
+    storage_type "lru": RamSession bounded by max_entries, least recently used
+                        sessions are evicted first. Single node only.
+    storage_type "redis": pickled sessions in redis with the session timeout as
+                          ttl. With settings.REDIS_LOCAL the in process
+                          LocalRedis stand-in is used instead of a server.
+
+CherryPy finds the class as storage_type.title() + "Session" in
+cherrypy.lib.sessions, so they are registered there on import.
+"""
+from collections import OrderedDict
+import pickle
+import threading
+from cherrypy.lib import sessions
+from app import settings
+from common import redis_client
+
+
+class LruSession(sessions.RamSession):
+    cache = OrderedDict()
+    locks = {}
+    max_entries = settings.SESSION_MAX_ENTRIES
+    _cache_lock = threading.Lock()
+
+    @classmethod
+    def setup(cls, **kwargs):
+        """
+            Called once by tools.sessions with the tools.sessions.* config
+        """
+        cls.max_entries = int(kwargs.get("max_entries", cls.max_entries))
+
+    def _exists(self):
+        return self.id in self.cache
+
+    def _load(self):
+        with self._cache_lock:
+            data = self.cache.get(self.id)
+            if data is not None:
+                self.cache.move_to_end(self.id)
+            return data
+
+    def _save(self, expiration_time):
+        with self._cache_lock:
+            self.cache[self.id] = (self._data, expiration_time)
+            self.cache.move_to_end(self.id)
+            while len(self.cache) > self.max_entries:
+                evicted, _ = self.cache.popitem(last=False)
+                self._drop_lock(evicted)
+
+    def _delete(self):
+        with self._cache_lock:
+            self.cache.pop(self.id, None)
+
+    @classmethod
+    def _drop_lock(cls, session_id):
+        """
+            Forget the lock of an evicted session unless a request holds it,
+            like RamSession.clean_up
+        """
+        lock = cls.locks.get(session_id)
+        if lock is not None and lock.acquire(blocking=False):
+            cls.locks.pop(session_id, None)
+            lock.release()
+
+    def clean_up(self):
+        with self._cache_lock:
+            super(LruSession, self).clean_up()
+
+
+class RedisSession(sessions.Session):
+    # sessions are locked per process like MemcachedSession, the lock of a
+    # session is dropped when its last request releases it:
+    # id -> [RLock, requests holding or waiting for it]
+    locks = {}
+    _locks_lock = threading.Lock()
+    prefix = "session:"
+    client = None
+
+    @classmethod
+    def setup(cls, **kwargs):
+        """
+            Called once by tools.sessions with the tools.sessions.* config
+        """
+        for k, v in kwargs.items():
+            setattr(cls, k, v)
+        cls.client = redis_client(settings.REDIS_SESSION_KWARGS)
+
+    def _key(self) -> str:
+        return self.prefix + self.id
+
+    def _exists(self):
+        return bool(self.client.exists(self._key()))
+
+    def _load(self):
+        data = self.client.get(self._key())
+        if data is None:
+            return None
+        return pickle.loads(data)
+
+    def _save(self, expiration_time):
+        ttl = int(self.timeout * 60)
+        data = pickle.dumps((self._data, expiration_time),
+                            pickle.HIGHEST_PROTOCOL)
+        self.client.setex(self._key(), ttl, data)
+
+    def _delete(self):
+        self.client.delete(self._key())
+
+    def acquire_lock(self):
+        with self._locks_lock:
+            entry = self.locks.setdefault(self.id, [threading.RLock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+        self.locked = True
+
+    def release_lock(self):
+        with self._locks_lock:
+            entry = self.locks[self.id]
+            entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[self.id]
+        self.locked = False
+
+    def __len__(self):
+        """
+            Sessions stored, a SCAN over the prefix shared by every process
+        """
+        cursor, count = None, 0
+        while cursor != 0:
+            cursor, keys = self.client.scan(cursor or 0,
+                                            match=self.prefix + "*",
+                                            count=1000)
+            count += len(keys)
+        return count
+
+
+sessions.LruSession = LruSession
+sessions.RedisSession = RedisSession
@@ -4,6 +4,76 @@ from types import MappingProxyType
 
 STORAGE_PATH = os.environ.get("STORAGE_PATH", "/tmp")
 SESSION_KEY = os.environ.get('SESSION_KEY', '8ffa7757-2452-49bd-a629-8d66dfeadd2f')
+# lru (single process, in memory) or redis (shared between processes and
+# nodes), prefork workers (SERVER_WORKERS) need redis
+SESSION_STORAGE = os.environ.get("SESSION_STORAGE", "lru")
+SESSION_MAX_ENTRIES = int(os.environ.get("SESSION_MAX_ENTRIES", 10000))
+
+SERVER_PORTS = [int(i) for i in os.environ.get("SERVER_PORTS", "8080,8081").split(",")]
+SERVER_THREAD_POOL = int(os.environ.get("SERVER_THREAD_POOL", 10))
+# websocket limits: messages per second and burst of one socket and of one
+# player over all their sockets, messages waiting to be written to a slow
+# client, and the work waiting for the message pool in total and for
+# join_queue, which holds a thread until the player is matched
+WS_RATE = float(os.environ.get("WS_RATE", 10))
+WS_BURST = float(os.environ.get("WS_BURST", 20))
+WS_USER_RATE = float(os.environ.get("WS_USER_RATE", 20))
+WS_USER_BURST = float(os.environ.get("WS_USER_BURST", 40))
+WS_OUTBOX = int(os.environ.get("WS_OUTBOX", 64))
+WS_SEND_THREADS = int(os.environ.get("WS_SEND_THREADS", 8))
+MESSAGE_POOL_SIZE = int(os.environ.get("MESSAGE_POOL_SIZE", 20))
+MESSAGE_POOL_PENDING = int(os.environ.get("MESSAGE_POOL_PENDING", 200))
+MESSAGE_POOL_JOINS = int(os.environ.get("MESSAGE_POOL_JOINS", 15))
+# sockets are pinged every WS_HEARTBEAT seconds and closed when nothing came
+# back for WS_TIMEOUT
+WS_HEARTBEAT = float(os.environ.get("WS_HEARTBEAT", 10))
+WS_TIMEOUT = float(os.environ.get("WS_TIMEOUT", 30))
+
+# prefork: worker processes sharing the ports with SO_REUSEPORT, 0 runs
+# everything in this process. A login must be seen by every worker, so
+# prefork refuses to start with per process sessions (SESSION_STORAGE lru)
+# or REDIS_LOCAL. Each worker answers /metrics/health on
+# 127.0.0.1 from a pool of 2 * SERVER_WORKERS ports starting here, a single
+# process on this port. /metrics/profile and /metrics/report are only
+# served on these private ports, never on SERVER_PORTS
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", 0))
+SERVER_HEALTH_PORT = int(os.environ.get("SERVER_HEALTH_PORT", 9100))
+SERVER_HEALTH_INTERVAL = float(os.environ.get("SERVER_HEALTH_INTERVAL", 2))
+SERVER_HEALTH_FAILURES = int(os.environ.get("SERVER_HEALTH_FAILURES", 3))
+
+# players are matched with the queued player rated closest to them within
+# this many points, else with the next one in line
+MATCH_RATING_WINDOW = float(os.environ.get("MATCH_RATING_WINDOW", 200))
+# queued players the heartbeat hasn't refreshed for this long are dropped
+QUEUE_TTL = float(os.environ.get("QUEUE_TTL", 30))
+
+# games against the engine, search depth in plies and thinking on the
+# player's time
+BOT_DEPTH = int(os.environ.get("BOT_DEPTH", 3))
+BOT_PONDER = os.environ.get("BOT_PONDER", "1") == "1"
+
+# new games are taken from this many engines built in advance
+ENGINE_POOL_SIZE = int(os.environ.get("ENGINE_POOL_SIZE", 32))
+
+# matched games, "initial+increment" seconds and the delay of every move
+TIME_CONTROL = os.environ.get("TIME_CONTROL", "300+0")
+TIME_DELAY = float(os.environ.get("TIME_DELAY", 0))
+
+# finished games, see game/archive.py. The archive worker appends them in
+# batches of this many seconds
+ARCHIVE_PATH = os.environ.get("ARCHIVE_PATH", join(STORAGE_PATH, "archive"))
+ARCHIVE_FLUSH_SECONDS = float(os.environ.get("ARCHIVE_FLUSH_SECONDS", 10))
+# archived games are analyzed newest first, every ply searched to this depth
+# in at most this many nodes. The analyzer runs niced and busy at most
+# ANALYSIS_DUTY of the time
+ANALYSIS_DEPTH = int(os.environ.get("ANALYSIS_DEPTH", 3))
+ANALYSIS_NODES = int(os.environ.get("ANALYSIS_NODES", 1000))
+ANALYSIS_DUTY = float(os.environ.get("ANALYSIS_DUTY", 0.5))
+ANALYSIS_NICE = int(os.environ.get("ANALYSIS_NICE", 10))
+# search results by position shared by every process in redis, kept this
+# many seconds, with the ANALYSIS_CACHE_SIZE most recent in each process
+ANALYSIS_CACHE_SIZE = int(os.environ.get("ANALYSIS_CACHE_SIZE", 100000))
+ANALYSIS_CACHE_TTL = int(os.environ.get("ANALYSIS_CACHE_TTL", 7 * 24 * 3600))
 
 LOG_ERROR_FILE = os.environ.get('LOG_ERROR_FILE', "/tmp/errors.log")
 LOG_ACCESS_FILE = os.environ.get('LOG_ACCESS_FILE', '/tmp/access.log')
@@ -12,6 +82,9 @@ REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
 REDIS_PORT = os.environ.get("REDIS_PORT", 6379)
 
 REDIS_QUEUE_DB = os.environ.get("REDIS_QUEUE_DB", 0)
+REDIS_SESSION_DB = os.environ.get("REDIS_SESSION_DB", 1)
+# use the in process redis stand-in instead of a server
+REDIS_LOCAL = os.environ.get("REDIS_LOCAL", "0") == "1"
 
 _current_dir = dirname(abspath(__file__))
 current_dir = abspath(join(_current_dir, os.pardir))
@@ -20,4 +93,9 @@ static_dir = abspath(join(current_dir, 'static'))
 REDIS_QUEUE_KWARGS = MappingProxyType({
     "host": REDIS_HOST,
     "port": REDIS_PORT,
-    "db": REDIS_QUEUE_DB, })
\ No newline at end of file
+    "db": REDIS_QUEUE_DB, })
+
+REDIS_SESSION_KWARGS = MappingProxyType({
+    "host": REDIS_HOST,
+    "port": REDIS_PORT,
+    "db": REDIS_SESSION_DB, })
@@ -1,5 +1,7 @@
 from app.sockets import CoolSocket
 from app import settings
+# registers the lru and redis storage types
+from app import sessions
 
 config = {
     'global': {
@@ -13,10 +15,13 @@ config = {
     },
     '/': {
         'tools.sessions.on': True,
-        'tools.sessions.storage_type': "file",
+        'tools.sessions.storage_type': settings.SESSION_STORAGE,
+        'tools.sessions.max_entries': settings.SESSION_MAX_ENTRIES,
+        # only used by storage_type "file"
         'tools.sessions.storage_path': settings.STORAGE_PATH,
         'tools.sessions.timeout': 60,
         'tools.auth.on': True,
+        'tools.profile.on': True,
     },
 }
 ws_config = {
@@ -28,8 +33,6 @@ ws_config = {
 
 static_config = {
     '/': {
-        'tools.staticdir.on': True,
-        'tools.staticdir.dir': settings.static_dir,
-        'response.headers.connection': 'close'
+        'tools.profile.on': False,
     },
 }
@@ -1,21 +1,142 @@
 import json
+from collections import defaultdict
 from functools import wraps
+from ws4py.messaging import PingControlMessage
 from ws4py.websocket import WebSocket
-from common import RedisQueue, WebSocketPubSubPool
+from common import RedisQueue, ReliableQueue, WebSocketPubSubPool, Ratings, \
+    Presence, redis_client, TokenBucket, Buckets, Outbox, Admission, \
+    AnalysisCache
 from concurrent.futures import ThreadPoolExecutor
-from game.chess import make_game_engine
+from threading import Lock, RLock, Thread
+from time import perf_counter, monotonic, sleep
+from uuid import uuid4
+from app.settings import BOT_DEPTH, BOT_PONDER, TIME_CONTROL, TIME_DELAY, \
+    ENGINE_POOL_SIZE, WS_RATE, WS_BURST, WS_USER_RATE, WS_USER_BURST, \
+    WS_OUTBOX, WS_SEND_THREADS, MESSAGE_POOL_SIZE, MESSAGE_POOL_PENDING, \
+    MESSAGE_POOL_JOINS, WS_HEARTBEAT, WS_TIMEOUT, QUEUE_TTL, \
+    ANALYSIS_CACHE_SIZE, ANALYSIS_CACHE_TTL
+from game.chess import GameEngine
+from game.clock import Clock, parse_time_control
+from game.ponder import Bot
+from game.pool import EnginePool
+from metrics import registry, profiler, timed
+from workers.archive import FINISHED_QUEUE, finished_game
+from workers.clocks import FlagScheduler
+from workers.queue import QUEUE
 
-r_queue = RedisQueue("all_players")
-pub_sub_pool = WebSocketPubSubPool("queue_channel", 20)
-message_pool = ThreadPoolExecutor(20)
+# every server process keeps its own copy of the matched games, the moves
+# made through the other processes come in on the game channels
+ORIGIN = uuid4().hex
+GAME_CHANNEL = "game:%s"
+FINISHED_KEY = "finished:%s"
+
+r_queue = RedisQueue(QUEUE)
+# last heartbeat of every queued channel, the matcher drops the stale ones
+queue_presence = Presence(QUEUE, QUEUE_TTL)
+finished_queue = ReliableQueue(FINISHED_QUEUE)
+ratings = Ratings()
+_redis = redis_client()
+pub_sub_pool = WebSocketPubSubPool("queue_channel:%s" % ORIGIN, 20)
+registry.gauge("pub_sub_pool", lambda: {"free": pub_sub_pool.free()})
+message_pool = ThreadPoolExecutor(MESSAGE_POOL_SIZE)
+# join_queue waits for a match in the pool, keep threads for the rest
+admission = Admission(MESSAGE_POOL_PENDING, {"join_queue": MESSAGE_POOL_JOINS})
+registry.gauge("message_pool", admission.snapshot)
+# writes to the clients, a slow client doesn't hold a game thread
+send_pool = ThreadPoolExecutor(WS_SEND_THREADS)
+user_buckets = Buckets(WS_USER_RATE, WS_USER_BURST)
+engine_pool = EnginePool(ENGINE_POOL_SIZE).start()
 
 games = {}
+games_lock = Lock()
+# per game, moves and reads of its board from the socket, pool and
+# replication threads take it
+game_locks = {}
+# games against the engine, game uid -> Bot
+bots = {}
+# the bots' searches, shared with every process and the analyzer
+analysis_cache = AnalysisCache(max_size=ANALYSIS_CACHE_SIZE,
+                               ttl=ANALYSIS_CACHE_TTL)
+BOT_PLAYER = "bot"
+# sockets of the players of every game, told when the game ends
+game_sockets = defaultdict(list)
+# pinged by the heartbeat
+open_sockets = set()
+open_sockets_lock = Lock()
+
+
+def _game_lock(uid) -> RLock:
+    with games_lock:
+        return game_locks.setdefault(uid, RLock())
+
+
+def _game_over(uid):
+    """
+        Called once the game is finished, under its lock. The process
+        forgets the game, the players get the result
+    """
+    with games_lock:
+        game = games.pop(uid)
+        bot = bots.pop(uid, None)
+        game_locks.pop(uid, None)
+    if bot is not None:
+        bot.stop_pondering()
+    over = {"game": uid, "result": game.result, "reason": game.reason}
+    # every process holding the game gets here, one of them archives and
+    # rates it
+    first = _redis.set(FINISHED_KEY % uid, ORIGIN, ex=3600, nx=True)
+    if first:
+        finished_queue.put(finished_game(game))
+    if first and bot is None:
+        white, black = game.players["W"], game.players["B"]
+        over["ratings"] = dict(zip(
+            (white, black), ratings.record_game(white, black, game.result)))
+    message = json.dumps(over)
+    for socket in game_sockets.pop(uid, []):
+        socket.send(message)
+
+
+def _flag_fall(uid, color):
+    with _game_lock(uid):
+        game = games.get(uid)
+        if game is None or game.result is not None:
+            # a move ended the game first
+            return
+        game.finish("0-1" if color == "W" else "1-0", "time")
+        flags.remove(uid)
+        _game_over(uid)
 
 
-def run_in_pool(f):
+flags = FlagScheduler(_flag_fall)
+flags.wheel.start()
+
+
+def run_in_pool(f=None, admit=True):
+    """
+        Run f(socket, ...) in the message pool. With admit the work is
+        refused with a "busy" error once admission is full, continuations
+        of work already admitted use admit=False
+    """
+    if f is None:
+        return lambda f: run_in_pool(f, admit)
+    kind = f.__name__
+
+    def run(*args, **kwargs):
+        try:
+            f(*args, **kwargs)
+        finally:
+            admission.leave(kind)
+
     @wraps(f)
-    def wrapper(*args, **kwargs):
-        message_pool.submit(f, *args, **kwargs)
+    def wrapper(socket, *args, **kwargs):
+        if not admit:
+            message_pool.submit(f, socket, *args, **kwargs)
+        elif admission.enter(kind):
+            message_pool.submit(run, socket, *args, **kwargs)
+        else:
+            registry.counter("ws.busy").incr()
+            socket.send(json.dumps({"error": "busy", "type": kind}),
+                        key="busy:" + kind)
 
     return wrapper
 
@@ -24,38 +145,326 @@ def run_in_pool(f):
 def join_queue(socket:WebSocket, data):
     # keep this order to avoid state conflict
     channel, pubsub = pub_sub_pool.join()
+    socket.set_channel(channel)
+    queue_presence.touch(channel)
+    ratings.queue(channel, ratings.rating(socket.username))
     r_queue.put(channel)
+    queued = perf_counter()
     # {'pattern': None, 'type': 'message', 'data': b'30ae154a-2397-4945-aeed-48dad6c603b6', 'channel': 'queue_channel:19'}
     msg = pub_sub_pool.next_message(channel, pubsub)
-    uid = msg['data']
-    if not uid in games:
-        games[uid] = make_game_engine()
+    # the matcher sends one message per entry, the channel is free again
+    socket.set_channel(None)
+    pub_sub_pool.free_pub_sub(channel)
+    # {"game": uid, "color": "W"} or {"cancelled": true}
+    matched = json.loads(msg['data'].decode("utf-8"))
+    if matched.get("cancelled"):
+        return
+    registry.histogram("matchmaker.wait").observe(perf_counter() - queued)
+    uid = matched["game"]
+    _join(uid, socket.username, matched["color"], socket)
+    _publish(uid, {"type": "join", "player": socket.username,
+                   "color": matched["color"]})
+    socket.send(uid)
+
 
-    games[uid].join_game(data["player"])
+def _join(uid, player, color, socket=None):
+    # both players of the game get here, from different threads or processes
+    with games_lock:
+        if not uid in games:
+            games[uid] = engine_pool.get()
+        game = games[uid]
+        game.join_game(player, color)
+        if socket is not None:
+            game_sockets[uid].append(socket)
+        # the time starts once both players are in
+        if len(game.players) == 2 and game.clock is None:
+            initial, increment = parse_time_control(TIME_CONTROL)
+            game.clock = Clock(initial, increment, TIME_DELAY, game.board.turn)
+            flags.start(uid, game.clock)
+    return game
+
+
+@run_in_pool
+def play_bot(socket:WebSocket, data):
+    # the player is white, the bot black
+    uid = str(uuid4())
+    game = engine_pool.get()
+    game.join_game(socket.username, "W")
+    game.join_game(BOT_PLAYER, "B")
+    with games_lock:
+        games[uid] = game
+        bots[uid] = Bot("B", depth=BOT_DEPTH, ponder=BOT_PONDER,
+                        cache=analysis_cache)
+        game_sockets[uid].append(socket)
     socket.send(uid)
 
 
+@run_in_pool(admit=False)
+def bot_move(socket:WebSocket, uid):
+    with _game_lock(uid):
+        game, bot = games.get(uid), bots.get(uid)
+        if game is None or game.result is not None:
+            return
+        # the search makes and unmakes moves, it works on a copy so the
+        # game can be read meanwhile
+        position = GameEngine(game.board.copy())
+    with profiler.profile(uid):
+        result = bot.play(position)
+    with _game_lock(uid):
+        if games.get(uid) is not game or game.result is not None:
+            return
+        bot_moved = None
+        if result.move is not None:
+            start, end, promotion = result.move
+            with registry.timer("game.move"):
+                game.move(start, end, bot.color, promotion)
+            bot_moved = {"start": start, "end": end, "promotion": promotion}
+        socket.send(json.dumps({"game": uid, "bot_move": bot_moved}))
+        if game.outcome() is not None:
+            game.finish(*game.outcome())
+            _game_over(uid)
+
+
+def _player_color(game, player):
+    for color, name in game.players.items():
+        if name == player:
+            return color
+    raise Exception("Player %s is not in this game" % repr(player))
+
+
 def move(socket:WebSocket, data):
-    pass
+    # {"game": uid, "start": [4, 6], "end": [4, 4]} played by the login of
+    # the socket
+    # promotion ("Q", "R", "B" or "N") is optional, queen by default
+    uid = data["game"]
+    with _game_lock(uid):
+        game = games.get(uid)
+        if game is None:
+            # over, or not on this process
+            socket.send(json.dumps({"game": uid, "moved": False}))
+            return
+        color = _player_color(game, socket.username)
+        if game.result is not None or flags.expired(uid):
+            socket.send(json.dumps({"game": uid, "moved": False}))
+            return
+        with profiler.profile(uid), registry.timer("game.move"):
+            moved = game.move(tuple(data["start"]), tuple(data["end"]), color,
+                              data.get("promotion"))
+        flagged = moved and uid in flags and not flags.moved(uid)
+        if flagged:
+            # ran out of time before the move got here
+            game.unmake()
+            moved = False
+        socket.send(json.dumps({"game": uid, "moved": moved}))
+        if flagged:
+            _flag_fall(uid, color)
+        if moved and uid not in bots:
+            _publish(uid, {"type": "move", "color": color,
+                           "start": data["start"], "end": data["end"],
+                           "promotion": data.get("promotion")})
+        if moved and game.outcome() is not None:
+            game.finish(*game.outcome())
+            flags.remove(uid)
+            _game_over(uid)
+        elif moved and uid in bots:
+            bot_move(socket, uid)
+
+
+def _publish(uid, event: dict):
+    event["origin"] = ORIGIN
+    _redis.publish(GAME_CHANNEL % uid, json.dumps(event))
+
+
+def _replicate_join(uid, event):
+    with _game_lock(uid):
+        _join(uid, event["player"], event["color"])
+
+
+def _replicate_move(uid, event):
+    with _game_lock(uid):
+        game = games.get(uid)
+        if game is None or game.result is not None:
+            return
+        game.move(tuple(event["start"]), tuple(event["end"]), event["color"],
+                  event["promotion"])
+        if uid in flags:
+            flags.moved(uid)
+        if game.outcome() is not None:
+            game.finish(*game.outcome())
+            flags.remove(uid)
+            _game_over(uid)
+
+
+replicated = {
+    "join": _replicate_join,
+    "move": _replicate_move,
+}
+
+
+def replicate_games():
+    """
+        Apply the joins and moves published by the other processes
+    """
+    pubsub = _redis.pubsub()
+    pubsub.psubscribe(GAME_CHANNEL % "*")
+    for msg in pubsub.listen():
+        if msg["type"] != "pmessage":
+            continue
+        event = json.loads(msg["data"].decode("utf-8"))
+        if event["origin"] == ORIGIN:
+            continue
+        uid = msg["channel"].decode("utf-8").partition(":")[2]
+        try:
+            replicated[event["type"]](uid, event)
+            registry.counter("games.replicated").incr()
+        except Exception:
+            registry.counter("games.replication_errors").incr()
+
+
+Thread(target=replicate_games, daemon=True).start()
+
+
+def _state(game):
+    state = {"turn": game.board.turn,
+             "players": game.players,
+             "plies": len(game.board.moves),
+             "result": game.result}
+    if game.clock is not None:
+        state["clock"] = game.clock.json_dict()
+    return state
+
+
+def _possible_moves(game):
+    result = _state(game)
+    result["moves"] = game.possible_moves(json=True)
+    return result
+
+
+game_operations = {
+    "state": _state,
+    "possible_moves": _possible_moves,
+}
 
 
 def game_operation(socket:WebSocket, data):
-    pass
+    # {"game": uid, "operation": "possible_moves"}
+    operation = data.get("operation", None)
+    if operation not in game_operations.keys():
+        raise Exception("Unexpected operation %s" % repr(operation))
+    # possible_moves makes and unmakes moves on the board
+    with _game_lock(data["game"]), profiler.profile(data["game"]):
+        game = games.get(data["game"])
+        if game is None:
+            raise Exception("Unknown game %s" % repr(data["game"]))
+        result = game_operations[operation](game)
+    result["game"] = data["game"]
+    # only the latest answer matters to a client that reads slowly
+    socket.send(json.dumps(result), key=(data["game"], operation))
 
 
 type_funcs = {
     "join_queue": join_queue,
+    "play_bot": play_bot,
     "move": move,
     "game_operation": game_operation,
 }
 
 
+def heartbeat():
+    """
+        Ping the sockets and refresh the queue entries of the live ones.
+        A socket silent for WS_TIMEOUT is closed, its queue entry goes stale
+    """
+    while True:
+        sleep(WS_HEARTBEAT)
+        now = monotonic()
+        with open_sockets_lock:
+            sockets = list(open_sockets)
+        channels = []
+        for socket in sockets:
+            if now - socket.last_seen > WS_TIMEOUT:
+                registry.counter("ws.timeouts").incr()
+                socket.disconnected()
+                send_pool.submit(socket.close, 1001, "heartbeat timeout")
+                continue
+            socket.send(PingControlMessage(b"ping"), key="ping")
+            if socket.channel is not None:
+                channels.append(socket.channel)
+        queue_presence.touch(*channels)
+
+
+Thread(target=heartbeat, daemon=True).start()
+
+
 class CoolSocket(WebSocket):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.session_id = None
         self.username = None
+        self.bucket = TokenBucket(WS_RATE, WS_BURST)
+        self.outbox = Outbox(WS_OUTBOX)
+        self.last_seen = monotonic()
+        # queue channel while waiting for a match
+        self.channel = None
+        self._channel_lock = Lock()
+
+    def set_channel(self, channel):
+        with self._channel_lock:
+            self.channel = channel
+
+    def disconnected(self):
+        """
+            Stop the heartbeat, a queue entry is dropped at the next round of
+            the matcher. Under the lock, so the channel isn't already given
+            to another socket
+        """
+        with open_sockets_lock:
+            open_sockets.discard(self)
+        with self._channel_lock:
+            if self.channel is not None:
+                queue_presence.expire(self.channel)
+
+    def send(self, payload, binary=False, key=None):
+        """
+            Queue the payload for the send pool.
+            A payload with a key replaces the queued one with the same key.
+            A full queue drops keyed payloads and closes the socket for the
+            others, the client doesn't keep up
+        """
+        if not self.outbox.put((payload, binary), key):
+            if key is not None:
+                registry.counter("ws.dropped").incr()
+                return
+            registry.counter("ws.overflow").incr()
+            self.outbox.clear()
+            send_pool.submit(self.close, 1008, "too slow")
+            return
+        if self.outbox.schedule():
+            send_pool.submit(self._drain)
+
+    def _drain(self):
+        item = self.outbox.pop()
+        while item is not None:
+            payload, binary = item
+            try:
+                WebSocket.send(self, payload, binary)
+            except Exception:
+                registry.counter("ws.send_errors").incr()
+                self.outbox.clear()
+            item = self.outbox.pop()
+
+    def _admit(self) -> bool:
+        """
+            Rate limits of the socket and of the player logged in on it,
+            whatever player the message names
+        """
+        if self.bucket.take() and \
+                (self.username is None or user_buckets.take(self.username)):
+            return True
+        registry.counter("ws.rate_limited").incr()
+        self.send(json.dumps({"error": "rate limited"}), key="rate limited")
+        return False
 
     def _parse_input(self, _json):
         print(_json)
@@ -68,22 +477,43 @@ class CoolSocket(WebSocket):
         elif data is None:
             raise Exception("No data provided")
 
+        # the player is the login of the socket, a message can't name
+        # another one
+        if self.username is None:
+            raise Exception("Not logged in")
+        if isinstance(data, dict) and \
+                data.get("player", self.username) != self.username:
+            raise Exception("Player %s is not logged in on this socket"
+                            % repr(data["player"]))
+
         return _type, data
 
     def _process_message(self, _json):
         _type, data = self._parse_input(_json)
-        type_funcs[_type](self, data)
+        if not self._admit():
+            return
+        with registry.timer("ws.%s" % _type):
+            type_funcs[_type](self, data)
 
     def opened(self):
         print("socket opened", self)
+        with open_sockets_lock:
+            open_sockets.add(self)
 
     def closed(self, code, reason=None):
         print("socket closed", self)
+        self.disconnected()
+
+    def ponged(self, pong):
+        self.last_seen = monotonic()
 
+    @timed("ws.received_message")
     def received_message(self, message):
+        self.last_seen = monotonic()
         # security reasons
         if len(message.data) > 1000:
             self.close(1856, "message too long")
+            return
 
         try:
             _json = json.loads(message.data.decode("utf-8"))
@@ -0,0 +1,261 @@
+import datetime
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+from email.utils import formatdate
+from threading import Event, Thread
+from unittest.mock import patch
+import cherrypy
+from cherrypy import _cprequest
+from cherrypy.lib import httputil
+from app import settings
+from app.assets import AssetStore, IMMUTABLE, REVALIDATE, serve_asset
+from app.application import Api
+from app.monitoring import Metrics
+from app.sessions import LruSession, RedisSession
+from common import LocalRedis, Ratings
+
+
+class TestLruSession(unittest.TestCase):
+    def setUp(self):
+        class Session(LruSession):
+            cache = OrderedDict()
+            locks = {}
+            max_entries = 2
+        self.Session = Session
+
+    def _new(self, id=None, **values):
+        session = self.Session(id, clean_freq=0)
+        for k, v in values.items():
+            session[k] = v
+        session.save()
+        return session.id
+
+    def test_round_trip(self):
+        first = self._new(player="alice")
+        session = self.Session(first, clean_freq=0)
+        assert session.get("player") == "alice" and not session.missing
+        assert self.Session("unknown", clean_freq=0).missing
+
+    def test_eviction(self):
+        first, second = self._new(n=1), self._new(n=2)
+        # used last, the second is evicted first
+        assert self.Session(first, clean_freq=0)["n"] == 1
+        third = self._new(n=3)
+        assert list(self.Session.cache) == [first, third]
+        assert len(self.Session.cache) == self.Session.max_entries
+        assert self.Session(second, clean_freq=0).missing
+
+    def test_expired(self):
+        first = self._new(n=1)
+        data, _ = self.Session.cache[first]
+        self.Session.cache[first] = (data, datetime.datetime.now() -
+                                     datetime.timedelta(seconds=1))
+        assert self.Session(first, clean_freq=0).get("n") is None
+
+    def test_locked_eviction(self):
+        locked = self.Session(self._new(n=1), clean_freq=0)
+        unlocked = self.Session(self._new(n=2), clean_freq=0)
+        unlocked.acquire_lock()
+        unlocked.release_lock()
+        # a request in another thread holds the lock
+        acquired, done = Event(), Event()
+
+        def request():
+            locked.acquire_lock()
+            acquired.set()
+            done.wait()
+            locked.release_lock()
+        thread = Thread(target=request)
+        thread.start()
+        acquired.wait()
+        self._new(n=3)
+        self._new(n=4)
+        assert locked.id in self.Session.locks
+        assert unlocked.id not in self.Session.locks
+        done.set()
+        thread.join()
+
+
+class TestRedisSession(unittest.TestCase):
+    def setUp(self):
+        class Session(RedisSession):
+            client = LocalRedis()
+            locks = {}
+        self.Session = Session
+
+    def test_round_trip(self):
+        session = self.Session(clean_freq=0, timeout=2)
+        session["player"] = "alice"
+        session.save()
+        loaded = self.Session(session.id, clean_freq=0)
+        assert loaded["player"] == "alice" and not loaded.missing
+        assert 0 < self.Session.client.ttl("session:" + session.id) <= 120
+        loaded.delete()
+        assert self.Session(session.id, clean_freq=0).missing
+
+    def test_locks(self):
+        first = self.Session(clean_freq=0)
+        first["n"] = 1
+        first.save()
+        second = self.Session(first.id, clean_freq=0)
+        first.acquire_lock()
+        second.acquire_lock()
+        first.release_lock()
+        assert self.Session.locks[first.id][1] == 1
+        second.release_lock()
+        # nothing left behind per session id
+        assert self.Session.locks == {}
+
+    def test_len(self):
+        session = self.Session(clean_freq=0)
+        assert len(session) == 0
+        session["n"] = 1
+        session.save()
+        self.Session.client.set("other", 1)
+        assert len(self.Session(session.id, clean_freq=0)) == 1
+
+
+class TestAssets(unittest.TestCase):
+    SCRIPT = b"var board = [];\n" * 100
+    HTML = '<script src="static/js/app.js"></script>' \
+        '<img src="static/missing.png">'
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, "js"))
+        os.makedirs(os.path.join(self.root, "templates"))
+        self._write("js/app.js", self.SCRIPT, 2000000000)
+        self._write("templates/index.html", self.HTML.encode("utf-8"),
+                    1000000000)
+        self.store = AssetStore(self.root).load()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, path, body, mtime):
+        full_path = os.path.join(self.root, path)
+        with open(full_path, "wb") as f:
+            f.write(body)
+        os.utime(full_path, (mtime, mtime))
+
+    def _request(self, path, **headers):
+        """
+            serve_asset for a request with the headers, underscores in the
+            names are dashes
+        """
+        request = _cprequest.Request(httputil.Host("127.0.0.1", 80),
+                                     httputil.Host("127.0.0.1", 1234))
+        request.headers = httputil.HeaderMap(
+            {k.replace("_", "-"): v for k, v in headers.items()})
+        cherrypy.serving.request = request
+        cherrypy.serving.response = _cprequest.Response()
+        body = serve_asset(self.store, path)
+        return cherrypy.response, body
+
+    def test_rewrite(self):
+        hashed = self.store.url("js/app.js")
+        assert hashed != "js/app.js" and hashed.startswith("js/app.")
+        _, body = self._request("templates/index.html")
+        html = body.decode("utf-8")
+        assert 'src="static/%s"' % hashed in html
+        # unknown files are left alone
+        assert 'src="static/missing.png"' in html
+
+    def test_encoding(self):
+        asset, _ = self.store.get("js/app.js")
+        assert asset.encoding("gzip, deflate") == "gzip"
+        assert asset.encoding("deflate") == "identity"
+        assert asset.encoding("gzip;q=0, deflate") == "identity"
+        assert asset.encoding("gzip; q=0.0") == "identity"
+        assert asset.encoding("*") == "gzip"
+        assert asset.encoding("") == "identity"
+
+        response, body = self._request("js/app.js", Accept_Encoding="gzip")
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(body) == self.SCRIPT
+        response, body = self._request("js/app.js")
+        assert "Content-Encoding" not in response.headers
+        assert body == self.SCRIPT
+
+    def test_etag(self):
+        response, _ = self._request("js/app.js", Accept_Encoding="gzip")
+        etag = response.headers["ETag"]
+        response, body = self._request("js/app.js", Accept_Encoding="gzip",
+                                       If_None_Match=etag)
+        assert response.status == 304 and body == b""
+        # another representation has another etag
+        response, body = self._request("js/app.js", If_None_Match=etag)
+        assert response.status is None and body == self.SCRIPT
+
+    def test_if_modified_since(self):
+        response, _ = self._request("js/app.js")
+        modified = response.headers["Last-Modified"]
+        response, _ = self._request("js/app.js", If_Modified_Since=modified)
+        assert response.status == 304
+        response, _ = self._request(
+            "js/app.js", If_Modified_Since=formatdate(1000000000, usegmt=True))
+        assert response.status is None
+
+    def test_html_last_modified(self):
+        # the script changed after the html
+        response, _ = self._request("templates/index.html")
+        assert response.headers["Last-Modified"] == \
+            formatdate(2000000000, usegmt=True)
+
+    def test_cache_control(self):
+        response, _ = self._request(self.store.url("js/app.js"))
+        assert response.headers["Cache-Control"] == IMMUTABLE
+        response, _ = self._request("js/app.js")
+        assert response.headers["Cache-Control"] == REVALIDATE
+
+    def test_not_found(self):
+        with self.assertRaises(cherrypy.NotFound):
+            self._request("js/other.js")
+
+
+class TestMetrics(unittest.TestCase):
+    def _request(self, port, handler, *args):
+        request = _cprequest.Request(httputil.Host("127.0.0.1", port),
+                                     httputil.Host("127.0.0.1", 1234))
+        request.method = "GET"
+        cherrypy.serving.request = request
+        cherrypy.serving.response = _cprequest.Response()
+        return handler(*args)
+
+    def test_private(self):
+        metrics = Metrics()
+        with self.assertRaises(cherrypy.NotFound):
+            self._request(settings.SERVER_PORTS[0], metrics.report, "game")
+        assert self._request(settings.SERVER_HEALTH_PORT, metrics.report,
+                             "game") == ""
+        # the counters stay public
+        assert isinstance(self._request(settings.SERVER_PORTS[0],
+                                        metrics.index), str)
+
+
+class TestLeaderboard(unittest.TestCase):
+    def setUp(self):
+        self.api = Api()
+        cherrypy.serving.request = _cprequest.Request(
+            httputil.Host("127.0.0.1", 80), httputil.Host("127.0.0.1", 1234))
+        cherrypy.serving.request.method = "GET"
+        cherrypy.serving.response = _cprequest.Response()
+        # json_out wraps the handler, call the handler itself
+        self.leaderboard = Api.leaderboard.__wrapped__
+
+    def test_bounds(self):
+        with self.assertRaises(cherrypy.HTTPError) as raised:
+            self.leaderboard(self.api, "a", "20")
+        assert raised.exception.status == 400
+        ratings = Ratings(client=LocalRedis())
+        ratings.replace_all({i: {"rating": 1500 + n, "games": 1}
+                             for n, i in enumerate(("a", "b", "c"))})
+        with patch("app.application.Ratings", lambda: ratings):
+            # count=0 used to be the whole leaderboard
+            assert self.leaderboard(self.api, "-5", "0") == \
+                [{"player": "c", "rating": 1502}]
+            assert len(self.leaderboard(self.api, "0", "1000")) == 3
@@ -0,0 +1,258 @@
+"""
+Load test with simulated players against a local server.
+
+    python -m benchmarks.load --players 1000 --plies 40 --output load.json
+
+Every player logs in through /api/login, opens /ws/, joins the queue and once
+match_players pairs it plays random legal moves until its game has --plies
+moves. By default server.py is started with REDIS_LOCAL=1 so only loopback is
+used, --no-spawn runs against a server that is already running.
+Reports matchmaking latency, move round trip, throughput and server cpu/memory.
+"""
+from argparse import ArgumentParser
+from ast import literal_eval
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from threading import Lock
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+try:
+    import websocket
+except ImportError as e:
+    raise ImportError("benchmarks.load needs websocket-client, see "
+                      "requirements.txt") from e
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentiles(values: list, points=(50, 90, 99)) -> dict:
+    """
+        Nearest rank percentiles, plus max
+    """
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {"p%i" % p: values[min(len(values) - 1, int(len(values) * p / 100))]
+              for p in points}
+    result["max"] = values[-1]
+    return result
+
+
+class ServerProcess(object):
+    """
+        server.py in a child process using the local redis stand-in
+    """
+
+    def __init__(self, port: int):
+        self.port = port
+        env = dict(os.environ, REDIS_LOCAL="1", SERVER_PORTS=str(port))
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "server.py")], cwd=ROOT, env=env)
+
+    def wait(self, host: str, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                socket.create_connection((host, self.port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise Exception("Server did not start on port %i" % self.port)
+
+    def usage(self) -> dict:
+        """
+            cpu seconds and memory in kB of the server, read from /proc
+        """
+        pid = self.process.pid
+        with open("/proc/%i/stat" % pid) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = os.sysconf("SC_CLK_TCK")
+        usage = {"cpu": (int(fields[11]) + int(fields[12])) / ticks}
+        with open("/proc/%i/status" % pid) as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                if key in ("VmRSS", "VmHWM"):
+                    usage[key] = int(value.split()[0])
+        return usage
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+class Results(object):
+    def __init__(self):
+        self.lock = Lock()
+        self.matchmaking = []
+        self.round_trips = []
+        self.games = 0
+        self.errors = 0
+
+    def add(self, name: str, value):
+        with self.lock:
+            getattr(self, name).append(value)
+
+    def incr(self, name: str):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+class SimulatedPlayer(object):
+    def __init__(self, name: str, host: str, port: int, plies: int,
+                 results: Results, poll=0.05, timeout=60):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.plies = plies
+        self.results = results
+        self.poll = poll
+        self.timeout = timeout
+        self.ws = None
+        self.game = None
+
+    def login(self) -> str:
+        """
+            POST /api/login and return the session id from the cookie
+        """
+        connection = HTTPConnection(self.host, self.port, timeout=self.timeout)
+        body = json.dumps({"username": self.name})
+        connection.request("POST", "/api/login", body,
+                           {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        response.read()
+        cookies = response.getheader("Set-Cookie", "")
+        connection.close()
+        for cookie in cookies.replace(",", ";").split(";"):
+            key, _, value = cookie.strip().partition("=")
+            if key == "session_id":
+                return value
+        raise Exception("No session cookie for %s" % self.name)
+
+    def connect(self, session_id: str):
+        url = "ws://%s:%i/ws/?id=%s&u=%s" % (
+            self.host, self.port, session_id, self.name)
+        self.ws = websocket.create_connection(
+            url, header=["Cookie: session_id=%s" % session_id],
+            timeout=self.timeout)
+
+    def _request(self, _type: str, data: dict) -> str:
+        self.ws.send(json.dumps({"type": _type, "data": data}))
+        return self.ws.recv()
+
+    def _operation(self, operation: str) -> dict:
+        data = {"game": self.game, "operation": operation}
+        return json.loads(self._request("game_operation", data))
+
+    def join_queue(self):
+        start = time.time()
+        self.game = self._request("join_queue", {"player": self.name})
+        self.results.add("matchmaking", time.time() - start)
+
+    def play(self):
+        while True:
+            state = self._operation("state")
+            if state["plies"] >= self.plies:
+                return
+            # opponent still joining or thinking
+            if len(state["players"]) < 2 or \
+                    state["players"][state["turn"]] != self.name:
+                time.sleep(self.poll)
+                continue
+
+            moves = self._operation("possible_moves")["moves"]
+            if not moves:
+                return
+            start = random.choice(list(moves.keys()))
+            data = {"game": self.game, "player": self.name,
+                    "start": literal_eval(start),
+                    "end": random.choice(moves[start])}
+            sent = time.time()
+            self._request("move", data)
+            self.results.add("round_trips", time.time() - sent)
+
+    def run(self):
+        try:
+            self.connect(self.login())
+            self.join_queue()
+            self.play()
+            self.results.incr("games")
+        except Exception:
+            self.results.incr("errors")
+        finally:
+            if self.ws:
+                self.ws.close()
+
+
+def run(players: int, plies: int, host: str, port: int, ramp: float,
+        timeout: float, server: ServerProcess=None) -> dict:
+    results = Results()
+    before = server.usage() if server else None
+    start = time.time()
+    with ThreadPoolExecutor(players) as executor:
+        for i in range(0, players):
+            player = SimulatedPlayer("player%i" % i, host, port, plies,
+                                     results, timeout=timeout)
+            executor.submit(player.run)
+            time.sleep(ramp / players)
+    wall = time.time() - start
+
+    report = {
+        "players": players,
+        "games": results.games // 2,
+        "errors": results.errors,
+        "moves": len(results.round_trips),
+        "wall": wall,
+        "moves_per_second": len(results.round_trips) / wall,
+        "matchmaking": percentiles(results.matchmaking),
+        "round_trip": percentiles(results.round_trips),
+    }
+    if server:
+        after = server.usage()
+        report["server"] = {
+            "cpu": after["cpu"] - before["cpu"],
+            "cpu_percent": 100 * (after["cpu"] - before["cpu"]) / wall,
+            "rss_kb": after["VmRSS"],
+            "peak_rss_kb": after["VmHWM"],
+        }
+    return report
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--players", type=int, default=100)
+    parser.add_argument("--plies", type=int, default=20)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--ramp", type=float, default=1.0,
+                        help="seconds to spread the logins over")
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="seconds a player waits for any reply")
+    parser.add_argument("--no-spawn", action="store_true",
+                        help="use a server that is already running")
+    parser.add_argument("--output", help="write the report as json")
+    args = parser.parse_args()
+
+    server = None
+    if not args.no_spawn:
+        server = ServerProcess(args.port)
+        server.wait(args.host)
+    try:
+        report = run(args.players, args.plies, args.host, args.port,
+                     args.ramp, args.timeout, server)
+    finally:
+        if server:
+            server.stop()
+
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
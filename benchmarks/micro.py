@@ -0,0 +1,286 @@
+"""
+Micro benchmarks of the game.chess hot paths.
+
+    python -m benchmarks.micro                  # compare with the baseline
+    python -m benchmarks.micro --save           # record a new baseline
+    python -m benchmarks.micro -k move --threshold 0.1
+
+Every case is timed like timeit: the number of calls per round is raised
+until a round takes --min-time, the best and the median of --repeat rounds
+are reported. Memory is measured with tracemalloc on one call: the peak
+allocated during it and what it still holds after. A case regresses when its
+median time or its peak memory is more than --threshold above the baseline,
+the exit status is then 1.
+
+Baselines are only comparable on the machine they were recorded on, record
+one before starting on a change. On a shared or throttled machine timings
+move by 20-50% between runs, raise --repeat and --threshold there.
+"""
+from argparse import ArgumentParser
+from collections import OrderedDict
+from statistics import median
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from game.chess import Board, GameEngine, Math, Rook, Knight, Bishop, Queen, \
+    King, Pawn, make_game_engine, move_cache
+from game.evaluation import evaluate, tapered
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "micro_baseline.json")
+# middle game with every piece type able to move, white down
+MIDDLE_GAME = "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1"
+# memory below this many bytes is noise
+MEMORY_FLOOR = 512
+
+cases = OrderedDict()
+
+
+def case(f):
+    """
+        f() prepares the state and returns the function to time
+    """
+    cases[f.__name__] = f
+    return f
+
+
+@case
+def board_init():
+    return lambda: Board(player_down="W", create=True)
+
+
+@case
+def board_init_empty():
+    return lambda: Board(player_down="W")
+
+
+@case
+def make_engine():
+    return make_game_engine
+
+
+@case
+def filter_line():
+    board = Board.from_fen(MIDDLE_GAME)
+    rook = board[0, 7]
+    # Rook.find without the clean_moves cache, the decorator alone
+    line = Math.filter_line(lambda self, end, board: Rook.find(self, 0, 7))
+    return lambda: line(rook, (0, 2), board)
+
+
+@case
+def check_blocks():
+    board = Board.from_fen(MIDDLE_GAME)
+    rook = board[0, 7]
+    moves = {(0, 6), (0, 5), (0, 4), (0, 3), (0, 2)}
+    blocks = Math.check_blocks(lambda piece, end, board: moves)
+    return lambda: blocks(rook, (0, 2), board)
+
+
+def _check_move(square: tuple, end: tuple, clazz):
+    board = Board.from_fen(MIDDLE_GAME)
+    piece = board[square]
+    assert isinstance(piece, clazz), (square, piece)
+    return lambda: piece.check_move(end, board)
+
+
+@case
+def check_move_pawn():
+    return _check_move((0, 6), (0, 4), Pawn)
+
+
+@case
+def check_move_knight():
+    return _check_move((2, 5), (1, 3), Knight)
+
+
+@case
+def check_move_bishop():
+    return _check_move((4, 6), (0, 2), Bishop)
+
+
+@case
+def check_move_rook():
+    return _check_move((7, 7), (5, 7), Rook)
+
+
+@case
+def check_move_queen():
+    return _check_move((5, 5), (7, 5), Queen)
+
+
+@case
+def check_move_king():
+    return _check_move((4, 7), (3, 7), King)
+
+
+@case
+def move_undo():
+    engine = make_game_engine()
+
+    def run():
+        engine.move((4, 6), (4, 4), "W")
+        engine.undo()
+    return run
+
+
+@case
+def possible_moves():
+    engine = GameEngine(Board.from_fen(MIDDLE_GAME))
+
+    def run():
+        move_cache.clear()
+        return engine.possible_moves()
+    return run
+
+
+@case
+def possible_moves_cached():
+    engine = GameEngine(Board.from_fen(MIDDLE_GAME))
+    engine.possible_moves()
+    return engine.possible_moves
+
+
+@case
+def json_dict():
+    return Board.from_fen(MIDDLE_GAME).json_dict
+
+
+@case
+def board_eq():
+    board, other = Board.from_fen(MIDDLE_GAME), Board.from_fen(MIDDLE_GAME)
+    return lambda: board == other
+
+
+@case
+def evaluate_walk():
+    board = Board.from_fen(MIDDLE_GAME)
+    return lambda: evaluate(board)
+
+
+@case
+def evaluate_tapered():
+    # scores kept by the moves, the pawn structure cached
+    board = Board.from_fen(MIDDLE_GAME)
+    tapered(board)
+    return lambda: tapered(board)
+
+
+def measure_time(f, repeat: int, min_time: float) -> dict:
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(0, number):
+            f()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+    rounds = [elapsed]
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(1, repeat):
+            start = time.perf_counter()
+            for _ in range(0, number):
+                f()
+            rounds.append(time.perf_counter() - start)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    per_call = [i / number * 1e6 for i in rounds]
+    return {"us": min(per_call), "median_us": median(per_call),
+            "calls": number}
+
+
+def measure_memory(f) -> dict:
+    f()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = f()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return {"peak_bytes": peak - before, "retained_bytes": current - before}
+
+
+def run(names: list, repeat: int=5, min_time: float=0.1) -> dict:
+    report = OrderedDict()
+    for name in names:
+        f = cases[name]()
+        report[name] = measure_time(f, repeat, min_time)
+        report[name].update(measure_memory(f))
+    return report
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> list:
+    """
+    @return: (name, metric, baseline, value) of every regression
+    """
+    regressions = []
+    for name, result in report.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        if result["median_us"] > old["median_us"] * (1 + threshold):
+            regressions.append(
+                (name, "median_us", old["median_us"], result["median_us"]))
+        limit = max(old["peak_bytes"], MEMORY_FLOOR) * (1 + threshold)
+        if result["peak_bytes"] > limit:
+            regressions.append(
+                (name, "peak_bytes", old["peak_bytes"], result["peak_bytes"]))
+    return regressions
+
+
+def _print(report: dict, baseline: dict):
+    print("%-24s %12s %12s %10s %12s" % (
+        "case", "best us", "median us", "change", "peak bytes"))
+    for name, result in report.items():
+        change = ""
+        if name in baseline:
+            change = "%+.1f%%" % (
+                100 * (result["median_us"] / baseline[name]["median_us"] - 1))
+        print("%-24s %12.2f %12.2f %10s %12i" % (
+            name, result["us"], result["median_us"], change,
+            result["peak_bytes"]))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-k", dest="only", help="cases containing this text")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.1,
+                        help="seconds per round")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed slowdown, 0.25 is 25%%")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true",
+                        help="write the results as the new baseline")
+    args = parser.parse_args()
+
+    names = [i for i in cases if not args.only or args.only in i]
+    report = run(names, args.repeat, args.min_time)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    _print(report, baseline)
+
+    if args.save:
+        baseline.update(report)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2)
+        return
+    regressions = compare(report, baseline, args.threshold)
+    for name, metric, old, new in regressions:
+        print("REGRESSION %s %s: %.2f -> %.2f" % (name, metric, old, new))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
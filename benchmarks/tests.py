@@ -0,0 +1,24 @@
+import unittest
+
+try:
+    from benchmarks.load import Results, percentiles
+except ImportError:
+    # websocket-client is not installed
+    percentiles = None
+
+
+@unittest.skipIf(percentiles is None, "websocket-client is not installed")
+class TestLoad(unittest.TestCase):
+    def test_percentiles(self):
+        assert percentiles([]) == {}
+        values = list(range(100, 0, -1))
+        assert percentiles(values) == {"p50": 51, "p90": 91, "p99": 100,
+                                       "max": 100}
+        assert percentiles([7], points=(50, )) == {"p50": 7, "max": 7}
+
+    def test_results(self):
+        results = Results()
+        results.add("round_trips", 0.5)
+        results.incr("games")
+        results.incr("games")
+        assert results.round_trips == [0.5] and results.games == 2
@@ -1 +1,6 @@
-from common._redis import RedisQueue, PubSubPool, WebSocketPubSubPool
\ No newline at end of file
+from common._redis import RedisQueue, ReliableQueue, RedisPriorityQueue, \
+    PubSubPool, WebSocketPubSubPool, Presence, redis_client
+from common._local_redis import LocalRedis
+from common._ratings import Ratings
+from common._limits import TokenBucket, Buckets, Outbox, Admission
+from common._analysis_cache import AnalysisCache, AnalysisEntry
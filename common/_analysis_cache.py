@@ -0,0 +1,83 @@
+from collections import namedtuple
+import json
+from common._redis import redis_client
+from game.cache import LRUCache
+from metrics import registry, timed
+
+AnalysisEntry = namedtuple("AnalysisEntry", ["depth", "score", "move", "pv"])
+
+
+def _decode(value) -> str:
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def _move(value) -> tuple:
+    start, end, promotion = value
+    return tuple(start), tuple(end), promotion
+
+
+class AnalysisCache(object):
+    """
+        Search results by position, shared by the processes of every node.
+        A position is a redis hash with a field per depth searched holding
+        the score, the best move and the principal variation, it expires
+        ttl seconds after the last result stored. An LRU of the deepest
+        result of max_size positions sits in front of it.
+        A result only answers a request of its depth or less
+    """
+
+    def __init__(self, namespace="analysis", max_size: int=10000,
+                 ttl: int=7 * 24 * 3600, client=None):
+        self.__db = client if client is not None else redis_client()
+        self.namespace = namespace
+        self.ttl = ttl
+        self.local = LRUCache(max_size)
+        self._hits = {"local": registry.counter("%s.local_hits" % namespace),
+                      "redis": registry.counter("%s.redis_hits" % namespace)}
+        self._misses = registry.counter("%s.misses" % namespace)
+        registry.gauge("%s.local" % namespace, self.local.stats)
+
+    def _key(self, position_key: tuple) -> str:
+        return "%s:%s" % (self.namespace, ":".join(
+            str(i).replace(" ", "") for i in position_key))
+
+    @timed("analysis_cache.get")
+    def get(self, position_key: tuple, depth: int) -> AnalysisEntry:
+        """
+            The deepest result of the position searched depth or deeper,
+            None if there is none
+        """
+        entry = self.local.get(position_key)
+        if entry is not None and entry.depth >= depth:
+            self._hits["local"].incr()
+            return entry
+        stored = self.__db.hgetall(self._key(position_key))
+        if stored:
+            deepest = max(stored, key=lambda i: int(i))
+            if int(deepest) >= depth:
+                value = json.loads(_decode(stored[deepest]))
+                entry = AnalysisEntry(
+                    int(deepest), value["score"], _move(value["move"]),
+                    [_move(i) for i in value["pv"]])
+                self.local.put(position_key, entry)
+                self._hits["redis"].incr()
+                return entry
+        self._misses.incr()
+        return None
+
+    @timed("analysis_cache.put")
+    def put(self, position_key: tuple, depth: int, score: int, move: tuple,
+            pv: list=()):
+        entry = AnalysisEntry(depth, score, move, list(pv) or [move])
+        known = self.local.get(position_key)
+        if known is None or known.depth <= depth:
+            self.local.put(position_key, entry)
+        key = self._key(position_key)
+        pipe = self.__db.pipeline(transaction=False)
+        pipe.hset(key, depth, json.dumps(
+            {"score": score, "move": move, "pv": entry.pv}))
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def clear_local(self):
+        self.local.clear()
@@ -0,0 +1,175 @@
+"""
+Rate limits, bounded outbound queues and admission control.
+
+    bucket = TokenBucket(rate=10, burst=20)
+    bucket.take()                  # False once the client goes over 10/s
+
+    users = Buckets(rate=20, burst=40)
+    users.take("alice")            # one bucket per key, least recently
+                                   # used keys are forgotten
+
+    outbox = Outbox(64)
+    outbox.put(message, key="state:<game>")   # replaces a queued message
+                                              # with the same key
+
+    admission = Admission(200, {"join_queue": 15})
+    if admission.enter("join_queue"):
+        ...
+        admission.leave("join_queue")
+"""
+from collections import OrderedDict, deque
+from threading import Lock
+import time
+
+
+class TokenBucket(object):
+    __slots__ = ("rate", "burst", "tokens", "updated", "clock")
+
+    def __init__(self, rate: float, burst: float, clock=time.monotonic):
+        """
+        @param rate: tokens added per second
+        @param burst: most tokens held, the bucket starts full
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.clock = clock
+        self.updated = clock()
+
+    def take(self, tokens: float=1) -> bool:
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+
+class Buckets(object):
+    """
+        A TokenBucket per key, thread safe. At most max_keys are kept, a
+        forgotten key starts again with a full bucket
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int=100000,
+                 clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key, tokens: float=1) -> bool:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(
+                    self.rate, self.burst, self.clock)
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket.take(tokens)
+
+
+class Outbox(object):
+    """
+        Bounded queue of the messages waiting to be written to one client.
+        A message with a key replaces the queued message with the same key,
+        the client only needs the latest one
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._messages = deque()
+        self._keys = {}
+        self._lock = Lock()
+        # a sender is draining the queue
+        self.draining = False
+
+    def __len__(self):
+        return len(self._messages)
+
+    def put(self, message, key=None) -> bool:
+        """
+        @return: False if the queue is full and nothing was replaced
+        """
+        with self._lock:
+            if key is not None and key in self._keys:
+                self._keys[key][1] = message
+                return True
+            if len(self._messages) >= self.size:
+                return False
+            entry = [key, message]
+            self._messages.append(entry)
+            if key is not None:
+                self._keys[key] = entry
+            return True
+
+    def schedule(self) -> bool:
+        """
+        @return: True if the caller has to start draining
+        """
+        with self._lock:
+            if self.draining or not self._messages:
+                return False
+            self.draining = True
+            return True
+
+    def pop(self):
+        """
+            Next message, None once empty. The queue stops draining when it
+            returns None
+        """
+        with self._lock:
+            if not self._messages:
+                self.draining = False
+                return None
+            key, message = self._messages.popleft()
+            if key is not None:
+                del self._keys[key]
+            return message
+
+    def clear(self):
+        with self._lock:
+            self._messages.clear()
+            self._keys.clear()
+
+
+class Admission(object):
+    """
+        Caps the work waiting for or running in a thread pool, in total and
+        per kind of work
+    """
+
+    def __init__(self, total: int, limits: dict=None):
+        self.total = total
+        self.limits = dict(limits or {})
+        self.running = {}
+        self._count = 0
+        self._lock = Lock()
+
+    def enter(self, kind: str) -> bool:
+        with self._lock:
+            running = self.running.get(kind, 0)
+            if self._count >= self.total or \
+                    running >= self.limits.get(kind, self.total):
+                return False
+            self._count += 1
+            self.running[kind] = running + 1
+            return True
+
+    def leave(self, kind: str):
+        with self._lock:
+            self._count -= 1
+            self.running[kind] -= 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.running, total=self._count)
@@ -0,0 +1,505 @@
+from collections import deque, defaultdict
+from fnmatch import fnmatchcase
+import queue
+import threading
+import time
+
+
+def _encode(value) -> bytes:
+    """
+        Redis stores everything as bytes, do the same so callers can't tell
+        the difference between the stand-in and a real server.
+    """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    return repr(value).encode("utf-8")
+
+
+class LocalRedis(object):
+    """
+        In-process stand-in for StrictRedis.
+        Implements the subset of commands used by the project with the same
+        argument order and bytes replies. Used by tests, load runs and single
+        node deployments (settings.REDIS_LOCAL).
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+        self._lock = threading.RLock()
+        self._pushed = threading.Condition(self._lock)
+        self._subscribers = defaultdict(list)
+        self._pattern_subscribers = defaultdict(list)
+
+    def _expired(self, name) -> bool:
+        expires = self._expires.get(name)
+        if expires is not None and expires <= time.time():
+            self._data.pop(name, None)
+            self._expires.pop(name, None)
+            return True
+        return False
+
+    def _get(self, name):
+        name = _encode(name)
+        if self._expired(name):
+            return None
+        return self._data.get(name)
+
+    def flushdb(self):
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+        return True
+
+    def get(self, name):
+        with self._lock:
+            return self._get(name)
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        name = _encode(name)
+        with self._lock:
+            exists = self._get(name) is not None
+            if (nx and exists) or (xx and not exists):
+                return None
+            self._data[name] = _encode(value)
+            self._expires.pop(name, None)
+            if ex is not None:
+                self._expires[name] = time.time() + ex
+            elif px is not None:
+                self._expires[name] = time.time() + px / 1000.0
+            return True
+
+    def setex(self, name, time, value):
+        return self.set(name, value, ex=time)
+
+    def delete(self, *names):
+        deleted = 0
+        with self._lock:
+            for name in map(_encode, names):
+                if self._get(name) is not None:
+                    deleted += 1
+                self._data.pop(name, None)
+                self._expires.pop(name, None)
+        return deleted
+
+    def exists(self, name) -> bool:
+        with self._lock:
+            return self._get(name) is not None
+
+    def expire(self, name, time_) -> bool:
+        name = _encode(name)
+        with self._lock:
+            if self._get(name) is None:
+                return False
+            self._expires[name] = time.time() + time_
+            return True
+
+    def ttl(self, name):
+        name = _encode(name)
+        with self._lock:
+            if self._get(name) is None:
+                return -2
+            if name not in self._expires:
+                return -1
+            return int(round(self._expires[name] - time.time()))
+
+    def scan(self, cursor=0, match=None, count=None) -> tuple:
+        """
+            Every key in one round, the cursor returned is always 0
+        """
+        with self._lock:
+            names = [name for name in list(self._data)
+                     if not self._expired(name)]
+        if match is not None:
+            names = [i for i in names
+                     if fnmatchcase(i.decode("utf-8"), match)]
+        return 0, names
+
+    # lists
+    def _list(self, name, create=False):
+        name = _encode(name)
+        items = self._get(name)
+        if items is None and create:
+            items = self._data[name] = deque()
+        return items
+
+    def rpush(self, name, *values):
+        with self._lock:
+            items = self._list(name, create=True)
+            items.extend(map(_encode, values))
+            self._pushed.notify_all()
+            return len(items)
+
+    def lpush(self, name, *values):
+        with self._lock:
+            items = self._list(name, create=True)
+            items.extendleft(map(_encode, values))
+            self._pushed.notify_all()
+            return len(items)
+
+    def lpop(self, name):
+        with self._lock:
+            items = self._list(name)
+            if not items:
+                return None
+            item = items.popleft()
+            if not items:
+                self.delete(name)
+            return item
+
+    def blpop(self, keys, timeout=0):
+        if isinstance(keys, (str, bytes)):
+            keys = [keys]
+        deadline = time.time() + timeout if timeout else None
+        with self._lock:
+            while True:
+                for key in keys:
+                    item = self.lpop(key)
+                    if item is not None:
+                        return _encode(key), item
+                remaining = deadline - time.time() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._pushed.wait(remaining)
+
+    def rpop(self, name):
+        with self._lock:
+            items = self._list(name)
+            if not items:
+                return None
+            item = items.pop()
+            if not items:
+                self.delete(name)
+            return item
+
+    def brpoplpush(self, src, dst, timeout=0):
+        deadline = time.time() + timeout if timeout else None
+        with self._lock:
+            while True:
+                item = self.rpop(src)
+                if item is not None:
+                    self.lpush(dst, item)
+                    return item
+                remaining = deadline - time.time() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._pushed.wait(remaining)
+
+    def llen(self, name) -> int:
+        with self._lock:
+            items = self._list(name)
+            return len(items) if items else 0
+
+    def lrange(self, name, start, end) -> list:
+        with self._lock:
+            items = list(self._list(name) or [])
+            end = len(items) if end == -1 else end + 1
+            return items[start:end]
+
+    def lrem(self, name, count, value) -> int:
+        value = _encode(value)
+        with self._lock:
+            items = self._list(name)
+            if not items:
+                return 0
+            kept, removed = deque(), 0
+            for item in items:
+                if item == value and (count == 0 or removed < abs(count)):
+                    removed += 1
+                else:
+                    kept.append(item)
+            items.clear()
+            items.extend(kept)
+            if not items:
+                self.delete(name)
+            return removed
+
+    def rename(self, src, dst) -> bool:
+        src, dst = _encode(src), _encode(dst)
+        with self._lock:
+            value = self._get(src)
+            if value is None:
+                raise KeyError("no such key %r" % src)
+            self.delete(dst)
+            self._data[dst] = self._data.pop(src)
+            if src in self._expires:
+                self._expires[dst] = self._expires.pop(src)
+            return True
+
+    # hashes
+    def _hash(self, name, create=False):
+        name = _encode(name)
+        items = self._get(name)
+        if items is None and create:
+            items = self._data[name] = {}
+        return items
+
+    def hget(self, name, key):
+        with self._lock:
+            return (self._hash(name) or {}).get(_encode(key))
+
+    def hset(self, name, key, value) -> int:
+        with self._lock:
+            items = self._hash(name, create=True)
+            key = _encode(key)
+            added = key not in items
+            items[key] = _encode(value)
+            return int(added)
+
+    def hmset(self, name, mapping) -> bool:
+        with self._lock:
+            items = self._hash(name, create=True)
+            items.update(
+                (_encode(k), _encode(v)) for k, v in mapping.items())
+            return True
+
+    def hgetall(self, name) -> dict:
+        with self._lock:
+            return dict(self._hash(name) or {})
+
+    def hincrby(self, name, key, amount=1) -> int:
+        with self._lock:
+            items = self._hash(name, create=True)
+            key = _encode(key)
+            value = int(items.get(key, 0)) + amount
+            items[key] = _encode(value)
+            return value
+
+    def hdel(self, name, *keys) -> int:
+        with self._lock:
+            items = self._hash(name) or {}
+            deleted = 0
+            for key in map(_encode, keys):
+                if items.pop(key, None) is not None:
+                    deleted += 1
+            if not items:
+                self.delete(name)
+            return deleted
+
+    # sorted sets, kept as {member: score} and sorted on every range query
+    def _zset(self, name, create=False):
+        return self._hash(name, create)
+
+    def _sorted(self, name) -> list:
+        items = self._zset(name) or {}
+        return sorted(items.items(), key=lambda item: (item[1], item[0]))
+
+    def zadd(self, name, *args, **kwargs) -> int:
+        """
+            zadd(name, score1, member1, score2, member2, ...) or
+            zadd(name, member1=score1, ...) like StrictRedis
+        """
+        pairs = list(zip(args[1::2], args[0::2])) + list(kwargs.items())
+        with self._lock:
+            items = self._zset(name, create=True)
+            added = 0
+            for member, score in pairs:
+                member = _encode(member)
+                added += member not in items
+                items[member] = float(score)
+            return added
+
+    def zincrby(self, name, value, amount=1) -> float:
+        with self._lock:
+            items = self._zset(name, create=True)
+            member = _encode(value)
+            items[member] = items.get(member, 0.0) + amount
+            return items[member]
+
+    def zrem(self, name, *values) -> int:
+        return self.hdel(name, *values)
+
+    def zscore(self, name, value):
+        with self._lock:
+            return (self._zset(name) or {}).get(_encode(value))
+
+    def zcard(self, name) -> int:
+        with self._lock:
+            return len(self._zset(name) or {})
+
+    def zrank(self, name, value):
+        member = _encode(value)
+        with self._lock:
+            members = [i[0] for i in self._sorted(name)]
+        return members.index(member) if member in members else None
+
+    def zrevrank(self, name, value):
+        with self._lock:
+            rank = self.zrank(name, value)
+            return None if rank is None else self.zcard(name) - 1 - rank
+
+    @staticmethod
+    def _range(items, start, end, withscores):
+        end = len(items) if end == -1 else end + 1
+        items = items[start:end]
+        return items if withscores else [i[0] for i in items]
+
+    def zrange(self, name, start, end, desc=False, withscores=False):
+        with self._lock:
+            items = self._sorted(name)
+        if desc:
+            items.reverse()
+        return self._range(items, start, end, withscores)
+
+    def zrevrange(self, name, start, end, withscores=False):
+        return self.zrange(name, start, end, desc=True, withscores=withscores)
+
+    def zrangebyscore(self, name, min, max, start=None, num=None,
+                      withscores=False):
+        min, max = float(min), float(max)
+        with self._lock:
+            items = [i for i in self._sorted(name) if min <= i[1] <= max]
+        if start is not None:
+            items = items[start:start + num]
+        return items if withscores else [i[0] for i in items]
+
+    # transactions, commands run under the lock so they are atomic
+    def pipeline(self, transaction=True, shard_hint=None):
+        return LocalPipeline(self)
+
+    def transaction(self, func, *watches, **kwargs):
+        """
+            Same contract as StrictRedis.transaction, no retry is needed
+            since nothing else runs while func holds the lock
+        """
+        with self._lock:
+            pipe = self.pipeline()
+            pipe.watch(*watches)
+            func(pipe)
+            return pipe.execute()
+
+    # pub/sub
+    def publish(self, channel, message) -> int:
+        channel = _encode(channel)
+        msg = {'pattern': None, 'type': 'message',
+               'channel': channel, 'data': _encode(message)}
+        with self._lock:
+            subscribers = list(self._subscribers[channel])
+            patterns = [
+                (pattern, subscriber)
+                for pattern, queues in self._pattern_subscribers.items()
+                if fnmatchcase(channel.decode("utf-8"), pattern.decode("utf-8"))
+                for subscriber in queues]
+        for subscriber in subscribers:
+            subscriber.put(msg)
+        for pattern, subscriber in patterns:
+            subscriber.put(dict(msg, type='pmessage', pattern=pattern))
+        return len(subscribers) + len(patterns)
+
+    def pubsub(self):
+        return LocalPubSub(self)
+
+
+class LocalPipeline(object):
+    """
+        Commands run right away until multi(), then they are queued until
+        execute(). Without multi() every command is queued
+    """
+
+    def __init__(self, local_redis: LocalRedis):
+        self._redis = local_redis
+        self._commands = []
+        self._watching = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.reset()
+
+    def __getattr__(self, name):
+        command = getattr(self._redis, name)
+        if self._watching:
+            return command
+
+        def queued(*args, **kwargs):
+            self._commands.append((command, args, kwargs))
+            return self
+        return queued
+
+    def watch(self, *names):
+        self._watching = True
+
+    def unwatch(self):
+        self._watching = False
+
+    def multi(self):
+        self._watching = False
+
+    def execute(self) -> list:
+        with self._redis._lock:
+            results = [command(*args, **kwargs)
+                       for command, args, kwargs in self._commands]
+        self.reset()
+        return results
+
+    def reset(self):
+        self._commands = []
+        self._watching = False
+
+
+class LocalPubSub(object):
+    """
+        Same interface as redis.client.PubSub, messages are delivered through
+        a queue.Queue per subscriber
+    """
+
+    def __init__(self, local_redis: LocalRedis):
+        self._redis = local_redis
+        self._messages = queue.Queue()
+        self.channels = set()
+        self.patterns = set()
+
+    def subscribe(self, channels):
+        if isinstance(channels, (str, bytes)):
+            channels = [channels]
+        with self._redis._lock:
+            for channel in map(_encode, channels):
+                self._redis._subscribers[channel].append(self._messages)
+                self.channels.add(channel)
+                self._messages.put({'pattern': None, 'type': 'subscribe',
+                                    'channel': channel,
+                                    'data': len(self.channels)})
+
+    def unsubscribe(self, channels=None):
+        if channels is None:
+            channels = list(self.channels)
+        elif isinstance(channels, (str, bytes)):
+            channels = [channels]
+        with self._redis._lock:
+            for channel in map(_encode, channels):
+                if channel in self.channels:
+                    self._redis._subscribers[channel].remove(self._messages)
+                    self.channels.discard(channel)
+
+    def psubscribe(self, patterns):
+        if isinstance(patterns, (str, bytes)):
+            patterns = [patterns]
+        with self._redis._lock:
+            for pattern in map(_encode, patterns):
+                self._redis._pattern_subscribers[pattern].append(self._messages)
+                self.patterns.add(pattern)
+                self._messages.put({'pattern': None, 'type': 'psubscribe',
+                                    'channel': pattern,
+                                    'data': len(self.channels) + len(self.patterns)})
+
+    def punsubscribe(self, patterns=None):
+        if patterns is None:
+            patterns = list(self.patterns)
+        elif isinstance(patterns, (str, bytes)):
+            patterns = [patterns]
+        with self._redis._lock:
+            for pattern in map(_encode, patterns):
+                if pattern in self.patterns:
+                    self._redis._pattern_subscribers[pattern].remove(self._messages)
+                    self.patterns.discard(pattern)
+
+    def close(self):
+        self.unsubscribe()
+        self.punsubscribe()
+
+    def listen(self):
+        while True:
+            yield self._messages.get()
@@ -0,0 +1,129 @@
+from common._redis import redis_client
+from game.rating import DEFAULT_RATING, update
+from metrics import timed
+
+
+def _decode(value) -> str:
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class Ratings(object):
+    """
+        Player ratings in redis.
+        Every player has a hash (rating, games, wins, losses, draws), the
+        leaderboard is a sorted set by rating so ranks and pages are
+        O(log n). Queued players are in a second sorted set by rating, so a
+        close opponent is a range query
+    """
+
+    def __init__(self, namespace="ratings", client=None):
+        self.__db = client if client is not None else redis_client()
+        self.namespace = namespace
+        self.leaderboard_key = "%s:leaderboard" % namespace
+        self.queue_key = "%s:queue" % namespace
+
+    def _player_key(self, player) -> str:
+        return "%s:player:%s" % (self.namespace, _decode(player))
+
+    @staticmethod
+    def _parse(values: dict) -> dict:
+        values = {_decode(k): _decode(v) for k, v in values.items()}
+        return {"rating": float(values.get("rating", DEFAULT_RATING)),
+                "games": int(values.get("games", 0)),
+                "wins": int(values.get("wins", 0)),
+                "losses": int(values.get("losses", 0)),
+                "draws": int(values.get("draws", 0))}
+
+    def get(self, player) -> dict:
+        return self._parse(self.__db.hgetall(self._player_key(player)))
+
+    def rating(self, player) -> float:
+        return self.get(player)["rating"]
+
+    @timed("ratings.record_game")
+    def record_game(self, white, black, result: str) -> tuple:
+        """
+            Update both players of a finished game in one transaction
+        @param result: "1-0", "0-1" or "1/2-1/2"
+        @return: new (white, black) ratings
+        """
+        keys = self._player_key(white), self._player_key(black)
+        new = {}
+
+        def _update(pipe):
+            players = [self._parse(pipe.hgetall(key)) for key in keys]
+            ratings = update(players[0]["rating"], players[1]["rating"],
+                             result, players[0]["games"], players[1]["games"])
+            outcome = {"1-0": ("wins", "losses"), "0-1": ("losses", "wins"),
+                       "1/2-1/2": ("draws", "draws")}[result]
+            pipe.multi()
+            for player, key, values, rating, field in zip(
+                    (white, black), keys, players, ratings, outcome):
+                values["rating"] = rating
+                values["games"] += 1
+                values[field] += 1
+                pipe.hmset(key, values)
+                pipe.zadd(self.leaderboard_key, rating, _decode(player))
+            new["ratings"] = ratings
+
+        self.__db.transaction(_update, *keys)
+        return new["ratings"]
+
+    def rank(self, player):
+        """
+            1 for the best player, None if the player has no rated game
+        """
+        rank = self.__db.zrevrank(self.leaderboard_key, _decode(player))
+        return None if rank is None else rank + 1
+
+    def top(self, start: int=0, count: int=20) -> list:
+        """
+            [(player, rating), ...] best first
+        """
+        if start < 0 or count < 1:
+            # zrevrange reads negative indexes from the end
+            return []
+        items = self.__db.zrevrange(
+            self.leaderboard_key, start, start + count - 1, withscores=True)
+        return [(_decode(player), rating) for player, rating in items]
+
+    def replace_all(self, players: dict):
+        """
+            Swap every rating for the given ones, used by the recompute job
+        @param players: {player: {"rating": .., "games": .., ...}}
+        """
+        leaderboard = "%s:rebuild" % self.leaderboard_key
+        pipe = self.__db.pipeline()
+        pipe.delete(leaderboard)
+        for player, values in players.items():
+            pipe.delete(self._player_key(player))
+            pipe.hmset(self._player_key(player), values)
+            pipe.zadd(leaderboard, values["rating"], player)
+        if players:
+            pipe.rename(leaderboard, self.leaderboard_key)
+        else:
+            pipe.delete(self.leaderboard_key)
+        pipe.execute()
+
+    # matchmaking
+    def queue(self, channel, rating: float):
+        self.__db.zadd(self.queue_key, rating, channel)
+
+    def unqueue(self, *channels):
+        if channels:
+            self.__db.zrem(self.queue_key, *channels)
+
+    def nearest(self, channel, window: float):
+        """
+            The queued channel rated closest to the channel's player, within
+            window points. None if there is none
+        """
+        rating = self.__db.zscore(self.queue_key, channel)
+        if rating is None:
+            return None
+        candidates = self.__db.zrangebyscore(
+            self.queue_key, rating - window, rating + window, withscores=True)
+        candidates = [i for i in candidates if _decode(i[0]) != _decode(channel)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda i: abs(i[1] - rating))[0]
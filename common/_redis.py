@@ -3,11 +3,25 @@ import time
 import redis
 from redis.client import PubSub
 from app import settings
+from metrics import timed
+from common._local_redis import LocalRedis
+
+_local_redis = LocalRedis()
+
+
+def redis_client(kwargs=settings.REDIS_QUEUE_KWARGS):
+    """
+        Real StrictRedis for the given connection kwargs or the process wide
+        LocalRedis when settings.REDIS_LOCAL is on
+    """
+    if settings.REDIS_LOCAL:
+        return _local_redis
+    return redis.StrictRedis(**kwargs)
 
 
 class PubSubPool():
-    def __init__(self,channel_name, size=20):
-        self.redis_client = redis.StrictRedis(**settings.REDIS_QUEUE_KWARGS)
+    def __init__(self,channel_name, size=20, client=None):
+        self.redis_client = client if client is not None else redis_client()
         self._free_channels = deque(
             ("{}:{}".format(channel_name, i) for i in range(0, size)))
         self._occupied_channels = deque(maxlen=size)
@@ -23,8 +37,14 @@ class PubSubPool():
         return channel, self._pub_subs[channel]
 
     def free_pub_sub(self, channel):
+        """
+            Give the channel back once its last message was read
+        """
         self._occupied_channels.remove(channel)
-        self._free_channels.remove(channel)
+        self._free_channels.append(channel)
+
+    def free(self) -> int:
+        return len(self._free_channels)
 
     def _make_pub_sub(self, channel):
         pubsub = self.redis_client.pubsub()
@@ -46,11 +66,12 @@ class WebSocketPubSubPool(PubSubPool):
 class RedisQueue(object):
     """Simple Queue with Redis Backend"""
 
-    def __init__(self, name, namespace='queue'):
+    def __init__(self, name, namespace='queue', client=None):
         """The default connection parameters are: host='localhost', port=6379, db=0"""
-        self.__db = redis.Redis(**settings.REDIS_QUEUE_KWARGS)
+        self.__db = client if client is not None else redis_client()
         self.key = '%s:%s' % (namespace, name)
 
+    @timed("redis.llen")
     def qsize(self):
         """Return the approximate size of the queue."""
         return self.__db.llen(self.key)
@@ -59,10 +80,12 @@ class RedisQueue(object):
         """Return True if the queue is empty, False otherwise."""
         return self.qsize() == 0
 
+    @timed("redis.rpush")
     def put(self, item):
         """Put item into the queue."""
         self.__db.rpush(self.key, item)
 
+    @timed("redis.pop")
     def get(self, block=True, timeout=None):
         """Remove and return an item from the queue. 
 
@@ -79,4 +102,129 @@ class RedisQueue(object):
 
     def get_nowait(self):
         """Equivalent to get(False)."""
-        return self.get(False)
\ No newline at end of file
+        return self.get(False)
+
+    @timed("redis.lrem")
+    def remove(self, item) -> bool:
+        """Remove the item, False if it was no longer queued."""
+        return self.__db.lrem(self.key, 1, item) > 0
+
+
+class ReliableQueue(object):
+    """
+        FIFO queue in a redis list whose taken items stay in a processing
+        list until the consumer is done with them. A consumer that dies
+        leaves them there, recover() queues them again. Each queue has a
+        single consumer
+    """
+
+    def __init__(self, name, namespace='queue', client=None):
+        self.__db = client if client is not None else redis_client()
+        self.key = '%s:%s' % (namespace, name)
+        self.processing = '%s:%s:processing' % (namespace, name)
+
+    @timed("redis.llen")
+    def qsize(self):
+        return self.__db.llen(self.key)
+
+    @timed("redis.lpush")
+    def put(self, item):
+        self.__db.lpush(self.key, item)
+
+    @timed("redis.brpoplpush")
+    def get(self, timeout: int=0):
+        """
+            Take the oldest item into the processing list, None after
+            timeout seconds, 0 blocks
+        """
+        return self.__db.brpoplpush(self.key, self.processing, timeout)
+
+    def done(self):
+        """
+            Forget the items taken so far
+        """
+        self.__db.delete(self.processing)
+
+    def recover(self) -> int:
+        """
+            Queue the items taken and not done again, ahead of the others.
+            Only while the consumer isn't running
+        @return: items recovered
+        """
+        recovered = 0
+        # newest first, the oldest ends up next in line
+        item = self.__db.lpop(self.processing)
+        while item is not None:
+            self.__db.rpush(self.key, item)
+            recovered += 1
+            item = self.__db.lpop(self.processing)
+        return recovered
+
+
+class RedisPriorityQueue(object):
+    """
+        Queue in a redis sorted set, the item with the highest priority comes
+        out first. Putting a queued item again only changes its priority
+    """
+
+    def __init__(self, name, namespace='queue', client=None):
+        self.__db = client if client is not None else redis_client()
+        self.key = '%s:%s' % (namespace, name)
+
+    @timed("redis.zcard")
+    def qsize(self):
+        return self.__db.zcard(self.key)
+
+    @timed("redis.zadd")
+    def put(self, item, priority: float):
+        self.__db.zadd(self.key, **{item: priority})
+
+    @timed("redis.zpop")
+    def get_nowait(self):
+        """
+            Remove and return the item with the highest priority, None if
+            the queue is empty
+        """
+        while True:
+            items = self.__db.zrevrange(self.key, 0, 0)
+            if not items:
+                return None
+            # another consumer may take it between the two calls
+            if self.__db.zrem(self.key, items[0]):
+                return items[0]
+
+
+class Presence(object):
+    """
+        Last time members were seen, in a redis sorted set. Members not seen
+        for ttl seconds are stale
+    """
+
+    def __init__(self, name, ttl: float, client=None, clock=time.time):
+        self.__db = client if client is not None else redis_client()
+        self.key = "presence:%s" % name
+        self.ttl = ttl
+        self.clock = clock
+
+    def touch(self, *members):
+        if members:
+            now = self.clock()
+            self.__db.zadd(self.key, **{m: now for m in members})
+
+    def expire(self, *members):
+        """
+            Stale right away
+        """
+        if members:
+            self.__db.zadd(self.key, **{m: 0 for m in members})
+
+    def forget(self, *members):
+        if members:
+            self.__db.zrem(self.key, *members)
+
+    def alive(self, member) -> bool:
+        seen = self.__db.zscore(self.key, member)
+        return seen is not None and seen > self.clock() - self.ttl
+
+    def stale(self) -> list:
+        return self.__db.zrangebyscore(self.key, "-inf", self.clock() - self.ttl)
\ No newline at end of file
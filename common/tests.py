@@ -2,7 +2,11 @@ import unittest
 from multiprocessing.pool import Pool
 from multiprocessing import Process
 from redis import StrictRedis
-from common import PubSubPool, RedisQueue
+from common import PubSubPool, RedisQueue, ReliableQueue, \
+    RedisPriorityQueue, LocalRedis, Ratings, Presence, TokenBucket, Buckets, Outbox, Admission, AnalysisCache
+from game.chess import make_game_engine
+from game.ponder import Bot
+from metrics import registry
 
 
 class TestRedis(unittest.TestCase):
@@ -15,5 +19,261 @@ class TestRedis(unittest.TestCase):
         assert "channel" in channel
         # pubsub.listen()
 
+    def test_free_pub_sub(self):
+        channels = {self.pool.join()[0], self.pool.join()[0]}
+        assert self.pool.free() == 0
+        for channel in channels:
+            self.pool.free_pub_sub(channel)
+        assert self.pool.free() == 2
+        assert {self.pool.join()[0], self.pool.join()[0]} == channels
+
+    def test_remove(self):
+        self.queue.put("a")
+        assert self.queue.remove("a")
+        assert not self.queue.remove("a")
+
+    def test_priority_queue(self):
+        queue = RedisPriorityQueue("test_pq", client=LocalRedis())
+        queue.put("old", 10)
+        queue.put("new", 30)
+        queue.put("middle", 20)
+        queue.put("old", 40)
+        assert queue.qsize() == 3
+        assert [queue.get_nowait() for _ in range(0, 4)] == \
+            [b"old", b"new", b"middle", None]
+
+    def test_reliable_queue(self):
+        queue = ReliableQueue("test_rq", client=LocalRedis())
+        for item in ("a", "b", "c"):
+            queue.put(item)
+        assert queue.get(timeout=1) == b"a"
+        queue.done()
+        assert queue.get(timeout=1) == b"b"
+        assert queue.get(timeout=1) == b"c"
+        # the consumer died with b and c taken
+        assert queue.recover() == 2
+        queue.put("d")
+        assert [queue.get(timeout=1) for _ in range(0, 3)] == \
+            [b"b", b"c", b"d"]
+        queue.done()
+        assert queue.recover() == 0
+        assert queue.get(timeout=0.01) is None
+
+
+class TestLocalRedis(unittest.TestCase):
+    def setUp(self):
+        self.redis = LocalRedis()
+
+    def test_get_set(self):
+        assert self.redis.get("key") is None
+        self.redis.set("key", "value")
+        assert self.redis.get("key") == b"value"
+        assert self.redis.exists("key")
+        assert self.redis.delete("key", "missing") == 1
+        assert not self.redis.exists("key")
+
+    def test_expire(self):
+        self.redis.setex("key", 60, 1)
+        assert self.redis.get("key") == b"1"
+        assert 0 < self.redis.ttl("key") <= 60
+        self.redis.setex("key", -1, 1)
+        assert self.redis.get("key") is None
+        assert self.redis.ttl("key") == -2
+
+    def test_list_and_pub_sub(self):
+        pubsub = self.redis.pubsub()
+        pubsub.subscribe("channel")
+        self.redis.rpush("queue", "channel")
+        assert self.redis.llen("queue") == 1
+        assert self.redis.blpop("queue", timeout=1) == (b"queue", b"channel")
+        assert self.redis.blpop("queue", timeout=0.01) is None
+
+        assert self.redis.publish("channel", "game") == 1
+        messages = pubsub.listen()
+        assert next(messages)["type"] == "subscribe"
+        assert next(messages)["data"] == b"game"
+
+    def test_pattern_pub_sub(self):
+        pubsub = self.redis.pubsub()
+        pubsub.psubscribe("game:*")
+        assert self.redis.publish("game:1", "move") == 1
+        assert self.redis.publish("queue", "other") == 0
+        messages = pubsub.listen()
+        assert next(messages)["type"] == "psubscribe"
+        msg = next(messages)
+        assert (msg["type"], msg["pattern"], msg["channel"], msg["data"]) == \
+            ("pmessage", b"game:*", b"game:1", b"move")
+        pubsub.close()
+        assert self.redis.publish("game:1", "move") == 0
+
+    def test_sorted_set(self):
+        self.redis.zadd("board", 1500, "a", 1600, "b", c=1400)
+        assert self.redis.zrevrange("board", 0, 1) == [b"b", b"a"]
+        assert self.redis.zrevrank("board", "c") == 2
+        assert self.redis.zrangebyscore("board", 1450, 1650) == [b"a", b"b"]
+        assert self.redis.zscore("board", "a") == 1500
+        assert self.redis.zrem("board", "a") == 1
+        assert self.redis.zcard("board") == 2
+
+    def test_transaction(self):
+        def incr(pipe):
+            value = int(pipe.hget("hash", "n") or 0)
+            pipe.multi()
+            pipe.hset("hash", "n", value + 1)
+
+        self.redis.transaction(incr, "hash")
+        self.redis.transaction(incr, "hash")
+        assert self.redis.hgetall("hash") == {b"n": b"2"}
+
+
+class TestRatings(unittest.TestCase):
+    def setUp(self):
+        self.ratings = Ratings(client=LocalRedis())
+
+    def test_record_game(self):
+        white, black = self.ratings.record_game("a", "b", "1-0")
+        assert white > 1500 > black
+        self.ratings.record_game("c", "b", "1/2-1/2")
+        assert self.ratings.get("a")["wins"] == 1
+        assert self.ratings.get("b")["games"] == 2
+        assert self.ratings.rank("a") == 1
+        assert self.ratings.rank("b") == 3
+        assert self.ratings.rank("d") is None
+        assert [i[0] for i in self.ratings.top(0, 2)] == ["a", "c"]
+        assert self.ratings.top(0, 0) == [] and self.ratings.top(-1, 2) == []
+
+    def test_nearest(self):
+        self.ratings.queue("x", 1500)
+        self.ratings.queue("y", 1900)
+        self.ratings.queue("z", 1650)
+        assert self.ratings.nearest("x", 200) == b"z"
+        assert self.ratings.nearest("y", 200) is None
+        self.ratings.unqueue("z")
+        assert self.ratings.nearest("x", 200) is None
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestPresence(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeTime()
+        self.presence = Presence("test", 30, LocalRedis(), self.clock)
+
+    def test_stale(self):
+        self.presence.touch("a", "b")
+        self.clock.now = 20
+        self.presence.touch("b")
+        assert self.presence.stale() == []
+        self.clock.now = 40
+        assert self.presence.stale() == [b"a"]
+        assert not self.presence.alive("a") and self.presence.alive("b")
+        self.presence.expire("b")
+        assert self.presence.stale() == [b"a", b"b"]
+        self.presence.forget("a", "b")
+        assert self.presence.stale() == [] and not self.presence.alive("a")
+
+
+class TestAnalysisCache(unittest.TestCase):
+    KEY = (12345, 15, None, "W")
+    E4 = ((4, 6), (4, 4), None)
+    E5 = ((4, 1), (4, 3), None)
+
+    def setUp(self):
+        self.redis = LocalRedis()
+        self.cache = AnalysisCache("test_analysis", ttl=60, client=self.redis)
+
+    def _counts(self) -> list:
+        return [registry.counter("test_analysis.%s" % i).value
+                for i in ("local_hits", "redis_hits", "misses")]
+
+    def test_depth(self):
+        counts = self._counts()
+        assert self.cache.get(self.KEY, 1) is None
+        self.cache.put(self.KEY, 3, 20, self.E4, [self.E4, self.E5])
+        assert self.cache.get(self.KEY, 3) == (3, 20, self.E4, [self.E4, self.E5])
+        assert self.cache.get(self.KEY, 2).depth == 3
+        assert self.cache.get(self.KEY, 4) is None
+        assert [b - a for a, b in zip(counts, self._counts())] == [2, 0, 2]
+        assert 0 < self.redis.ttl("test_analysis:12345:15:None:W") <= 60
+
+    def test_shared(self):
+        self.cache.put(self.KEY, 3, 20, self.E4)
+        # another process
+        other = AnalysisCache("test_analysis", client=self.redis)
+        counts = self._counts()
+        assert other.get(self.KEY, 3) == (3, 20, self.E4, [self.E4])
+        assert other.get(self.KEY, 3).move == self.E4
+        other.put(self.KEY, 5, -10, self.E5)
+        # the shallower result doesn't replace the deeper one
+        other.put(self.KEY, 4, 0, self.E4)
+        assert other.get(self.KEY, 5).score == -10
+        assert self.cache.get(self.KEY, 2).depth == 3
+        assert self.cache.get(self.KEY, 4).score == -10
+        assert [b - a for a, b in zip(counts, self._counts())] == [3, 2, 0]
+
+    def test_bot(self):
+        first = Bot("W", depth=2, ponder=False, cache=self.cache)
+        searched = first.play(make_game_engine("W"))
+        assert searched.nodes > 0
+        entry = self.cache.get(make_game_engine("W").board.position_key(), 2)
+        assert entry.move == searched.move and entry.pv[0] == searched.move
+        # another node's bot, no search needed
+        second = Bot("W", depth=2, ponder=False, cache=AnalysisCache(
+            "test_analysis", client=self.redis))
+        engine = make_game_engine("W")
+        assert second.play(engine) == (searched.score, searched.move, 0)
+        assert engine.history() == [searched.move]
+        deeper = Bot("W", depth=3, ponder=False, cache=self.cache)
+        assert deeper.play(make_game_engine("W")).nodes > 0
+
+
+class TestLimits(unittest.TestCase):
+    def test_token_bucket(self):
+        clock = FakeTime()
+        bucket = TokenBucket(rate=2, burst=3, clock=clock)
+        assert [bucket.take() for _ in range(0, 4)] == [True] * 3 + [False]
+        clock.now = 0.5
+        assert bucket.take() and not bucket.take()
+        clock.now = 100
+        # never more than the burst
+        assert sum(bucket.take() for _ in range(0, 10)) == 3
+
+    def test_buckets(self):
+        buckets = Buckets(rate=1, burst=1, max_keys=2, clock=FakeTime())
+        assert buckets.take("a") and not buckets.take("a")
+        buckets.take("b")
+        buckets.take("c")
+        assert len(buckets) == 2
+        # forgotten, full again
+        assert buckets.take("a")
+
+    def test_outbox(self):
+        outbox = Outbox(2)
+        assert outbox.put("a") and outbox.put("s1", key="state")
+        assert not outbox.put("b")
+        assert outbox.put("s2", key="state")
+        assert outbox.schedule() and not outbox.schedule()
+        assert [outbox.pop(), outbox.pop(), outbox.pop()] == ["a", "s2", None]
+        assert not outbox.draining
+        assert outbox.put("c") and outbox.schedule()
+
+    def test_admission(self):
+        admission = Admission(3, {"join_queue": 1})
+        assert admission.enter("join_queue")
+        assert not admission.enter("join_queue")
+        assert admission.enter("play_bot") and admission.enter("play_bot")
+        assert not admission.enter("play_bot")
+        admission.leave("join_queue")
+        assert admission.snapshot() == {"join_queue": 0, "play_bot": 2,
+                                        "total": 2}
+        assert admission.enter("join_queue")
+
+
 if __name__ == '__main__':
     unittest.main()
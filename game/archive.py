@@ -0,0 +1,402 @@
+"""
+Columnar archive of finished games, read through memory maps.
+
+    writer = ArchiveWriter("/data/archive")
+    writer.add("alice", "bob", "1-0", engine.history(), eco="C20")
+    writer.flush()
+
+    archive = Archive("/data/archive")
+    ids = archive.query(player="alice", eco="C20", result="1-0")
+    archive.game(ids[0])     # {"white": "alice", ..., "moves": [...]}
+
+Every header column is a flat file of fixed width integers (white, black,
+result, eco, length, date, offset) and a query is a few numpy operations on
+their memory maps, no game is turned into python objects until asked for.
+Moves of all games are one uint16 file, a move packs the from and to squares
+(6 bits each, file + 8 * rank so it doesn't depend on player_down) and the
+promotion (3 bits). offset[i] is the first move of game i.
+
+Games by player and by ECO code are posting lists in CSR form: the game ids
+sorted by key then id, and per key the slice where its ids start. A query
+starts from the shortest posting list it can use and filters the remaining
+columns on the candidate ids only.
+
+Appending adds rows to the column files and rebuilds the posting lists,
+about 0.4s per million games. Readers keep the games they mapped until
+reload. Once every column is appended the sizes are written to flushed.json
+in one replace, with the keys the caller gave for the games of the flush. A
+writer opened after a crash in the middle of a flush cuts the files back to
+those sizes, so the columns never disagree on the number of games.
+
+The analysis of a game is written in place, in any order of the games: per
+move the score after it (centipawns for white, int16) and its mark (uint8,
+an index of MARKS) at the offsets of the moves file, then the game's flag
+in the analyzed column. Games not analyzed yet are holes of zeros.
+"""
+import json
+import os
+import numpy as np
+from game.chess import PROMOTIONS
+
+RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+PROMOTION_CODES = [None] + list(PROMOTIONS)
+
+COLUMNS = {
+    "white": np.uint32,
+    "black": np.uint32,
+    "result": np.uint8,
+    "eco": np.uint16,
+    "length": np.uint16,
+    # unix seconds
+    "date": np.uint32,
+    "offset": np.uint64,
+}
+MOVES = "moves"
+PLAYERS = "players.txt"
+FLUSHED = "flushed.json"
+ANALYSIS_COLUMNS = {
+    # per move
+    "scores": np.int16,
+    "marks": np.uint8,
+    # per game, 1 once the moves above are written
+    "analyzed": np.uint8,
+}
+# inaccuracy, mistake, blunder
+MARKS = (None, "?!", "?", "??")
+
+
+def eco_code(eco: str) -> int:
+    """
+        "C20" -> 221, 0 when the opening is unknown
+    """
+    if not eco:
+        return 0
+    return 1 + "ABCDE".index(eco[0]) * 100 + int(eco[1:3])
+
+
+def eco_name(code: int) -> str:
+    if code == 0:
+        return None
+    code -= 1
+    return "%s%02i" % ("ABCDE"[code // 100], code % 100)
+
+
+def square_index(position: tuple, player_down: str="W") -> int:
+    x, y = position
+    return x + 8 * (7 - y if player_down == "W" else y)
+
+
+def index_square(index: int, player_down: str="W") -> tuple:
+    x, rank = index % 8, index // 8
+    return x, 7 - rank if player_down == "W" else rank
+
+
+def encode_move(move: tuple, player_down: str="W") -> int:
+    start, end, promotion = move
+    return square_index(start, player_down) | \
+        square_index(end, player_down) << 6 | \
+        PROMOTION_CODES.index(promotion) << 12
+
+
+def decode_move(code: int, player_down: str="W") -> tuple:
+    return (index_square(code & 63, player_down),
+            index_square(code >> 6 & 63, player_down),
+            PROMOTION_CODES[code >> 12])
+
+
+def _path(directory: str, name: str) -> str:
+    return os.path.join(directory, name)
+
+
+def _map(directory: str, name: str, dtype) -> np.ndarray:
+    """
+        Read only memory map of a column, empty if there is no file yet
+    """
+    path = _path(directory, name)
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+def _write(directory: str, name: str, array: np.ndarray):
+    # readers never see a half written index
+    tmp = _path(directory, name + ".tmp")
+    array.tofile(tmp)
+    os.replace(tmp, _path(directory, name))
+
+
+def _write_at(directory: str, name: str, index: int, array: np.ndarray):
+    """
+        Write array over the column from row index on, the file grows as
+        needed
+    """
+    fd = os.open(_path(directory, name), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        os.pwrite(fd, array.tobytes(), index * array.itemsize)
+    finally:
+        os.close(fd)
+
+
+def postings(keys: np.ndarray, ids: np.ndarray, size: int) -> tuple:
+    """
+        CSR posting lists
+    @param size: number of distinct keys, keys are 0 .. size - 1
+    @return: (ids sorted by key then id, offsets) the ids of key k are
+        ids[offsets[k]:offsets[k + 1]]
+    """
+    order = np.lexsort((ids, keys))
+    offsets = np.searchsorted(keys[order], np.arange(0, size + 1))
+    return ids[order].astype(np.uint32), offsets.astype(np.uint64)
+
+
+class ArchiveWriter:
+    """
+        Appends games to an archive directory, one writer per directory
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # keys of the games of the last flush
+        self.flushed_keys = set()
+        truncated = self._rollback()
+        self.players = {}
+        players = _path(directory, PLAYERS)
+        if os.path.exists(players):
+            with open(players, encoding="utf-8") as f:
+                for i, name in enumerate(f.read().splitlines()):
+                    self.players[name] = i
+        self._new_players = []
+        self._rows = {name: [] for name in COLUMNS}
+        self._moves = []
+        self._next_offset = len(_map(directory, MOVES, np.uint16))
+        self.size = len(_map(directory, "result", COLUMNS["result"]))
+        if truncated:
+            self.index()
+
+    def _rollback(self) -> bool:
+        """
+            Cut the files back to the sizes of the last complete flush
+        @return: True if a file was longer
+        """
+        path = _path(self.directory, FLUSHED)
+        if not os.path.exists(path):
+            return False
+        with open(path, encoding="utf-8") as f:
+            flushed = json.load(f)
+        self.flushed_keys = set(flushed["keys"])
+        sizes = {name: flushed["size"] * np.dtype(dtype).itemsize
+                 for name, dtype in COLUMNS.items()}
+        sizes[MOVES] = flushed["moves"] * np.dtype(np.uint16).itemsize
+        truncated = False
+        for name, size in sizes.items():
+            column = _path(self.directory, name)
+            if os.path.exists(column) and os.path.getsize(column) > size:
+                os.truncate(column, size)
+                truncated = True
+        players = _path(self.directory, PLAYERS)
+        if os.path.exists(players):
+            with open(players, encoding="utf-8") as f:
+                names = f.read().splitlines()
+            if len(names) > flushed["players"]:
+                tmp = _path(self.directory, PLAYERS + ".tmp")
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.write("".join(i + "\n" for i in names[:flushed["players"]]))
+                os.replace(tmp, players)
+                truncated = True
+        return truncated
+
+    def _player(self, name: str) -> int:
+        if name not in self.players:
+            self.players[name] = len(self.players)
+            self._new_players.append(name)
+        return self.players[name]
+
+    def add(self, white: str, black: str, result: str, moves: list,
+            eco: str=None, date: float=0, player_down: str="W") -> int:
+        """
+        @param moves: (start, end, promotion) as GameEngine.history gives them
+        @return: id of the game
+        """
+        if "\n" in white or "\n" in black:
+            raise ValueError("Player names can't contain new lines")
+        # everything that can raise before the first column grows
+        result, eco = RESULTS.index(result), eco_code(eco)
+        encoded = [encode_move(i, player_down) for i in moves]
+        row = self._rows
+        row["white"].append(self._player(white))
+        row["black"].append(self._player(black))
+        row["result"].append(result)
+        row["eco"].append(eco)
+        row["length"].append(len(moves))
+        row["date"].append(int(date))
+        row["offset"].append(self._next_offset)
+        self._moves.extend(encoded)
+        self._next_offset += len(moves)
+        self.size += 1
+        return self.size - 1
+
+    def flush(self, keys: list=()):
+        """
+            Append the added games and rebuild the indexes
+        @param keys: strings identifying the added games, flushed_keys of the
+            next writer opened on the directory
+        """
+        if self._new_players:
+            with open(_path(self.directory, PLAYERS), "a",
+                      encoding="utf-8") as f:
+                f.write("".join(i + "\n" for i in self._new_players))
+            self._new_players = []
+        # moves before the headers pointing to them
+        with open(_path(self.directory, MOVES), "ab") as f:
+            np.array(self._moves, dtype=np.uint16).tofile(f)
+        for name, dtype in COLUMNS.items():
+            with open(_path(self.directory, name), "ab") as f:
+                np.array(self._rows[name], dtype=dtype).tofile(f)
+            self._rows[name] = []
+        self._moves = []
+        tmp = _path(self.directory, FLUSHED + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"size": self.size, "moves": self._next_offset,
+                       "players": len(self.players), "keys": list(keys)}, f)
+        os.replace(tmp, _path(self.directory, FLUSHED))
+        self.flushed_keys = set(keys)
+        self.index()
+
+    def index(self):
+        white = _map(self.directory, "white", COLUMNS["white"])
+        black = _map(self.directory, "black", COLUMNS["black"])
+        eco = _map(self.directory, "eco", COLUMNS["eco"])
+        ids = np.arange(0, len(white), dtype=np.uint32)
+        player_ids, player_offsets = postings(
+            np.concatenate((white, black)), np.concatenate((ids, ids)),
+            len(self.players))
+        eco_ids, eco_offsets = postings(eco, ids, eco_code("E99") + 1)
+        _write(self.directory, "player_ids", player_ids)
+        _write(self.directory, "player_offsets", player_offsets)
+        _write(self.directory, "eco_ids", eco_ids)
+        _write(self.directory, "eco_offsets", eco_offsets)
+
+
+class AnalysisWriter:
+    """
+        Stores the analysis of archived games, one writer per directory. It
+        doesn't touch the files of the ArchiveWriter
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def add(self, game_id: int, offset: int, scores: list, marks: list):
+        """
+        @param offset: of the game's first move, Archive.offset[game_id]
+        @param scores: centipawns for white after every move
+        @param marks: index in MARKS of every move
+        """
+        if len(scores) != len(marks):
+            raise ValueError("A score and a mark per move")
+        # the flag last, readers never see half an analysis
+        _write_at(self.directory, "scores", offset,
+                  np.array(scores, dtype=ANALYSIS_COLUMNS["scores"]))
+        _write_at(self.directory, "marks", offset,
+                  np.array(marks, dtype=ANALYSIS_COLUMNS["marks"]))
+        _write_at(self.directory, "analyzed", game_id,
+                  np.ones(1, dtype=ANALYSIS_COLUMNS["analyzed"]))
+
+
+class Archive:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.reload()
+
+    def reload(self):
+        """
+            Map the games appended since the archive was opened
+        """
+        directory = self.directory
+        self.players = []
+        players = _path(directory, PLAYERS)
+        if os.path.exists(players):
+            with open(players, encoding="utf-8") as f:
+                self.players = f.read().splitlines()
+        self.player_ids = {name: i for i, name in enumerate(self.players)}
+        for name, dtype in COLUMNS.items():
+            setattr(self, name, _map(directory, name, dtype))
+        self.moves = _map(directory, MOVES, np.uint16)
+        for name, dtype in ANALYSIS_COLUMNS.items():
+            setattr(self, name, _map(directory, name, dtype))
+        self._player_postings = (_map(directory, "player_ids", np.uint32),
+                                 _map(directory, "player_offsets", np.uint64))
+        self._eco_postings = (_map(directory, "eco_ids", np.uint32),
+                              _map(directory, "eco_offsets", np.uint64))
+
+    def __len__(self):
+        # the index may lag behind the columns while a writer flushes
+        offsets = self._eco_postings[1]
+        return int(offsets[-1]) if len(offsets) else 0
+
+    @staticmethod
+    def _posting(postings: tuple, key: int) -> np.ndarray:
+        ids, offsets = postings
+        if key is None or key + 1 >= len(offsets):
+            return np.zeros(0, dtype=np.uint32)
+        return ids[int(offsets[key]):int(offsets[key + 1])]
+
+    def by_player(self, player: str) -> np.ndarray:
+        return self._posting(self._player_postings, self.player_ids.get(player))
+
+    def by_eco(self, eco: str) -> np.ndarray:
+        return self._posting(self._eco_postings, eco_code(eco))
+
+    def query(self, player: str=None, color: str=None, eco: str=None,
+              result: str=None, since: float=None, until: float=None) -> np.ndarray:
+        """
+            Ids of the games matching every given filter, in archive order
+        @param color: with player, only the games where the player had W or B
+        @param since, until: unix seconds, until excluded
+        """
+        ids = None
+        if player is not None:
+            ids = self.by_player(player)
+        if eco is not None:
+            by_eco = self.by_eco(eco)
+            ids = by_eco if ids is None else \
+                np.intersect1d(ids, by_eco, assume_unique=True)
+        if ids is None:
+            ids = np.arange(0, len(self), dtype=np.uint32)
+        if player is not None and color is not None:
+            column = self.white if color == "W" else self.black
+            ids = ids[column[ids] == self.player_ids.get(player, -1)]
+        if result is not None:
+            ids = ids[self.result[ids] == RESULTS.index(result)]
+        if since is not None:
+            ids = ids[self.date[ids] >= since]
+        if until is not None:
+            ids = ids[self.date[ids] < until]
+        return ids
+
+    def game_moves(self, game_id: int, player_down: str="W") -> list:
+        start = int(self.offset[game_id])
+        codes = self.moves[start:start + int(self.length[game_id])]
+        return [decode_move(int(i), player_down) for i in codes]
+
+    def analysis(self, game_id: int) -> dict:
+        """
+            {"scores": [...], "marks": [None, "??", ...]} per move, None
+            until the game is analyzed
+        """
+        if game_id >= len(self.analyzed) or not self.analyzed[game_id]:
+            return None
+        start = int(self.offset[game_id])
+        end = start + int(self.length[game_id])
+        return {"scores": [int(i) for i in self.scores[start:end]],
+                "marks": [MARKS[i] for i in self.marks[start:end]]}
+
+    def game(self, game_id: int, player_down: str="W") -> dict:
+        return {"id": int(game_id),
+                "white": self.players[self.white[game_id]],
+                "black": self.players[self.black[game_id]],
+                "result": RESULTS[self.result[game_id]],
+                "eco": eco_name(int(self.eco[game_id])),
+                "date": int(self.date[game_id]),
+                "moves": self.game_moves(game_id, player_down)}
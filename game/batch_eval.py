@@ -0,0 +1,202 @@
+"""
+Batch evaluation of many boards at once with numpy.
+
+    planes = to_planes(boards)   # N x 12 x 8 x 8 uint8
+    scores = evaluate(planes)    # N int32, centipawns for white
+
+Planes 0-5 are the white P N B R Q K, planes 6-11 the black ones, indexed
+[plane, y, x] with white moving towards y = 0 whatever the board's
+player_down. Material, piece square and mobility terms are computed with array
+operations over the whole batch, only the Board -> planes conversion walks
+the squares in python. Mobility works on one uint64 bitboard per piece type,
+so a move generation step over the whole batch is a couple of shifts.
+
+Measured on 10000 positions from random games against evaluation.evaluate
+plus the same mobility computed piece by piece in python (about 200us per
+board): evaluate takes about 2us per board, to_planes about 27us. From
+Board objects that's about 7x, the 100x only holds for callers that keep
+their planes.
+"""
+import numpy as np
+from game.evaluation import PIECE_VALUES, PIECE_SQUARE, MOBILITY, \
+    PIECE_LETTERS, piece_letter
+
+COLORS = "WB"
+
+ROOK_DIRECTIONS = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+BISHOP_DIRECTIONS = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+KNIGHT_OFFSETS = [(1, 2), (2, 1), (-1, 2), (-2, 1),
+                  (1, -2), (2, -1), (-1, -2), (-2, -1)]
+
+
+def plane_index(color: str, letter: str) -> int:
+    return COLORS.index(color) * 6 + PIECE_LETTERS.index(letter)
+
+
+def _square_weights() -> np.ndarray:
+    """
+        12 x 8 x 8 value + piece square score of every piece on every square.
+        Black uses the mirrored white table with the opposite sign.
+    """
+    weights = np.zeros((12, 8, 8), dtype=np.int32)
+    for letter in PIECE_LETTERS:
+        table = np.array(PIECE_SQUARE[letter], dtype=np.int32)
+        table += PIECE_VALUES[letter]
+        weights[plane_index("W", letter)] = table
+        weights[plane_index("B", letter)] = -table[::-1]
+    return weights
+
+SQUARE_WEIGHTS = _square_weights()
+
+
+def _byte_weights() -> np.ndarray:
+    """
+        12 x 8 x 256: summed SQUARE_WEIGHTS of the squares set in byte k of a
+        plane's bitboard, so the square term is 96 lookups per board
+    """
+    weights = SQUARE_WEIGHTS.reshape((12, 8, 8))
+    table = np.zeros((12, 8, 256), dtype=np.int32)
+    for value in range(0, 256):
+        bits = [(value >> i) & 1 for i in range(0, 8)]
+        table[:, :, value] = (weights * bits).sum(axis=2)
+    return table
+
+BYTE_WEIGHTS = _byte_weights()
+_BYTE_OFFSETS = np.arange(0, 96, dtype=np.intp) * 256
+
+
+def to_planes(boards: list) -> np.ndarray:
+    index = {}
+    boards_, planes_, squares_ = [], [], []
+    for n, board in enumerate(boards):
+        flip = board.player_down == "B"
+        # board.values() is ordered by y then x
+        for square, piece in enumerate(board.values()):
+            if piece is None:
+                continue
+            key = (piece.__class__, piece.color)
+            if key not in index:
+                index[key] = plane_index(piece.color, piece_letter(piece))
+            boards_.append(n)
+            planes_.append(index[key])
+            squares_.append(square ^ 56 if flip else square)
+    planes = np.zeros((len(boards), 12, 64), dtype=np.uint8)
+    planes[boards_, planes_, squares_] = 1
+    return planes.reshape((len(boards), 12, 8, 8))
+
+
+def to_bitboards(planes: np.ndarray) -> np.ndarray:
+    """
+        N x 12 uint64, bit y * 8 + x set when the plane has a piece on x, y
+    """
+    n = len(planes)
+    packed = np.packbits(planes.reshape((n, 12, 64)), axis=-1,
+                         bitorder="little")
+    return packed.view("<u8").reshape((n, 12)).astype(np.uint64)
+
+
+def _file_mask(files) -> np.uint64:
+    mask = 0
+    for x in files:
+        for y in range(0, 8):
+            mask |= 1 << (y * 8 + x)
+    return np.uint64(mask)
+
+# after moving dx files, clear the squares that wrapped around the board edge
+WRAP_MASKS = {dx: ~_file_mask(range(0, dx) if dx > 0 else range(8 + dx, 8))
+              for dx in (-2, -1, 0, 1, 2)}
+
+
+def _shift(bitboards: np.ndarray, dx: int, dy: int) -> np.ndarray:
+    """
+        Move every piece of the bitboards by dx, dy, dropping what falls off
+    """
+    offset = dy * 8 + dx
+    if offset > 0:
+        shifted = bitboards << np.uint64(offset)
+    else:
+        shifted = bitboards >> np.uint64(-offset)
+    return shifted & WRAP_MASKS[dx]
+
+
+if hasattr(np, "bitwise_count"):
+    popcount = np.bitwise_count
+else:
+    _BYTE_COUNTS = np.array([bin(i).count("1") for i in range(0, 256)],
+                            dtype=np.uint8)
+
+    def popcount(bitboards: np.ndarray) -> np.ndarray:
+        counts = _BYTE_COUNTS[bitboards.view(np.uint8)]
+        return counts.reshape(bitboards.shape + (8,)).sum(axis=-1)
+
+
+def _both_colors(bitboards: np.ndarray, letter: str) -> np.ndarray:
+    """
+        2N bitboards of a piece type, white boards first
+    """
+    return np.concatenate([bitboards[:, plane_index("W", letter)],
+                           bitboards[:, plane_index("B", letter)]])
+
+
+def _mobility(bitboards: np.ndarray) -> np.ndarray:
+    """
+        Weighted count of the squares each piece attacks and doesn't hold a
+        piece of its own color, white minus black, per board.
+        The pieces of a type are in one bitboard, so the squares are counted
+        per offset or direction: a knight has one target per offset, and a
+        ray stops at the first piece, so the rays of two pieces in the same
+        direction never share a square. Summing the counts then counts
+        every piece's squares, like a loop over the pieces would
+    """
+    n = len(bitboards)
+    white = np.bitwise_or.reduce(bitboards[:, :6], axis=1)
+    black = np.bitwise_or.reduce(bitboards[:, 6:], axis=1)
+    own = np.concatenate([white, black])
+    empty = ~np.concatenate([white | black, white | black])
+    scores = np.zeros(2 * n, dtype=np.int64)
+
+    knights = _both_colors(bitboards, "N")
+    for dx, dy in KNIGHT_OFFSETS:
+        targets = _shift(knights, dx, dy) & ~own
+        scores += MOBILITY["N"] * popcount(targets).astype(np.int64)
+
+    for letter, directions in (("B", BISHOP_DIRECTIONS),
+                               ("R", ROOK_DIRECTIONS),
+                               ("Q", ROOK_DIRECTIONS + BISHOP_DIRECTIONS)):
+        pieces = _both_colors(bitboards, letter)
+        for dx, dy in directions:
+            attacks = np.zeros(2 * n, dtype=np.uint64)
+            ray = pieces
+            for _ in range(0, 7):
+                ray = _shift(ray, dx, dy)
+                attacks |= ray
+                # stop at the first piece of either color
+                ray = ray & empty
+                if not ray.any():
+                    break
+            scores += MOBILITY[letter] * \
+                popcount(attacks & ~own).astype(np.int64)
+    return scores[:n] - scores[n:]
+
+
+def _squares(bitboards: np.ndarray) -> np.ndarray:
+    """
+        Material + piece square score per board
+    """
+    n = len(bitboards)
+    # little endian: byte k of a bitboard is row y = k
+    rows = bitboards.view(np.uint8).reshape((n, 96)).astype(np.intp)
+    scores = BYTE_WEIGHTS.take(rows + _BYTE_OFFSETS)
+    return scores.sum(axis=1, dtype=np.int64)
+
+
+def evaluate(planes: np.ndarray) -> np.ndarray:
+    """
+        Material + piece square + mobility for N x 12 x 8 x 8 planes
+    """
+    bitboards = to_bitboards(planes)
+    return (_squares(bitboards) + _mobility(bitboards)).astype(np.int32)
+
+
+def evaluate_boards(boards: list) -> np.ndarray:
+    return evaluate(to_planes(boards))
@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from threading import Lock
+import sys
+
+
+def deep_size(value) -> int:
+    """
+        Approximate memory of nested tuples/lists/dicts of small objects
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        return size + sum(deep_size(k) + deep_size(v) for k, v in value.items())
+    if isinstance(value, (tuple, list, set, frozenset)):
+        return size + sum(deep_size(i) for i in value)
+    return size
+
+
+class LRUCache(object):
+    """
+        Thread safe, bounded, least recently used entries are evicted first.
+        Keeps hit/miss counters and an estimate of the memory held.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.memory = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        size = deep_size(key) + deep_size(value)
+        with self._lock:
+            if key in self._data:
+                self.memory -= self._sizes[key]
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self._sizes[key] = size
+            self.memory += size
+            while len(self._data) > self.max_size:
+                evicted, _ = self._data.popitem(last=False)
+                self.memory -= self._sizes.pop(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.memory = 0
+            self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "memory": self.memory}
@@ -1,11 +1,13 @@
-from copy import deepcopy
 from itertools import product, chain
 from functools import wraps
 import uuid
 from math import fabs
 from abc import ABCMeta, abstractmethod
 from collections import OrderedDict, defaultdict
-import operator
+import random
+from game.cache import LRUCache
+from game.evaluation import SQUARE_SCORES, PHASE, PIECE_NAMES, PAWN_KEYS
+from metrics import timed, registry
 
 """
 Board holds the state of the game only.
@@ -13,13 +15,34 @@ GameEngine holds a Board.
 game_engine.move moves the pieces:
     1) finds the piece on board.
     2) calls get move on the piece (returns extends AbstractMove objecet)
-    3) calls move.execute
+    3) calls move.execute, which pushes what it can't undo by itself (castling rights,
+       en passant, killed piece, halfmove clock) on board.state. move.undo pops it
     4) moves have post_exec func to check if after moving the king is under attack
     5) if post_exec the move was succesful else post_exec will undo the move which makes it invalid
+    6) once something evaluated the board, exec updates board.scores too
 """
 
 color_change = {"W": "B", "B": "W"}
 
+# Zobrist keys for Board.position_hash, fixed seed so hashes are stable
+# between processes
+_zobrist_random = random.Random(20140101)
+ZOBRIST_PIECES = {
+    (name, color, square): _zobrist_random.getrandbits(64)
+    for name in ("Pawn", "Knight", "Bishop", "Rook", "Queen", "King")
+    for color in ("W", "B")
+    for square in product(range(0, 8), range(0, 8))}
+ZOBRIST_BLACK_TURN = _zobrist_random.getrandbits(64)
+
+# castling right bit per (color, rook x)
+CASTLING_BITS = {("W", 0): 1, ("W", 7): 2, ("B", 0): 4, ("B", 7): 8}
+ALL_CASTLING = 15
+
+# legal moves per position_key, shared by all the games of the process
+MOVE_CACHE_SIZE = 20000
+move_cache = LRUCache(MOVE_CACHE_SIZE)
+registry.gauge("engine.move_cache", move_cache.stats)
+
 
 class Math:
     @staticmethod
@@ -103,22 +126,24 @@ class Math:
         """
             Wraps piece.find
             It makes sure:
-            1) A cache is maintained
+            1) A cache is maintained, one per piece type shared by all pieces
             2) The found moves are in board range (0,0) -> (7,7)
             3) The start point is not included in the possible moves
         @return: All logically possible moves cleaned (ignoring board state)
         """
+        cache = {}
 
         @wraps(f)
         def wrapper(self, *args, **kwargs):
             x, y = args
             # all-ready calculated, exists in cache
-            if (x, y) in self.find_cache:
-                return self.find_cache[(x, y)]
+            if (x, y) in cache:
+                return cache[(x, y)]
 
             moves = f(self, *args, **kwargs)
-            moves = {move for move in moves if Math.check_range(move)} - {args}
-            self.find_cache[(x, y)] = moves
+            moves = frozenset(
+                move for move in moves if Math.check_range(move)) - {args}
+            cache[(x, y)] = moves
             return moves
 
         return wrapper
@@ -145,11 +170,12 @@ class Math:
             # start 3,3 end 5,5 -> 2,2 is not bigger than start 6,6 is not bigger
             # than end
             start_check = lambda _move: Math.diff_points(start, _move) == diff
-            end_check = Math.end_point_check(diff[1])
+            end_check_x = Math.end_point_check(diff[0])
+            end_check_y = Math.end_point_check(diff[1])
             moves = {
                 move for move in moves
-                if in_line(*move) and
-                   start_check(move) and end_check(move[1], end[1])}
+                if in_line(*move) and start_check(move) and
+                   end_check_x(move[0], end[0]) and end_check_y(move[1], end[1])}
             return moves
 
         return wrapper
@@ -192,7 +218,7 @@ def requires_turn(turn_position):
         def wrapper(*args, **kwargs):
             turn = args[0].board.turn
             player = args[turn_position]
-            if player is not turn:
+            if player != turn:
                 msg = "Its not your turn. Given %s expected %s" % (player, turn)
                 raise Exception(msg)
             return f(*args, **kwargs)
@@ -214,6 +240,11 @@ class GameEngine:
         """
         self.board = board
         self.players = {}
+        # game.clock.Clock of timed games
+        self.clock = None
+        # "1-0", "0-1" or "1/2-1/2" once the game is over
+        self.result = None
+        self.reason = None
 
     def join_game(self, player, color=None):
         player_size = len(self.players.keys())
@@ -228,15 +259,45 @@ class GameEngine:
 
         self.players[color] = player
 
+    def finish(self, result: str, reason: str):
+        """
+            End the game for a reason the board doesn't know about
+            (time, resignation)
+        """
+        self.result, self.reason = result, reason
+
+    def outcome(self) -> tuple:
+        """
+            (result, reason) if the game is over else None
+        """
+        if self.result is not None:
+            return self.result, self.reason
+        if self.board.halfmove_clock >= 100:
+            return "1/2-1/2", "fifty moves"
+        if self._cached_legal_moves():
+            return None
+        if not GameEngine.king_attacked(self.board):
+            return "1/2-1/2", "stalemate"
+        return ("0-1" if self.board.turn == "W" else "1-0"), "checkmate"
+
+    def history(self) -> list:
+        """
+            Moves played so far as (start, end, promotion), the same tuples
+            legal_moves gives
+        """
+        moves = []
+        for move in self.board.moves:
+            if isinstance(move, CastlingMove):
+                moves.append((move.king_start, move.king_end, None))
+            else:
+                moves.append((move.start, move.end,
+                              getattr(move, "promotion", None)))
+        return moves
 
     @staticmethod
     def square_attacked(end: tuple, board):
-        opposite_pieces = board.opposite_pieces()
-        opposite_attackers = [
-            piece.check_move(end, board) for piece in opposite_pieces
-            if not isinstance(piece, King)
-        ]
-        return len([move for move in opposite_attackers if move]) >= 1
+        return any(piece.attacks(end, board)
+                   for piece in board.opposite_pieces())
 
     @staticmethod
     def king_attacked(board):
@@ -244,30 +305,81 @@ class GameEngine:
         king = board.get_king(board.turn)
         return GameEngine.square_attacked(king.position, board)
 
+    @timed("engine.possible_moves")
     def possible_moves(self, json=False):
-        # TODO refacator
-        # At the moment its "brute forced"
-        # Better performance would be to filter the squares processed
-        # Best way would be to cache all "logical"
-        # moves and save it in key value store
-        our_pieces = self.board.our_pieces()
-        possible = self.board.all_possible_positions(our_pieces=our_pieces)
+        """
+            All legal moves of the player to move as {start: [end, ...]}.
+            Positions already seen by any game of the process come from
+            move_cache
+        @param json: Use str(start) as keys
+        """
         _possible_moves = defaultdict(list)
-        for start in our_pieces:
-            for end in possible:
-                valid = self._check_move(start.position, end, self.board.turn)
-                if valid:
-                    key = str(start.position) if json else start.position
-                    _possible_moves[key].append(end)
+        for start, ends in self._cached_legal_moves():
+            key = str(start) if json else start
+            _possible_moves[key].extend(ends)
         return _possible_moves
 
+    def legal_moves(self) -> list:
+        """
+            Legal moves of the player to move as (start, end, promotion).
+            A pawn reaching the last row gives one move per promotion piece,
+            promotion is None for every other move
+        """
+        moves = []
+        for start, ends in self._cached_legal_moves():
+            pawn = isinstance(self.board[start], Pawn)
+            for end in ends:
+                if pawn and end[1] in (0, 7):
+                    moves.extend((start, end, i) for i in PROMOTIONS)
+                else:
+                    moves.append((start, end, None))
+        return moves
+
+    def _cached_legal_moves(self) -> tuple:
+        position_key = self.board.position_key()
+        legal = move_cache.get(position_key)
+        if legal is None:
+            legal = self._legal_moves()
+            move_cache.put(position_key, legal)
+        return legal
+
+    def _legal_moves(self) -> tuple:
+        """
+            ((start, (end, ...)), ...) immutable so it can be cached.
+            Only the candidates of every piece are tried. Sorted, the
+            pieces and their candidates come out of sets and the searches
+            must not depend on the hash seed
+        """
+        turn = self.board.turn
+        legal = []
+        for piece in self.board.our_pieces():
+            start = piece.position
+            ends = tuple(sorted(
+                end for end in piece.candidates(self.board)
+                if (self.board[end] is None or self.board[end].color is not turn)
+                and self._check_move(start, end, turn)))
+            if ends:
+                legal.append((start, ends))
+        return tuple(sorted(legal))
+
     def _check_move(self, start: tuple, end: tuple, player: str):
         moved = self.move(start, end, player)
         if moved:
-            self.undo()
+            self.unmake()
             return True
         return False
 
+    def unmake(self):
+        """
+            Take the last move back without keeping it in undone_moves.
+            Used by the legality checks and the search
+        @return: the move taken back
+        """
+        move = self.board.moves.pop()
+        move.undo(self.board)
+        self.board.flip_color()
+        return move
+
     def _move(self, move):
         """
             Executes the move as returned by piece.get_move
@@ -285,13 +397,14 @@ class GameEngine:
         return False
 
     @requires_turn(3)
-    def move(self, start: tuple, end: tuple, player: str):
+    def move(self, start: tuple, end: tuple, player: str, promotion: str=None):
         """
             Moves the pieces on the board, just give the points.
             The module docstring explains the whole flow
         @param start: tuple start point (x,y)
         @param end: tuple end point (x,y)
         @param player: str player color
+        @param promotion: Q, R, B or N when a pawn reaches the last row, Q if not given
         @return: True if moved else False @raise Exception: When is not the players turn
         """
         piece = self.board[start]
@@ -300,6 +413,10 @@ class GameEngine:
         move = piece.get_move(end, self.board)
         if not move:
             return False
+        if promotion and isinstance(move, PromotionMove):
+            if promotion not in PROMOTIONS:
+                return False
+            move.promotion = promotion
         return self._move(move)
 
     def undo(self, move=None):
@@ -340,13 +457,16 @@ class AbstractMove:
 
 
 class Piece(object):
+    """
+        Pieces only know their color and square. Everything else a move
+        depends on (castling rights, en passant) is kept by the Board
+    """
     __metaclass__ = ABCMeta
+    __slots__ = ("color", "position")
 
     def __init__(self, color: str, position: tuple):
         self.color = color
         self.position = position
-        self.find_cache = {}
-        self.moved = 0
 
     def __eq__(self, other) -> bool:
         if not other or not isinstance(other, self.__class__):
@@ -375,6 +495,22 @@ class Piece(object):
         """
         pass
 
+    def candidates(self, board) -> set:
+        """
+            Squares the piece may move to, a superset of the legal moves
+        @param board: Board
+        """
+        return self.find(*self.position)
+
+    def attacks(self, end: tuple, board) -> bool:
+        """
+            Check if the piece could kill a piece on end
+        @param end: tuple square
+        @param board: Board
+        """
+        return end in self.find(*self.position) and \
+            bool(self.check_move(end, board))
+
     def get_move(self, end: tuple, board) -> AbstractMove:
         """
             Get the a Move object if the move was legal
@@ -386,28 +522,19 @@ class Piece(object):
             return Move(self, end)
         return False
 
-    def increase_moves(self):
-        """
-            Increase the times a piece moved.
-            Needed for castling and potentially statistics in AI
-        """
-        self.moved += 1
-
-    def decrease_moves(self):
-        """
-            Decrease moves when undoing moves.
-            Needed for castling and potentially statistics in AI
-        """
-        self.moved -= 1
-
     def update_position(self, position):
         """
             Updates the piece's position after every move.
-            Queen has a special implementation
         @param position:
         """
         self.position = position
 
+    def copy(self):
+        piece = object.__new__(self.__class__)
+        piece.color = self.color
+        piece.position = self.position
+        return piece
+
     # def __repr__(self):
     #     return "%s %s" % (self.color, type(self).__name__,)
 
@@ -422,10 +549,12 @@ class Piece(object):
 
 class Move(AbstractMove):
     def __init__(self, piece: Piece, end: tuple):
-        self.piece = deepcopy(piece)
+        self.piece = piece
         self.start = piece.position
         self.end = end
         self.killed = None
+        # where the killed piece stands, differs from end for en passant
+        self.killed_at = end
 
     def __hash__(self):
         return hash(" ".join(map(
@@ -441,21 +570,25 @@ class Move(AbstractMove):
             self.piece, self.start, self.killed)
 
     def exec(self, board):
-        board[self.piece.position] = None  # remove the piece from the board
-        self.piece.update_position(self.end)  # move the piece
-        if board[self.end]:  # kill previous piece if existed
-            self.killed = board[self.end]
+        self.killed = board[self.killed_at]
+        board.push_state(self.killed)
+        board[self.start] = None  # remove the piece from the board
+        if self.killed:  # kill previous piece if existed
+            board[self.killed_at] = None
             board.killed.append(self.killed)
+        board.update_scores(self.piece, self.start, self.end, self.killed)
+        self.piece.update_position(self.end)  # move the piece
         board[self.end] = self.piece  # make the move on the board
-        self.piece.increase_moves()
+        board.update_state(self.piece, self.start, self.end, self.killed)
 
     def undo(self, board):
+        killed = board.pop_state()
+        board[self.end] = None
         board[self.start] = self.piece
         self.piece.update_position(self.start)
-        board[self.end] = self.killed
-        if board.killed:
-            del board.killed[-1]
-            # self.piece.decrease_moves()
+        if killed:
+            board[self.killed_at] = killed
+            board.killed.pop()
 
     def post_exec(self, board):
         if GameEngine.king_attacked(board):
@@ -464,38 +597,64 @@ class Move(AbstractMove):
             return True
 
 
+class PromotionMove(Move):
+    def __init__(self, piece: Piece, end: tuple, promotion: str="Q"):
+        """
+            A pawn reaching the last row, replaced by the promotion piece
+        @param promotion: Q, R, B or N
+        """
+        super(PromotionMove, self).__init__(piece, end)
+        self.promotion = promotion
+
+    def exec(self, board):
+        super(PromotionMove, self).exec(board)
+        board[self.end] = PROMOTIONS[self.promotion](self.piece.color, self.end)
+        board.promote_scores(self.piece, board[self.end])
+
+
+class EnPassantMove(Move):
+    def __init__(self, piece: Piece, end: tuple):
+        """
+            A pawn killing the pawn that just passed next to it
+        """
+        super(EnPassantMove, self).__init__(piece, end)
+        self.killed_at = (end[0], self.start[1])
+
+
 class CastlingMove(AbstractMove):
-    def __init__(self, castling):
+    def __init__(self, castling, king):
         """
             Castling is a special moves and needs to be implemented separate
             because its the only case two pieces move at once
         @param castling: Castling
+        @param king: King
         """
-        self.king = deepcopy(castling.king)
+        self.king = king
         self.rook_start = castling.rook_start
-        self.king_start = deepcopy(self.king.position)
+        self.king_start = castling.king_start
         self.squares = castling.squares
         self.king_end = castling.king_end
         self.rook_end = castling.rook_end
         self.rook = None
-        #self.rook_x = 3 if self.king_end == 2 else 5
 
     def exec(self, board):
-        self.rook = deepcopy(board[self.rook_start])
+        self.rook = board[self.rook_start]
+        board.push_state(None)
 
-        board[self.rook.position] = None
-        board[self.king.position] = None
+        board[self.rook_start] = None
+        board[self.king_start] = None
 
         board[self.rook_end] = self.rook
         board[self.king_end] = self.king
 
+        board.update_scores(self.king, self.king_start, self.king_end)
+        board.update_scores(self.rook, self.rook_start, self.rook_end)
         self.rook.update_position(self.rook_end)
         self.king.update_position(self.king_end)
-
-        self.king.increase_moves()
-        self.rook.increase_moves()
+        board.update_state(self.king, self.king_start, self.king_end, None)
 
     def undo(self, board):
+        board.pop_state()
         board[self.king_end] = None
         board[self.rook_end] = None
 
@@ -510,6 +669,8 @@ class CastlingMove(AbstractMove):
 
 
 class Rook(Piece):
+    __slots__ = ()
+
     @Math.clean_moves
     def find(self, x: int, y: int, board=None):
         return {
@@ -522,6 +683,8 @@ class Rook(Piece):
 
 
 class Bishop(Piece):
+    __slots__ = ()
+
     @Math.clean_moves
     def find(self, x: int, y: int, board=None):
         possible = lambda k: [
@@ -535,6 +698,8 @@ class Bishop(Piece):
 
 
 class Knight(Piece):
+    __slots__ = ()
+
     @Math.clean_moves
     def find(self, x: int, y: int, board=None):
         moves = chain(product([x - 1, x + 1], [y - 2, y + 2]),
@@ -551,54 +716,47 @@ class Knight(Piece):
 
 
 class Pawn(Piece):
+    __slots__ = ("y_initial", "y_add")
+
     def __init__(self, color: str, position: tuple, player_down: str):
         super(Pawn, self).__init__(color, position)
         self.y_initial, self.y_add = \
             (6, -1) if self.color is player_down else (1, 1)
 
+    def copy(self):
+        piece = super(Pawn, self).copy()
+        piece.y_initial, piece.y_add = self.y_initial, self.y_add
+        return piece
+
     #@Math.clean_moves
     def find(self, x: int, y: int, board=None) -> set:
-        # TODO test kill moves, add en passant and --cache--
+        # TODO --cache--
         non_kill = self._find_non_kill_moves(x, y, board=board)
         kill = self._kill_moves(x, y, board=board)
         en_passant_moves = self._en_passant(x, y, board)
         return set(chain(kill, non_kill, en_passant_moves))
 
-    def _get_kill_pieces(self, x: int, y: int, board, _operator):
-        """
-            Gets all that could be killed.
-            Used in _en_pasant and _kill_moves
-            for normal kill moves x,y+self.y_add
-            for en_passant moves x,y-self,y_add
-        @return: All possible pieces to be killed
-        """
-        x1, x2 = x - 1, x + 1
-        new_y = _operator(y, self.y_add)
-        positions = [(x1, new_y), (x2, new_y)]
-        pieces = [board[i] for i in positions if Math.check_range(i)]
-        return set(filter(
-            lambda piece: piece and piece.color is not self.color, pieces))
-
-    def _en_passant(self, x: int, y: int, board):
-        # not moves yet en passant is impossible
-        if not board.moves:
-            return {}
-        last_move_piece = board.moves[-1].piece
-        # en passant requires last move to be opponents pawn
-        _all = [last_move_piece,
-                isinstance(last_move_piece, Pawn),
-                last_move_piece.color is color_change[self.color]]
-
-        if not all(_all):
-            return {}
-            # Check if end is in all "killable" en-passant pieces
-        pieces = self._get_kill_pieces(x, y, board, operator.sub)
-        if (x, y) in [piece.position for piece in pieces]:
-            return {(x, y)}
-        return {}
-
-    def _kill_moves(self, x: int, y: int, board):
-        return self._get_kill_pieces(x, y, board, operator.add)
+    def _en_passant(self, x: int, y: int, board) -> set:
+        """
+            The square behind the opponent's pawn that just moved two squares
+            next to this one
+        """
+        passed_x = board.en_passant
+        if passed_x is None or abs(passed_x - x) != 1:
+            return set()
+        # only from the row the passing pawn lands on
+        if y != self.y_initial + 3 * self.y_add:
+            return set()
+        passed = board[passed_x, y]
+        if not isinstance(passed, Pawn) or passed.color is self.color:
+            return set()
+        return {(passed_x, y + self.y_add)}
+
+    def _kill_moves(self, x: int, y: int, board) -> set:
+        new_y = y + self.y_add
+        positions = [(x - 1, new_y), (x + 1, new_y)]
+        return {i for i in positions if Math.check_range(i) and
+                board[i] is not None and board[i].color is not self.color}
 
     def _find_non_kill_moves(self, x: int, y: int, board) -> set:
         """
@@ -609,7 +767,7 @@ class Pawn(Piece):
         non_kill_moves = set()
         move_a = (x, y + self.y_add)
         # just check if the square is empty
-        if board[move_a] is None:
+        if Math.check_range(move_a) and board[move_a] is None:
             non_kill_moves.add(move_a)
             # check that two squares are empty
         if y is self.y_initial:
@@ -626,61 +784,105 @@ class Pawn(Piece):
             return moves
         return False
 
+    def candidates(self, board) -> set:
+        return self.find(*self.position, board=board)
+
+    def attacks(self, end: tuple, board) -> bool:
+        """
+            Pawns only attack diagonally forward, moving forward never kills
+        """
+        x, y = self.position
+        return end[1] == y + self.y_add and abs(end[0] - x) == 1
+
+    def get_move(self, end: tuple, board) -> AbstractMove:
+        if not self.check_move(end, board):
+            return False
+        if end[1] in (0, 7):
+            return PromotionMove(self, end)
+        # moving sideways to an empty square
+        if end[0] != self.position[0] and board[end] is None:
+            return EnPassantMove(self, end)
+        return Move(self, end)
+
 
 class Castling:
-    def __init__(self, y: int, start: int, end: int, king: Piece):
+    def __init__(self, y: int, start: int, end: int, color: str):
+        # squares between king and rook, they must be empty
         self.squares = [(x, y) for x in range(start, end)]
         rook_start_x = 0 if start == 1 else 7
-        self.rook_start = (rook_start_x, king.position[1])
-        self.king = king
+        self.rook_start = (rook_start_x, y)
+        self.color = color
+        self.king_start = (4, y)
         king_end_x = 2 if start == 1 else 6
         rook_end_x = 3 if start == 1 else 5
-        self.king_end = (king_end_x, king.position[1])
-        self.rook_end = (rook_end_x, king.position[1])
+        self.king_end = (king_end_x, y)
+        self.rook_end = (rook_end_x, y)
+        # squares the king passes, they must not be attacked
+        self.king_path = [(rook_end_x, y), (king_end_x, y)]
+        self.right = CASTLING_BITS[color, rook_start_x]
 
     def is_valid(self, board):
-        if GameEngine.king_attacked(board):
+        # king or rook moved or the rook was killed
+        if not board.castling & self.right:
             return False
-            # check if castling is blocked
+        king, rook = board[self.king_start], board[self.rook_start]
+        if not isinstance(king, King) or king.color is not self.color or \
+                not isinstance(rook, Rook) or rook.color is not self.color:
+            return False
+        # check if castling is blocked
         for square in self.squares:
-            if board[square] is not None or \
-                    GameEngine.square_attacked(square, board):
+            if board[square] is not None:
                 return False
-                # check if pieces have been moved previously
-        if not (board[self.rook_start].moved is 0 or self.king.moved is 0):
+        if GameEngine.king_attacked(board):
             return False
-
+        for square in self.king_path:
+            if GameEngine.square_attacked(square, board):
+                return False
         return self
 
 
 class King(Piece):
-    def __init__(self, color: str, position: tuple):
-        super(King, self).__init__(color, position)
-        y = self.position[1]
-        self.castling = {((4, y), (2, y)): Castling(y, 1, 4, self),
-                         ((4, y), (6, y)): Castling(y, 5, 7, self)}
+    __slots__ = ()
+    # {(color, y): {(king start, king end): Castling}} shared by all kings
+    _castling = {}
+
+    def castling(self, board) -> dict:
+        """
+            Both castling of the king's color, the back rank depends on
+            board.player_down
+        """
+        y = 7 if self.color == board.player_down else 0
+        key = (self.color, y)
+        if key not in King._castling:
+            King._castling[key] = {
+                ((4, y), (2, y)): Castling(y, 1, 4, self.color),
+                ((4, y), (6, y)): Castling(y, 5, 7, self.color)}
+        return King._castling[key]
 
     def _is_castling(self, end: tuple, board):
         possible_castling = (self.position, end)
+        castling = self.castling(board)
         # Not logically a castling move
-        if not possible_castling in self.castling:
+        if not possible_castling in castling:
             return False
             # A castling move that may actually be invalid
-        castling = self.castling[possible_castling]
-        return castling.is_valid(board)
+        return castling[possible_castling].is_valid(board)
 
     def get_castling_moves(self, board) -> set:
-        moves = set()
-        for positions in self.castling.keys():
-            self._is_castling(positions[1], board)
-            moves.add(positions[1])
-        return moves
+        return {positions[1] for positions in self.castling(board).keys()
+                if self._is_castling(positions[1], board)}
+
+    def candidates(self, board) -> set:
+        castling = {end for start, end in self.castling(board)
+                    if start == self.position}
+        return self.find(*self.position) | castling
+
+    def attacks(self, end: tuple, board) -> bool:
+        return end in self.find(*self.position)
 
     @Math.clean_moves
     def find(self, x: int, y: int, board=None):
-        normal_moves = set(product([x - 1, x + 1, x], [y + 1, y - 1, y]))
-        castling_moves = self.get_castling_moves(board)
-        return normal_moves.union(castling_moves)
+        return set(product([x - 1, x + 1, x], [y + 1, y - 1, y]))
 
     @Math.check_blocks
     def check_move(self, end: tuple, board):
@@ -691,31 +893,51 @@ class King(Piece):
         if not castling:
             return super(King, self).get_move(end, board)
         else:
-            return CastlingMove(castling)
+            return CastlingMove(castling, self)
 
 
 class Queen(Piece):
-    def __init__(self, color: str, position: tuple):
-        super(Queen, self).__init__(color, position)
-        self._rook = Rook(color, position)
-        self._bishop = Bishop(color, position)
-
-    def update_position(self, position):
-        self.position = position
-        self._rook.position = position
-        self._bishop.position = position
+    __slots__ = ()
 
+    @Math.clean_moves
     def find(self, x: int, y: int, board=None):
-        return self._bishop.find(x, y).union(self._rook.find(x, y))
+        return Bishop.find(self, x, y).union(Rook.find(self, x, y))
 
+    # the line to end is either a rook or a bishop line
+    @Math.check_blocks
+    @Math.filter_line
     def check_move(self, end: tuple, board):
-        bishop_moves = self._bishop.check_move(end, board)
-        if bishop_moves:
-            return bishop_moves
-        rook_moves = self._rook.check_move(end, board)
-        if rook_moves:
-            return rook_moves
-        return False
+        return self.find(*self.position)
+
+
+# pieces a pawn can be promoted to
+PROMOTIONS = OrderedDict([("Q", Queen), ("R", Rook), ("B", Bishop),
+                          ("N", Knight)])
+PIECE_CLASSES = {"P": Pawn, "N": Knight, "B": Bishop, "R": Rook, "Q": Queen,
+                 "K": King}
+FILES = "abcdefgh"
+# row by row, the order Board iterates the squares in
+EMPTY_SQUARES = tuple((square, None) for square in sorted(
+    product(range(0, 8), range(0, 8)), key=lambda i: (i[1], i[0])))
+# starting positions by player_down, see Board.start_position
+_start_boards = {}
+
+
+def square_name(position: tuple, player_down: str="W") -> str:
+    """
+        (4, 6) -> "e2" for a board with white down
+    """
+    x, y = position
+    rank = 8 - y if player_down == "W" else y + 1
+    return "%s%i" % (FILES[x], rank)
+
+
+def parse_square(name: str, player_down: str="W") -> tuple:
+    """
+        "e2" -> (4, 6) for a board with white down
+    """
+    x, rank = FILES.index(name[0]), int(name[1])
+    return x, 8 - rank if player_down == "W" else rank - 1
 
 
 class Board(OrderedDict):
@@ -730,9 +952,17 @@ class Board(OrderedDict):
         self.moves = []
         self.undone_moves = []
         self.turn = "W"
-        board = {i: None for i in product(range(0, 8), range(0, 8))}
-        self.update(sorted(
-            board.items(), key=lambda x: x[0][0] + ((1 + x[0][1]) * 100)))
+        # plies played before self.moves, for positions set up from a FEN
+        self.start_ply = 0
+        # irreversible state, one tuple per move in self.state
+        self.castling = ALL_CASTLING
+        self.en_passant = None
+        self.halfmove_clock = 0
+        self.state = []
+        self.castling_masks = self._castling_masks()
+        # evaluation.board_scores once evaluated, see evaluation.tapered
+        self.scores = None
+        self.update(EMPTY_SQUARES)
         if create:
             self.create()
 
@@ -745,6 +975,214 @@ class Board(OrderedDict):
                    and self.player_down == other.player_down \
             and self.turn == other.turn
 
+    def copy(self):
+        """
+            Same position with copied pieces, for analysis.
+            The move history isn't copied so moves made before can't be undone
+        """
+        board = Board.__new__(Board)
+        OrderedDict.__init__(board, [
+            (position, piece.copy() if piece else None)
+            for position, piece in self.items()])
+        board.player_down = self.player_down
+        board.killed = list(self.killed)
+        board.moves = []
+        board.undone_moves = []
+        board.turn = self.turn
+        board.start_ply = self.start_ply + len(self.moves)
+        board.castling = self.castling
+        board.en_passant = self.en_passant
+        board.halfmove_clock = self.halfmove_clock
+        board.state = []
+        board.castling_masks = self.castling_masks
+        board.scores = self.scores
+        return board
+
+    @classmethod
+    def start_position(cls, player_down: str="W"):
+        """
+            New board with the pieces in place, copied from a prototype
+            built once per player_down. The prototype is never handed out
+        """
+        prototype = _start_boards.get(player_down)
+        if prototype is None:
+            prototype = _start_boards[player_down] = \
+                cls(player_down=player_down, create=True)
+        return prototype.copy()
+
+    @classmethod
+    def from_fen(cls, fen: str, player_down: str="W"):
+        """
+            Board for a FEN string. Files are not mirrored when black is down,
+            the rows are
+        """
+        fields = fen.split()
+        board = cls(player_down=player_down)
+        for i, row in enumerate(fields[0].split("/")):
+            y = i if player_down == "W" else 7 - i
+            x = 0
+            for char in row:
+                if char.isdigit():
+                    x += int(char)
+                    continue
+                color = "W" if char.isupper() else "B"
+                piece_class = PIECE_CLASSES[char.upper()]
+                if piece_class is Pawn:
+                    board[x, y] = Pawn(color, (x, y), player_down)
+                else:
+                    board[x, y] = piece_class(color, (x, y))
+                x += 1
+        board.turn = "W" if fields[1] == "w" else "B"
+        board.castling = 0
+        for char in fields[2] if fields[2] != "-" else "":
+            color = "W" if char.isupper() else "B"
+            board.castling |= CASTLING_BITS[color, 7 if char in "Kk" else 0]
+        board.en_passant = FILES.index(fields[3][0]) \
+            if fields[3] != "-" else None
+        board.halfmove_clock = int(fields[4]) if len(fields) > 4 else 0
+        fullmove = int(fields[5]) if len(fields) > 5 else 1
+        board.start_ply = 2 * (fullmove - 1) + (board.turn == "B")
+        return board
+
+    def fen(self) -> str:
+        """
+            Forsyth-Edwards notation of the position
+        """
+        rows = []
+        for i in range(0, 8):
+            y = i if self.player_down == "W" else 7 - i
+            row, empty = [], 0
+            for x in range(0, 8):
+                piece = self[x, y]
+                if piece is None:
+                    empty += 1
+                    continue
+                if empty:
+                    row.append(str(empty))
+                    empty = 0
+                letter = repr(piece)[1].upper()
+                row.append(letter if piece.color == "W" else letter.lower())
+            if empty:
+                row.append(str(empty))
+            rows.append("".join(row))
+        castling = "".join(
+            char for char, bit in (("K", 2), ("Q", 1), ("k", 8), ("q", 4))
+            if self.castling & bit) or "-"
+        en_passant = "-"
+        if self.en_passant is not None:
+            rank = 6 if self.turn == "W" else 3
+            en_passant = "%s%i" % (FILES[self.en_passant], rank)
+        return " ".join([
+            "/".join(rows), self.turn.lower(), castling, en_passant,
+            str(self.halfmove_clock),
+            str(1 + (self.start_ply + len(self.moves)) // 2)])
+
+    def position_hash(self) -> int:
+        """
+            Zobrist hash of the pieces and the player to move
+        """
+        _hash = ZOBRIST_BLACK_TURN if self.turn == "B" else 0
+        for position, piece in self.items():
+            if piece:
+                _hash ^= ZOBRIST_PIECES[
+                    piece.__class__.__name__, piece.color, position]
+        return _hash
+
+    def position_key(self) -> tuple:
+        """
+            Everything the legal moves depend on
+        """
+        return (self.position_hash(), self.castling, self.en_passant,
+                self.player_down)
+
+    def _castling_masks(self) -> dict:
+        """
+            Rights kept when a piece leaves or arrives on a square.
+            Moving the king or a rook, or killing a rook, loses the right
+        """
+        masks = {}
+        for color in ("W", "B"):
+            y = 7 if color == self.player_down else 0
+            long, short = CASTLING_BITS[color, 0], CASTLING_BITS[color, 7]
+            masks[4, y] = ALL_CASTLING & ~(long | short)
+            masks[0, y] = ALL_CASTLING & ~long
+            masks[7, y] = ALL_CASTLING & ~short
+        return masks
+
+    def push_state(self, killed):
+        """
+            Save what a move can't restore by itself, called by move.exec
+        """
+        self.state.append((self.castling, self.en_passant, killed,
+                           self.halfmove_clock, self.scores))
+
+    def pop_state(self):
+        """
+            Restore the state before the last move, called by move.undo
+        @return: the killed piece of the move
+        """
+        self.castling, self.en_passant, killed, self.halfmove_clock, \
+            self.scores = self.state.pop()
+        return killed
+
+    def update_scores(self, piece, start: tuple, end: tuple, killed=None):
+        """
+            Evaluation scores after piece moved from start to end, called by
+            move.exec before the piece's position changes
+        """
+        if self.scores is None:
+            return
+        mg, eg, phase, pawns = self.scores
+        table = SQUARE_SCORES[self.player_down]
+        name, color = piece.__class__.__name__, piece.color
+        start_mg, start_eg = table[name, color, start]
+        end_mg, end_eg = table[name, color, end]
+        mg += end_mg - start_mg
+        eg += end_eg - start_eg
+        if name == "Pawn":
+            pawns ^= PAWN_KEYS[color, start] ^ PAWN_KEYS[color, end]
+        if killed:
+            name = killed.__class__.__name__
+            killed_mg, killed_eg = table[name, killed.color, killed.position]
+            mg -= killed_mg
+            eg -= killed_eg
+            phase -= PHASE[PIECE_NAMES[name]]
+            if name == "Pawn":
+                pawns ^= PAWN_KEYS[killed.color, killed.position]
+        self.scores = mg, eg, phase, pawns
+
+    def promote_scores(self, pawn, piece):
+        """
+            Evaluation scores after the pawn on piece's square was replaced
+        """
+        if self.scores is None:
+            return
+        mg, eg, phase, pawns = self.scores
+        table = SQUARE_SCORES[self.player_down]
+        pawn_mg, pawn_eg = table["Pawn", pawn.color, piece.position]
+        piece_mg, piece_eg = table[
+            piece.__class__.__name__, piece.color, piece.position]
+        self.scores = (
+            mg + piece_mg - pawn_mg, eg + piece_eg - pawn_eg,
+            phase + PHASE[PIECE_NAMES[piece.__class__.__name__]],
+            pawns ^ PAWN_KEYS[pawn.color, piece.position])
+
+    def update_state(self, piece, start: tuple, end: tuple, killed):
+        """
+            Castling rights, en passant file and halfmove clock after a move
+        """
+        masks = self.castling_masks
+        if start in masks or end in masks:
+            self.castling &= masks.get(start, ALL_CASTLING) & \
+                masks.get(end, ALL_CASTLING)
+        is_pawn = isinstance(piece, Pawn)
+        self.en_passant = start[0] \
+            if is_pawn and abs(start[1] - end[1]) == 2 else None
+        if is_pawn or killed:
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+
     def json_dict(self):
         _repr = lambda x: repr(x) if x else x
         return {"values": [_repr(i) for i in self.values()]}
@@ -829,7 +1267,7 @@ class Board(OrderedDict):
 
 
 def make_game_engine(player_down: str="W") -> GameEngine:
-    board = Board(player_down=player_down, create=True)
+    board = Board.start_position(player_down)
     game_engine = GameEngine(board)
     return game_engine
 
@@ -0,0 +1,86 @@
+"""
+Chess clock of one game. Times are seconds from time.monotonic.
+
+    clock = Clock(300, increment=2)
+    clock.start()
+    clock.press()          # after every move, False if the player flagged
+
+The increment is added after every move. The delay is a grace period at the
+start of every move before the player's time starts running.
+"""
+import time
+
+color_change = {"W": "B", "B": "W"}
+
+
+def parse_time_control(time_control: str) -> tuple:
+    """
+        "300+2" -> (300.0, 2.0), "300" -> (300.0, 0.0)
+    """
+    initial, _, increment = time_control.partition("+")
+    return float(initial), float(increment or 0)
+
+
+class Clock:
+    def __init__(self, initial: float, increment: float=0.0, delay: float=0.0,
+                 turn: str="W"):
+        self.initial = initial
+        self.increment = increment
+        self.delay = delay
+        self.remaining = {"W": float(initial), "B": float(initial)}
+        self.turn = turn
+        self.started = None
+        # color that ran out of time
+        self.flagged = None
+
+    def start(self, now: float=None):
+        self.started = time.monotonic() if now is None else now
+
+    def _used(self, now: float) -> float:
+        if self.started is None:
+            return 0.0
+        return max(0.0, now - self.started - self.delay)
+
+    def time_left(self, color: str, now: float=None) -> float:
+        now = time.monotonic() if now is None else now
+        if color != self.turn:
+            return self.remaining[color]
+        return max(0.0, self.remaining[color] - self._used(now))
+
+    def deadline(self) -> float:
+        """
+            When the player to move runs out of time, None before start
+        """
+        if self.started is None:
+            return None
+        return self.started + self.delay + self.remaining[self.turn]
+
+    def expired(self, now: float=None) -> bool:
+        now = time.monotonic() if now is None else now
+        return self.flagged is not None or \
+            (self.started is not None and now >= self.deadline())
+
+    def flag(self):
+        self.flagged = self.turn
+
+    def press(self, now: float=None) -> bool:
+        """
+            The player to move moved, start the opponent's time
+        @return: False if the player ran out of time before moving
+        """
+        now = time.monotonic() if now is None else now
+        if self.expired(now):
+            self.flag()
+            return False
+        self.remaining[self.turn] -= self._used(now)
+        self.remaining[self.turn] += self.increment
+        self.turn = color_change[self.turn]
+        self.started = now
+        return True
+
+    def json_dict(self, now: float=None) -> dict:
+        now = time.monotonic() if now is None else now
+        return {"W": self.time_left("W", now),
+                "B": self.time_left("B", now),
+                "turn": self.turn,
+                "flagged": self.flagged}
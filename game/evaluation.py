@@ -0,0 +1,250 @@
+"""
+Static evaluation terms shared by the evaluators.
+Scores are centipawns from white's point of view.
+
+Piece square tables are written from white's side: row 0 is the far side of
+the board (where white pawns promote), row 7 is white's back rank. Boards with
+player_down "B" are mirrored before looking squares up.
+
+evaluate walks the squares. tapered is the search's evaluation: material and
+piece square scores are kept apart for the midgame and the endgame and
+blended by the material left (the phase). Board.scores holds both sums, the
+phase and a Zobrist hash of the pawns; moves update it in place and
+pop_state restores it, so a leaf costs a few lookups. Pawn structure
+(doubled, isolated, passed) is only computed for pawn hashes pawn_cache
+hasn't seen.
+"""
+from itertools import product
+import random
+from game.cache import LRUCache
+from metrics import registry
+
+PIECE_VALUES = {"P": 100, "N": 320, "B": 330, "R": 500, "Q": 900, "K": 0}
+
+PIECE_SQUARE = {
+    "P": [[0, 0, 0, 0, 0, 0, 0, 0],
+          [50, 50, 50, 50, 50, 50, 50, 50],
+          [10, 10, 20, 30, 30, 20, 10, 10],
+          [5, 5, 10, 25, 25, 10, 5, 5],
+          [0, 0, 0, 20, 20, 0, 0, 0],
+          [5, -5, -10, 0, 0, -10, -5, 5],
+          [5, 10, 10, -20, -20, 10, 10, 5],
+          [0, 0, 0, 0, 0, 0, 0, 0]],
+    "N": [[-50, -40, -30, -30, -30, -30, -40, -50],
+          [-40, -20, 0, 0, 0, 0, -20, -40],
+          [-30, 0, 10, 15, 15, 10, 0, -30],
+          [-30, 5, 15, 20, 20, 15, 5, -30],
+          [-30, 0, 15, 20, 20, 15, 0, -30],
+          [-30, 5, 10, 15, 15, 10, 5, -30],
+          [-40, -20, 0, 5, 5, 0, -20, -40],
+          [-50, -40, -30, -30, -30, -30, -40, -50]],
+    "B": [[-20, -10, -10, -10, -10, -10, -10, -20],
+          [-10, 0, 0, 0, 0, 0, 0, -10],
+          [-10, 0, 5, 10, 10, 5, 0, -10],
+          [-10, 5, 5, 10, 10, 5, 5, -10],
+          [-10, 0, 10, 10, 10, 10, 0, -10],
+          [-10, 10, 10, 10, 10, 10, 10, -10],
+          [-10, 5, 0, 0, 0, 0, 5, -10],
+          [-20, -10, -10, -10, -10, -10, -10, -20]],
+    "R": [[0, 0, 0, 0, 0, 0, 0, 0],
+          [5, 10, 10, 10, 10, 10, 10, 5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [0, 0, 0, 5, 5, 0, 0, 0]],
+    "Q": [[-20, -10, -10, -5, -5, -10, -10, -20],
+          [-10, 0, 0, 0, 0, 0, 0, -10],
+          [-10, 0, 5, 5, 5, 5, 0, -10],
+          [-5, 0, 5, 5, 5, 5, 0, -5],
+          [0, 0, 5, 5, 5, 5, 0, -5],
+          [-10, 5, 5, 5, 5, 5, 0, -10],
+          [-10, 0, 5, 0, 0, 0, 0, -10],
+          [-20, -10, -10, -5, -5, -10, -10, -20]],
+    "K": [[-30, -40, -40, -50, -50, -40, -40, -30],
+          [-30, -40, -40, -50, -50, -40, -40, -30],
+          [-30, -40, -40, -50, -50, -40, -40, -30],
+          [-30, -40, -40, -50, -50, -40, -40, -30],
+          [-20, -30, -30, -40, -40, -30, -30, -20],
+          [-10, -20, -20, -20, -20, -20, -20, -10],
+          [20, 20, 0, 0, 0, 0, 20, 20],
+          [20, 30, 10, 0, 0, 10, 30, 20]],
+}
+
+ENDGAME_VALUES = {"P": 120, "N": 300, "B": 320, "R": 520, "Q": 920, "K": 0}
+
+# the other pieces use PIECE_SQUARE in the endgame too
+ENDGAME_SQUARE = dict(PIECE_SQUARE, **{
+    "P": [[0, 0, 0, 0, 0, 0, 0, 0],
+          [80, 80, 80, 80, 80, 80, 80, 80],
+          [50, 50, 50, 50, 50, 50, 50, 50],
+          [30, 30, 30, 30, 30, 30, 30, 30],
+          [20, 20, 20, 20, 20, 20, 20, 20],
+          [10, 10, 10, 10, 10, 10, 10, 10],
+          [0, 0, 0, 0, 0, 0, 0, 0],
+          [0, 0, 0, 0, 0, 0, 0, 0]],
+    "K": [[-50, -40, -30, -20, -20, -30, -40, -50],
+          [-30, -20, -10, 0, 0, -10, -20, -30],
+          [-30, -10, 20, 30, 30, 20, -10, -30],
+          [-30, -10, 30, 40, 40, 30, -10, -30],
+          [-30, -10, 30, 40, 40, 30, -10, -30],
+          [-30, -10, 20, 30, 30, 20, -10, -30],
+          [-30, -30, 0, 0, 0, 0, -30, -30],
+          [-50, -30, -30, -30, -30, -30, -30, -50]],
+})
+
+# phase of the material on the board, 24 with all pieces, 0 with pawns only
+PHASE = {"P": 0, "N": 1, "B": 1, "R": 2, "Q": 4, "K": 0}
+MAX_PHASE = 24
+
+# pawn structure (midgame, endgame) per pawn, passed pawns by the rows they
+# advanced from their start
+DOUBLED_PAWN = (-10, -20)
+ISOLATED_PAWN = (-10, -15)
+PASSED_PAWN = [(0, 0), (5, 10), (10, 20), (20, 40), (35, 65), (60, 110)]
+
+# Zobrist keys of the pawns for the pawn hash, fixed seed like the ones of
+# Board.position_hash
+_pawn_random = random.Random(20140102)
+PAWN_KEYS = {(color, square): _pawn_random.getrandbits(64)
+             for color in ("W", "B")
+             for square in product(range(0, 8), range(0, 8))}
+
+PAWN_CACHE_SIZE = 20000
+pawn_cache = LRUCache(PAWN_CACHE_SIZE)
+registry.gauge("engine.pawn_cache", pawn_cache.stats)
+
+# centipawns per pseudo legal target square
+MOBILITY = {"P": 0, "N": 4, "B": 5, "R": 2, "Q": 1, "K": 0}
+
+PIECE_LETTERS = "PNBRQK"
+PIECE_NAMES = {"Pawn": "P", "Knight": "N", "Bishop": "B", "Rook": "R",
+               "Queen": "Q", "King": "K"}
+
+
+def piece_letter(piece) -> str:
+    """
+        P, N, B, R, Q or K for a piece
+    """
+    return repr(piece)[1].upper()
+
+
+def evaluate(board) -> int:
+    """
+        Material + piece square for a Board, walking its squares
+    """
+    flip = board.player_down == "B"
+    score = 0
+    for (x, y), piece in board.items():
+        if piece is None:
+            continue
+        letter = piece_letter(piece)
+        # row as seen from white's side
+        row = 7 - y if flip else y
+        if piece.color == "W":
+            score += PIECE_VALUES[letter] + PIECE_SQUARE[letter][row][x]
+        else:
+            score -= PIECE_VALUES[letter] + PIECE_SQUARE[letter][7 - row][x]
+    return score
+
+
+def _square_scores(player_down: str) -> dict:
+    """
+        (midgame, endgame) value + piece square of every piece on every
+        square, negative for black
+    """
+    scores = {}
+    for (name, letter), color, (x, y) in product(
+            PIECE_NAMES.items(), ("W", "B"), product(range(0, 8), range(0, 8))):
+        row = 7 - y if player_down == "B" else y
+        if color == "W":
+            sign = 1
+        else:
+            sign, row = -1, 7 - row
+        scores[name, color, (x, y)] = (
+            sign * (PIECE_VALUES[letter] + PIECE_SQUARE[letter][row][x]),
+            sign * (ENDGAME_VALUES[letter] + ENDGAME_SQUARE[letter][row][x]))
+    return scores
+
+# per player_down, keyed like chess.ZOBRIST_PIECES
+SQUARE_SCORES = {"W": _square_scores("W"), "B": _square_scores("B")}
+
+
+def board_scores(board) -> tuple:
+    """
+        Board.scores computed from scratch:
+        (midgame, endgame, phase, pawn hash)
+    """
+    table = SQUARE_SCORES[board.player_down]
+    mg, eg, phase, pawns = 0, 0, 0, 0
+    for position, piece in board.items():
+        if piece is None:
+            continue
+        name = piece.__class__.__name__
+        piece_mg, piece_eg = table[name, piece.color, position]
+        mg += piece_mg
+        eg += piece_eg
+        phase += PHASE[PIECE_NAMES[name]]
+        if name == "Pawn":
+            pawns ^= PAWN_KEYS[piece.color, position]
+    return mg, eg, phase, pawns
+
+
+def pawn_structure(board) -> tuple:
+    """
+        (midgame, endgame) of the doubled, isolated and passed pawns
+    """
+    flip = board.player_down == "B"
+    # rows as seen from white's side per color and file
+    rows = {"W": [[] for _ in range(0, 8)], "B": [[] for _ in range(0, 8)]}
+    for (x, y), piece in board.items():
+        if piece is not None and piece.__class__.__name__ == "Pawn":
+            rows[piece.color][x].append(7 - y if flip else y)
+    mg, eg = 0, 0
+    for color, sign in (("W", 1), ("B", -1)):
+        own, other = rows[color], rows["B" if color == "W" else "W"]
+        for x in range(0, 8):
+            if not own[x]:
+                continue
+            neighbours = [i for i in (x - 1, x + 1) if 0 <= i < 8]
+            if len(own[x]) > 1:
+                mg += sign * DOUBLED_PAWN[0] * (len(own[x]) - 1)
+                eg += sign * DOUBLED_PAWN[1] * (len(own[x]) - 1)
+            if not any(own[i] for i in neighbours):
+                mg += sign * ISOLATED_PAWN[0] * len(own[x])
+                eg += sign * ISOLATED_PAWN[1] * len(own[x])
+            blockers = [r for i in neighbours + [x] for r in other[i]]
+            for row in own[x]:
+                # white moves towards row 0, black towards row 7
+                if color == "W" and all(r >= row for r in blockers):
+                    bonus = PASSED_PAWN[6 - row]
+                elif color == "B" and all(r <= row for r in blockers):
+                    bonus = PASSED_PAWN[row - 1]
+                else:
+                    continue
+                mg += sign * bonus[0]
+                eg += sign * bonus[1]
+    return mg, eg
+
+
+def tapered(board) -> int:
+    """
+        Material, piece square and pawn structure, blended between the
+        midgame and endgame scores by phase. The first call on a board
+        walks it, moves keep board.scores up to date after that. Pieces
+        set on the board by hand once scores are kept make them stale,
+        reset board.scores to None then
+    """
+    scores = board.scores
+    if scores is None:
+        scores = board.scores = board_scores(board)
+    mg, eg, phase, pawns = scores
+    key = (pawns, board.player_down)
+    structure = pawn_cache.get(key)
+    if structure is None:
+        structure = pawn_structure(board)
+        pawn_cache.put(key, structure)
+    phase = min(phase, MAX_PHASE)
+    return ((mg + structure[0]) * phase +
+            (eg + structure[1]) * (MAX_PHASE - phase)) // MAX_PHASE
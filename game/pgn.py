@@ -0,0 +1,96 @@
+"""
+Portable Game Notation of the games played through GameEngine.
+
+    moves = [san(engine, move) for move in ...]   # before making each move
+    text = pgn({"White": "a", "Black": "b", "Result": "1-0"}, moves)
+
+Moves are in standard algebraic notation: the piece letter, the file, rank
+or square of the start when another piece of the same kind can reach the end
+too, x for captures, =Q for promotions, + for check and # for mate.
+"""
+from collections import OrderedDict
+from game.chess import GameEngine, square_name, FILES
+from game.evaluation import piece_letter
+from game.search import make
+
+# the seven tag roster, in order
+ROSTER = ("Event", "Site", "Date", "Round", "White", "Black", "Result")
+LINE_LENGTH = 79
+
+
+def san(engine: GameEngine, move: tuple) -> str:
+    """
+        The legal move (start, end, promotion) in standard algebraic
+        notation, called before the move is made
+    """
+    board = engine.board
+    start, end, promotion = move
+    player_down = board.player_down
+    letter = piece_letter(board[start])
+    if letter == "K" and abs(start[0] - end[0]) == 2:
+        text = "O-O" if end[0] == 6 else "O-O-O"
+    elif letter == "P":
+        text = square_name(end, player_down)
+        if start[0] != end[0]:
+            text = FILES[start[0]] + "x" + text
+        if end[1] in (0, 7):
+            text += "=" + (promotion or "Q")
+    else:
+        others = {i[0] for i in engine.legal_moves()
+                  if i[1] == end and i[0] != start and
+                  piece_letter(board[i[0]]) == letter}
+        name = square_name(start, player_down)
+        if not others:
+            origin = ""
+        elif all(i[0] != start[0] for i in others):
+            origin = name[0]
+        elif all(i[1] != start[1] for i in others):
+            origin = name[1]
+        else:
+            origin = name
+        text = letter + origin + ("x" if board[end] else "") + \
+            square_name(end, player_down)
+    make(engine, move)
+    try:
+        if GameEngine.king_attacked(engine.board):
+            text += "+" if engine.legal_moves() else "#"
+    finally:
+        engine.unmake()
+    return text
+
+
+def pgn(tags: dict, moves: list, start_ply: int=0) -> str:
+    """
+    @param tags: {"White": ..., "Result": ...}, the roster tags missing are
+        "?", the result "*"
+    @param moves: standard algebraic moves
+    @param start_ply: plies before the first move, for games set up from a
+        FEN
+    """
+    tags = OrderedDict(tags)
+    lines = []
+    for name in ROSTER:
+        lines.append('[%s "%s"]' % (
+            name, tags.pop(name, "*" if name == "Result" else "?")))
+    for name, value in tags.items():
+        lines.append('[%s "%s"]' % (name, value))
+    lines.append("")
+
+    words = []
+    for i, move in enumerate(moves):
+        ply = start_ply + i
+        if ply % 2 == 0:
+            words.append("%i." % (ply // 2 + 1))
+        elif i == 0:
+            words.append("%i..." % (ply // 2 + 1))
+        words.append(move)
+    words.append(lines[ROSTER.index("Result")].split('"')[1])
+    line = ""
+    for word in words:
+        if line and len(line) + 1 + len(word) > LINE_LENGTH:
+            lines.append(line)
+            line = word
+        else:
+            line = line + " " + word if line else word
+    lines.append(line)
+    return "\n".join(lines) + "\n"
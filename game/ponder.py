@@ -0,0 +1,150 @@
+"""
+Engine player that keeps thinking during the opponent's turn.
+
+    bot = Bot("B", depth=3)
+    result = bot.play(engine)   # searches (or takes the pondered answer),
+                                # makes the move and starts pondering
+
+After its move the bot predicts the reply (the best move the transposition
+table holds for the opponent) and searches the position after it on a copy
+of the board in a background thread. When the opponent plays the predicted
+move the pondered result is used as soon as it is ready, otherwise the
+pondering search is stopped at its next node. The table is kept between
+moves so the next search starts warm either way.
+
+With a cache (common.AnalysisCache) the bot plays the cached move of a
+position searched at least as deep before, by any bot of any node, and
+stores the results of its own searches.
+"""
+from threading import Thread, Event
+from game.chess import GameEngine
+from game.search import Search, SearchResult, SearchStopped, \
+    TranspositionTable, make, search, principal_variation
+from metrics import registry
+
+
+class Ponder:
+    """
+        One background search of the position after the predicted reply
+    """
+
+    def __init__(self, engine: GameEngine, predicted: tuple, depth: int,
+                 table: TranspositionTable):
+        self.engine = GameEngine(engine.board.copy())
+        make(self.engine, predicted)
+        self.predicted = predicted
+        self.position_key = self.engine.board.position_key()
+        self.result = None
+        self.stop = Event()
+        self._search = Search(self.engine, table, self.stop)
+        self._depth = depth
+        self.thread = Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        try:
+            self.result = self._search.root(self._depth)
+        except SearchStopped:
+            pass
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.stop.set()
+        self.thread.join()
+
+    def wait(self) -> SearchResult:
+        self.thread.join()
+        return self.result
+
+
+class Bot:
+    def __init__(self, color: str, depth: int=3, ponder: bool=True,
+                 table: TranspositionTable=None, cache=None):
+        """
+        @param cache: AnalysisCache shared with the other bots
+        """
+        self.color = color
+        self.depth = depth
+        self.ponder = ponder
+        self.table = table if table is not None else TranspositionTable()
+        self.cache = cache
+        self._ponder = None
+
+    def play(self, engine: GameEngine) -> SearchResult:
+        """
+            Make the best move of the bot on the engine.
+            Must be called when it's the bot's turn
+        @return: SearchResult, move is None when the bot has no legal move
+        """
+        with registry.timer("bot.reply"):
+            result = self._cached(engine)
+            if result is None:
+                result = self._pondered(engine)
+                if result is None:
+                    result = search(engine, self.depth, self.table)
+                self._store(engine, result)
+        if result.move is None:
+            return result
+        make(engine, result.move)
+        if self.ponder:
+            self.start_pondering(engine)
+        return result
+
+    def _cached(self, engine: GameEngine) -> SearchResult:
+        if self.cache is None:
+            return None
+        entry = self.cache.get(engine.board.position_key(), self.depth)
+        # a hash collision mustn't play an illegal move
+        if entry is None or entry.move not in engine.legal_moves():
+            return None
+        self.stop_pondering()
+        return SearchResult(entry.score, entry.move, 0)
+
+    def _store(self, engine: GameEngine, result: SearchResult):
+        if self.cache is not None and result is not None and \
+                result.move is not None:
+            # walking the table makes moves, not on the caller's engine
+            pv = principal_variation(GameEngine(engine.board.copy()),
+                                     self.table, self.depth)
+            self.cache.put(engine.board.position_key(), self.depth,
+                           result.score, result.move, pv)
+
+    def _pondered(self, engine: GameEngine) -> SearchResult:
+        """
+            The pondered result if the opponent played the predicted move
+        """
+        ponder, self._ponder = self._ponder, None
+        if ponder is None:
+            return None
+        if ponder.position_key != engine.board.position_key():
+            registry.counter("bot.ponder_miss").incr()
+            ponder.cancel()
+            return None
+        registry.counter("bot.ponder_hit").incr()
+        return ponder.wait()
+
+    def start_pondering(self, engine: GameEngine):
+        """
+            Search the position after the opponent's predicted reply in
+            the background
+        """
+        self.stop_pondering()
+        predicted = self.table.best_move(engine.board.position_key())
+        if predicted is None:
+            # nothing in the table, a cheap search to guess the reply
+            predicted = search(engine, 1, self.table).move
+        if predicted is None:
+            return
+        self._ponder = Ponder(
+            engine, predicted, self.depth, self.table).start()
+
+    def stop_pondering(self):
+        ponder, self._ponder = self._ponder, None
+        if ponder is not None:
+            ponder.cancel()
+
+    @property
+    def predicted(self) -> tuple:
+        return self._ponder.predicted if self._ponder else None
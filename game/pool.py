@@ -0,0 +1,53 @@
+"""
+Ready made engines for new games.
+
+    pool = EnginePool(32).start()
+    engine = pool.get()      # a new game in the starting position
+
+get takes an engine built in advance by a background thread, so creating a
+game costs a deque pop. The thread tops the pool up once it drops below
+half, when it's empty get builds the engine itself.
+"""
+from collections import deque
+from threading import Thread, Event
+from game.chess import GameEngine, make_game_engine
+from metrics import registry
+
+
+class EnginePool:
+    def __init__(self, size: int=32, player_down: str="W"):
+        self.size = size
+        self.player_down = player_down
+        self._engines = deque()
+        self._low = Event()
+        self._thread = None
+        registry.gauge("engine_pool", lambda: {"ready": len(self._engines)})
+
+    def __len__(self):
+        return len(self._engines)
+
+    def fill(self):
+        while len(self._engines) < self.size:
+            self._engines.append(make_game_engine(self.player_down))
+
+    def get(self) -> GameEngine:
+        try:
+            engine = self._engines.popleft()
+        except IndexError:
+            registry.counter("engine_pool.miss").incr()
+            engine = make_game_engine(self.player_down)
+        if len(self._engines) < self.size // 2:
+            self._low.set()
+        return engine
+
+    def _run(self):
+        while True:
+            self._low.wait()
+            self._low.clear()
+            self.fill()
+
+    def start(self):
+        self.fill()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
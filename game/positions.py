@@ -0,0 +1,220 @@
+"""
+Position index of the archive: every (game, ply) that reached a position.
+
+    index = PositionIndex("/data/archive/positions")
+    index.add_game(game_id, moves)     # while the game is archived
+    index.flush()
+
+    index.games(board)                 # ids of the games reaching the board
+    index.next_moves(board, archive)   # {move: {"games": n, "1-0": .., ..}}
+
+A record is (hash, game, ply, move): the Zobrist hash of the position before
+ply, the game, the ply and the archive encoded move played from there
+(NO_MOVE once the game ended). Hashes are taken with white down, boards
+with black down are turned around before a lookup. They cover the pieces and
+the player to move, castling and en passant rights are not part of them.
+
+Records live in segment files sorted by hash, a lookup is a binary search in
+the memory map of every segment. flush writes the records added since the
+last flush as a new segment, once there are more than max_segments the
+newest ones are merged. The list of current segments is a manifest file replaced
+atomically, so readers never see a merged segment next to its parts. The
+parts are deleted right after, a reader that read the old manifest reads
+the new one again.
+
+Games are indexed in id order, records of a game below the highest id
+already flushed are dropped by add: a writer replaying the games of a
+flush that didn't make it to the archive doesn't index them twice.
+"""
+import os
+import numpy as np
+from game.archive import RESULTS, encode_move, decode_move
+from game.chess import Board, make_game_engine
+from game.search import make
+
+RECORD = np.dtype([("hash", "<u8"), ("game", "<u4"), ("ply", "<u2"),
+                   ("move", "<u2")])
+NO_MOVE = 0xFFFF
+MANIFEST = "segments"
+# manifests read by reload before giving up on segments disappearing
+RELOAD_ATTEMPTS = 5
+
+
+def board_hash(board: Board) -> int:
+    if board.player_down != "W":
+        board = Board.from_fen(board.fen(), "W")
+    return board.position_hash()
+
+
+def game_records(game_id: int, moves: list) -> np.ndarray:
+    """
+        Replay the game through GameEngine
+    @param moves: (start, end, promotion) with white down
+    """
+    engine = make_game_engine("W")
+    hashes = []
+    for ply, move in enumerate(moves):
+        hashes.append(engine.board.position_hash())
+        if not make(engine, move):
+            raise ValueError("Illegal move %s at ply %i of game %i"
+                             % (move, ply, game_id))
+    hashes.append(engine.board.position_hash())
+    records = np.zeros(len(hashes), dtype=RECORD)
+    records["hash"] = hashes
+    records["game"] = game_id
+    records["ply"] = np.arange(0, len(hashes))
+    records["move"] = [encode_move(i) for i in moves] + [NO_MOVE]
+    return records
+
+
+def sort_records(records: np.ndarray) -> np.ndarray:
+    # stable, the records of a hash stay in game order
+    return records[np.argsort(records["hash"], kind="stable")]
+
+
+class PositionIndex:
+    def __init__(self, directory: str, max_segments: int=8):
+        self.directory = directory
+        self.max_segments = max_segments
+        os.makedirs(directory, exist_ok=True)
+        self._pending = []
+        self.reload()
+        # the newest segment has the last games, merged or not
+        self.next_game = int(self.segments[-1]["game"].max()) + 1 \
+            if self.segments else 0
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _read_manifest(self) -> list:
+        if not os.path.exists(self._path(MANIFEST)):
+            return []
+        with open(self._path(MANIFEST)) as f:
+            return f.read().split()
+
+    def _write_manifest(self, names: list):
+        tmp = self._path(MANIFEST + ".tmp")
+        with open(tmp, "w") as f:
+            f.write("\n".join(names))
+        os.replace(tmp, self._path(MANIFEST))
+
+    def reload(self):
+        """
+            Map the segments flushed since the index was opened
+        """
+        for attempt in range(1, RELOAD_ATTEMPTS + 1):
+            names = self._read_manifest()
+            try:
+                segments = [np.memmap(self._path(i), dtype=RECORD, mode="r")
+                            for i in names]
+            except FileNotFoundError:
+                # merged away since the manifest was read
+                if attempt == RELOAD_ATTEMPTS:
+                    raise
+                continue
+            self.names, self.segments = names, segments
+            return
+
+    def __len__(self):
+        return sum(len(i) for i in self.segments)
+
+    def add_game(self, game_id: int, moves: list):
+        self.add(game_records(game_id, moves))
+
+    def add(self, records: np.ndarray):
+        """
+            Records of game_records, flushed with the next segment
+        """
+        self._pending.append(records[records["game"] >= self.next_game])
+
+    def _new_segment(self, records: np.ndarray) -> str:
+        last = max((int(i.split(".")[1]) for i in self.names), default=0)
+        name = "segment.%06i" % (last + 1)
+        tmp = self._path(name + ".tmp")
+        records.tofile(tmp)
+        os.replace(tmp, self._path(name))
+        return name
+
+    def flush(self):
+        if not self._pending:
+            return
+        records = sort_records(np.concatenate(self._pending))
+        self._pending = []
+        if not len(records):
+            return
+        self.next_game = max(self.next_game, int(records["game"].max()) + 1)
+        self.names = self._read_manifest()
+        self._write_manifest(self.names + [self._new_segment(records)])
+        self.reload()
+        if len(self.segments) > self.max_segments:
+            self.merge()
+
+    def merge(self):
+        """
+            Merge the newest segments into one, going back while a segment
+            is no bigger than the ones after it. Big old segments are left
+            alone, a record gets rewritten a logarithmic number of times.
+            Segments hold increasing game ids, merging neighbours with a
+            stable sort keeps the game order
+        """
+        sizes = [len(i) for i in self.segments]
+        if len(sizes) < 2:
+            return
+        start = len(sizes) - 2
+        while start > 0 and sizes[start - 1] <= sum(sizes[start:]):
+            start -= 1
+        old = self.names[start:]
+        records = sort_records(np.concatenate(self.segments[start:]))
+        self._write_manifest(self.names[:start] + [self._new_segment(records)])
+        self.reload()
+        for name in old:
+            os.remove(self._path(name))
+
+    def lookup(self, board: Board) -> np.ndarray:
+        """
+            Records of the position, by segment then game
+        """
+        _hash = np.uint64(board_hash(board))
+        found = []
+        for segment in self.segments:
+            hashes = segment["hash"]
+            start = np.searchsorted(hashes, _hash, side="left")
+            end = np.searchsorted(hashes, _hash, side="right")
+            if start < end:
+                found.append(segment[start:end])
+        if not found:
+            return np.zeros(0, dtype=RECORD)
+        return np.concatenate(found)
+
+    def games(self, board: Board) -> np.ndarray:
+        """
+            Ids of the games reaching the position, a game repeating it
+            appears once
+        """
+        return np.unique(self.lookup(board)["game"])
+
+    def next_moves(self, board: Board, archive=None) -> dict:
+        """
+            How often each move was played from the position, and with
+            the archive how those games ended
+        @param archive: game.archive.Archive the index was built from
+        @return: {(start, end, promotion): {"games": n, "1-0": n, ...}},
+            moves with the board's player_down
+        """
+        records = self.lookup(board)
+        records = records[records["move"] != NO_MOVE]
+        moves, inverse = np.unique(records["move"], return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(moves))
+        by_result = {}
+        if archive is not None:
+            results = archive.result[records["game"]]
+            for code, result in enumerate(RESULTS[:3]):
+                by_result[result] = np.bincount(
+                    inverse, weights=results == code, minlength=len(moves))
+        stats = {}
+        for i, code in enumerate(moves):
+            move = decode_move(int(code), board.player_down)
+            stats[move] = {"games": int(counts[i])}
+            for result, values in by_result.items():
+                stats[move][result] = int(values[i])
+        return stats
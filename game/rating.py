@@ -0,0 +1,42 @@
+"""
+Elo ratings.
+
+    white, black = update(1500, 1500, "1-0")   # (1520.0, 1480.0)
+
+New players move faster: K is PROVISIONAL_K for their first
+PROVISIONAL_GAMES games.
+"""
+
+DEFAULT_RATING = 1500.0
+K = 20
+PROVISIONAL_K = 40
+PROVISIONAL_GAMES = 30
+
+# white's score per result
+SCORES = {"1-0": 1.0, "0-1": 0.0, "1/2-1/2": 0.5}
+
+
+def expected(rating: float, opponent: float) -> float:
+    """
+        Expected score against the opponent, 0 to 1
+    """
+    return 1.0 / (1.0 + 10 ** ((opponent - rating) / 400.0))
+
+
+def k_factor(games: int) -> int:
+    return PROVISIONAL_K if games < PROVISIONAL_GAMES else K
+
+
+def update(white: float, black: float, result: str, white_games: int=0,
+           black_games: int=0) -> tuple:
+    """
+        Both ratings after a game
+    @param result: "1-0", "0-1" or "1/2-1/2"
+    @param white_games: games white played before this one
+    @return: (white, black)
+    """
+    score = SCORES[result]
+    white_delta = k_factor(white_games) * (score - expected(white, black))
+    black_delta = k_factor(black_games) * \
+        ((1 - score) - expected(black, white))
+    return white + white_delta, black + black_delta
@@ -0,0 +1,441 @@
+"""
+Move search over GameEngine.
+
+    perft(engine, 3)                  # leaf nodes, validates move generation
+    parallel_perft(fen, 5)            # the root moves split across processes
+    search(engine, 3)                 # SearchResult(score, move, nodes)
+    deepen(Search(engine, max_nodes=5000), 64)
+    parallel_search(fen, 4)
+
+    python -m game.search perft 5 --workers 16
+    python -m game.search search 4 --fen "<fen>"
+
+Moves are (start, end, promotion) as returned by GameEngine.legal_moves.
+Worker processes get the position as FEN plus the root move of their
+subtree, so nothing but strings and tuples is pickled. Scores are centipawns
+for the player to move.
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import time
+from game.chess import Board, GameEngine, Pawn
+from game.evaluation import PIECE_VALUES, tapered, piece_letter
+from game.see import see
+
+MATE = 100000
+INFINITY = MATE + 1
+# scores above are mates, stored relative to the node in the table
+MATE_BOUND = MATE - 1000
+
+# TableEntry.flag
+EXACT, LOWER, UPPER = 0, 1, 2
+
+SearchResult = namedtuple("SearchResult", ["score", "move", "nodes"])
+TableEntry = namedtuple("TableEntry", ["depth", "score", "flag", "move"])
+
+
+class SearchStopped(Exception):
+    pass
+
+
+class TranspositionTable:
+    """
+        Search results per Board.position_key, kept between searches.
+        A deeper entry is never replaced by a shallower one, the table is
+        cleared when full
+    """
+
+    def __init__(self, max_size: int=200000):
+        self.max_size = max_size
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key) -> TableEntry:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, key, entry: TableEntry):
+        old = self._entries.get(key)
+        if old is not None and old.depth > entry.depth:
+            return
+        if old is None and len(self._entries) >= self.max_size:
+            self._entries.clear()
+        self._entries[key] = entry
+
+    def best_move(self, key) -> tuple:
+        entry = self._entries.get(key)
+        return entry.move if entry else None
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+def _to_table(score: int, ply: int) -> int:
+    if score > MATE_BOUND:
+        return score + ply
+    if score < -MATE_BOUND:
+        return score - ply
+    return score
+
+
+def _from_table(score: int, ply: int) -> int:
+    if score > MATE_BOUND:
+        return score - ply
+    if score < -MATE_BOUND:
+        return score + ply
+    return score
+
+
+def engine_from_fen(fen: str, player_down: str="W") -> GameEngine:
+    return GameEngine(Board.from_fen(fen, player_down=player_down))
+
+
+def make(engine: GameEngine, move: tuple) -> bool:
+    start, end, promotion = move
+    return engine.move(start, end, engine.board.turn, promotion)
+
+
+def perft(engine: GameEngine, depth: int) -> int:
+    """
+        Leaf nodes of the legal move tree, depth plies deep
+    """
+    if depth == 0:
+        return 1
+    moves = engine.legal_moves()
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        make(engine, move)
+        nodes += perft(engine, depth - 1)
+        engine.unmake()
+    return nodes
+
+
+def divide(engine: GameEngine, depth: int) -> dict:
+    """
+        perft per root move
+    """
+    nodes = {}
+    for move in engine.legal_moves():
+        make(engine, move)
+        nodes[move] = perft(engine, depth - 1)
+        engine.unmake()
+    return nodes
+
+
+def _perft_worker(args) -> int:
+    fen, player_down, move, depth = args
+    engine = engine_from_fen(fen, player_down)
+    make(engine, move)
+    return perft(engine, depth - 1)
+
+
+def parallel_divide(fen: str, depth: int, player_down: str="W",
+                    workers: int=None) -> dict:
+    """
+        divide with every root move counted in a worker process
+    @param workers: processes, os.cpu_count() if not given
+    """
+    moves = engine_from_fen(fen, player_down).legal_moves()
+    if depth == 1:
+        return {move: 1 for move in moves}
+    jobs = [(fen, player_down, move, depth) for move in moves]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(moves, executor.map(_perft_worker, jobs)))
+
+
+def parallel_perft(fen: str, depth: int, player_down: str="W",
+                   workers: int=None) -> int:
+    return sum(parallel_divide(fen, depth, player_down, workers).values())
+
+
+class Search:
+    """
+        Negamax alpha beta search of one engine's position, then a
+        quiescence search of the captures at the leaves.
+        With a table, results are stored and reused across searches.
+        Setting the stop event or going over max_nodes makes the search
+        raise SearchStopped
+    """
+
+    def __init__(self, engine: GameEngine, table: TranspositionTable=None,
+                 stop=None, prune_captures: bool=True, max_nodes: int=None):
+        """
+        @param table: TranspositionTable
+        @param stop: threading.Event
+        @param prune_captures: skip the captures losing material by see in
+            the quiescence search
+        """
+        self.engine = engine
+        self.table = table
+        self.stop = stop
+        self.prune_captures = prune_captures
+        self.max_nodes = max_nodes
+        self.nodes = 0
+        self.quiescence_nodes = 0
+
+    def _visit(self):
+        self.nodes += 1
+        if self.stop is not None and self.stop.is_set():
+            raise SearchStopped()
+        if self.max_nodes is not None and self.nodes > self.max_nodes:
+            raise SearchStopped()
+
+    def evaluate(self) -> int:
+        score = tapered(self.engine.board)
+        return score if self.engine.board.turn == "W" else -score
+
+    def ordered_moves(self, first: tuple=None) -> list:
+        """
+            The first move (best move from the table) then most valuable
+            victim first, promotions first among the quiet moves
+        """
+        moves = sorted(self.engine.legal_moves(), key=self._order_key,
+                       reverse=True)
+        if first in moves:
+            moves.remove(first)
+            moves.insert(0, first)
+        return moves
+
+    def _order_key(self, move: tuple) -> int:
+        board = self.engine.board
+        start, end, promotion = move
+        victim = board[end]
+        if victim is None:
+            return PIECE_VALUES[promotion] if promotion else 0
+        return 10 * PIECE_VALUES[piece_letter(victim)] - \
+            PIECE_VALUES[piece_letter(board[start])]
+
+    def captures(self) -> list:
+        """
+            Legal captures, most valuable victim first, promotions to a
+            queen only. With prune_captures the ones see says lose material
+            are left out before their legality is checked, the expensive
+            part
+        """
+        board = self.engine.board
+        turn = board.turn
+        captures = []
+        for piece in board.our_pieces():
+            start = piece.position
+            pawn = isinstance(piece, Pawn)
+            for end in piece.candidates(board):
+                victim = board[end]
+                if victim is None:
+                    # en passant is the only capture to an empty square
+                    if not pawn or start[0] == end[0]:
+                        continue
+                elif victim.color == turn:
+                    continue
+                if self.prune_captures and see(board, start, end) < 0:
+                    continue
+                if self.engine._check_move(start, end, turn):
+                    promotion = "Q" if pawn and end[1] in (0, 7) else None
+                    captures.append((start, end, promotion))
+        # sorted first so the order doesn't depend on the hash seed, the
+        # second sort is stable
+        captures.sort()
+        return sorted(captures, key=self._order_key, reverse=True)
+
+    def quiescence(self, alpha: int, beta: int) -> int:
+        """
+            Search the captures until the position is quiet, so leaves aren't
+            evaluated half way through an exchange. The player to move may
+            stand pat on the evaluation instead of taking
+        """
+        self._visit()
+        self.quiescence_nodes += 1
+        stand_pat = self.evaluate()
+        if stand_pat >= beta:
+            return stand_pat
+        alpha = max(alpha, stand_pat)
+        for move in self.captures():
+            make(self.engine, move)
+            try:
+                score = -self.quiescence(-beta, -alpha)
+            finally:
+                self.engine.unmake()
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+    def negamax(self, depth: int, alpha: int, beta: int, ply: int=0) -> int:
+        if depth == 0:
+            return self.quiescence(alpha, beta)
+        self._visit()
+
+        key, table_move = None, None
+        if self.table is not None:
+            key = self.engine.board.position_key()
+            entry = self.table.get(key)
+            if entry is not None:
+                table_move = entry.move
+                if entry.depth >= depth:
+                    score = _from_table(entry.score, ply)
+                    if entry.flag == EXACT or \
+                            (entry.flag == LOWER and score >= beta) or \
+                            (entry.flag == UPPER and score <= alpha):
+                        return score
+
+        moves = self.ordered_moves(table_move)
+        if not moves:
+            if GameEngine.king_attacked(self.engine.board):
+                # mated, sooner is worse
+                return -MATE + ply
+            return 0
+        alpha_start = alpha
+        best, best_move = -INFINITY, None
+        for move in moves:
+            make(self.engine, move)
+            try:
+                score = -self.negamax(depth - 1, -beta, -alpha, ply + 1)
+            finally:
+                self.engine.unmake()
+            if score > best:
+                best, best_move = score, move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                break
+
+        if key is not None:
+            flag = LOWER if best >= beta else \
+                UPPER if best <= alpha_start else EXACT
+            self.table.put(key, TableEntry(
+                depth, _to_table(best, ply), flag, best_move))
+        return best
+
+    def root(self, depth: int, moves: list=None) -> SearchResult:
+        """
+            Best of the given root moves, all the legal moves if not given
+        """
+        key = self.engine.board.position_key()
+        if moves is None:
+            table_move = self.table.best_move(key) if self.table else None
+            moves = self.ordered_moves(table_move)
+        best, best_move = -INFINITY, None
+        for move in moves:
+            make(self.engine, move)
+            try:
+                score = -self.negamax(depth - 1, -INFINITY, -best, 1)
+            finally:
+                self.engine.unmake()
+            if score > best:
+                best, best_move = score, move
+        if self.table is not None and best_move is not None:
+            self.table.put(key, TableEntry(depth, best, EXACT, best_move))
+        return SearchResult(best, best_move, self.nodes)
+
+
+def search(engine: GameEngine, depth: int,
+           table: TranspositionTable=None) -> SearchResult:
+    return Search(engine, table).root(depth)
+
+
+def deepen(search: Search, depth: int, on_depth=None) -> SearchResult:
+    """
+        Iterative deepening up to depth. A stopped search gives the result of
+        the last finished depth, None if none finished
+    @param on_depth: on_depth(depth, result) after every finished depth
+    """
+    best = None
+    try:
+        for current in range(1, depth + 1):
+            result = search.root(current)
+            if result.move is None:
+                break
+            best = result
+            if on_depth is not None:
+                on_depth(current, result)
+    except SearchStopped:
+        pass
+    return best
+
+
+def principal_variation(engine: GameEngine, table: TranspositionTable,
+                        depth: int) -> list:
+    """
+        Best moves the table holds from the position on
+    """
+    moves = []
+    for _ in range(0, depth):
+        move = table.best_move(engine.board.position_key())
+        if move is None or not make(engine, move):
+            break
+        moves.append(move)
+    for _ in moves:
+        engine.unmake()
+    return moves
+
+
+def _search_worker(args) -> SearchResult:
+    fen, player_down, move, depth = args
+    return Search(engine_from_fen(fen, player_down)).root(depth, [move])
+
+
+def parallel_search(fen: str, depth: int, player_down: str="W",
+                    workers: int=None) -> SearchResult:
+    """
+        search with every root move searched in a worker process.
+        Workers don't share alpha, each subtree gets the full window
+    """
+    moves = engine_from_fen(fen, player_down).legal_moves()
+    jobs = [(fen, player_down, move, depth) for move in moves]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_search_worker, jobs))
+    if not results:
+        return SearchResult(None, None, 0)
+    best = max(results, key=lambda result: result.score)
+    return SearchResult(best.score, best.move,
+                        sum(result.nodes for result in results))
+
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("command", choices=["perft", "search"])
+    parser.add_argument("depth", type=int)
+    parser.add_argument("--fen", default=START_FEN)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="processes, one per core by default")
+    args = parser.parse_args()
+
+    started = time.time()
+    if args.command == "perft":
+        divided = parallel_divide(args.fen, args.depth, workers=args.workers)
+        for move, nodes in sorted(divided.items()):
+            print(move, nodes)
+        nodes = sum(divided.values())
+        print("nodes", nodes)
+    else:
+        result = parallel_search(args.fen, args.depth, workers=args.workers)
+        nodes = result.nodes
+        print("bestmove", result.move, "score", result.score, "nodes", nodes)
+    elapsed = time.time() - started
+    print("time %.2fs, %.0f nodes/s" % (elapsed, nodes / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Static exchange evaluation: the material a capture wins once both sides
+have recaptured on its square with their least valuable piece, as long as
+it pays for them.
+
+    see(board, (4, 4), (3, 3))      # 100 if a pawn is won, -200 for a knight
+                                    # taking a defended pawn
+
+Nothing is moved on the board. The attackers of the square are found from
+the piece geometry: knights with Knight.find, everything else by walking
+the eight rays out of the square, kings and pawns only count one square
+away, pawns in the direction they move. Removing a slider from its ray uncovers the piece behind it, so
+x-rays (a rook behind a rook, a queen behind a bishop) join the exchange.
+Pins, checks and promotions are ignored.
+"""
+from game.chess import Math, Knight, Pawn
+from game.evaluation import PIECE_VALUES, piece_letter
+
+# the king takes last, it can't be taken back
+SEE_VALUES = dict(PIECE_VALUES, K=20000)
+
+ORTHOGONAL = ((1, 0), (-1, 0), (0, 1), (0, -1))
+DIAGONAL = ((1, 1), (1, -1), (-1, 1), (-1, -1))
+# pieces moving along a ray of each kind
+SLIDERS = {ORTHOGONAL: "RQ", DIAGONAL: "BQ"}
+
+
+def _rays(board, square: tuple) -> list:
+    """
+        ([pieces nearest first], sliders, (dx, dy)) for the eight rays out of
+        the square
+    """
+    rays = []
+    for directions, sliders in SLIDERS.items():
+        for dx, dy in directions:
+            pieces = []
+            x, y = square[0] + dx, square[1] + dy
+            while Math.check_range((x, y)):
+                if board[x, y] is not None:
+                    pieces.append(board[x, y])
+                x, y = x + dx, y + dy
+            if pieces:
+                rays.append((pieces, sliders, (dx, dy)))
+    return rays
+
+
+def _attacks_along(piece, square: tuple, sliders: str,
+                   direction: tuple) -> bool:
+    letter = piece_letter(piece)
+    if letter in sliders:
+        return True
+    if max(abs(piece.position[0] - square[0]),
+           abs(piece.position[1] - square[1])) != 1:
+        return False
+    # a pawn attacks one square diagonally forward
+    return letter == "K" or letter == "P" and direction in DIAGONAL and \
+        direction[1] == -piece.y_add
+
+
+def _knights(board, square: tuple) -> list:
+    knights = []
+    for position in Knight.find(None, *square):
+        piece = board[position]
+        if piece is not None and piece_letter(piece) == "N":
+            knights.append(piece)
+    return knights
+
+
+def _attackers(square: tuple, rays: list, knights: list, removed: set) -> list:
+    """
+        The first piece left on every ray if it moves along it, and the
+        knights. Kings and pawns are on the rays one square away
+    @param removed: ids of the pieces that took part in the exchange
+    """
+    found = [i for i in knights if id(i) not in removed]
+    for pieces, sliders, direction in rays:
+        for piece in pieces:
+            if id(piece) in removed:
+                continue
+            if _attacks_along(piece, square, sliders, direction):
+                found.append(piece)
+            break
+    return found
+
+
+def attackers(board, square: tuple) -> list:
+    """
+        Pieces of both colors attacking the square
+    """
+    return _attackers(square, _rays(board, square), _knights(board, square),
+                      set())
+
+
+def see(board, start: tuple, end: tuple) -> int:
+    """
+        Material won by the side moving from start capturing on end, in
+        centipawns. Negative if the exchange loses material, 0 for a move
+        to an empty square nobody takes
+    """
+    piece = board[start]
+    target = board[end]
+    if target is None and isinstance(piece, Pawn) and start[0] != end[0]:
+        # en passant, the pawn taken isn't on end
+        gain = [SEE_VALUES["P"]]
+    else:
+        gain = [SEE_VALUES[piece_letter(target)] if target else 0]
+    rays, knights = _rays(board, end), _knights(board, end)
+    removed = {id(piece)}
+    # value of the piece standing on end, the next one to be taken
+    standing = SEE_VALUES[piece_letter(piece)]
+    color = "B" if piece.color == "W" else "W"
+    while True:
+        candidates = [i for i in _attackers(end, rays, knights, removed)
+                      if i.color == color]
+        if not candidates:
+            break
+        attacker = min(candidates, key=lambda i: SEE_VALUES[piece_letter(i)])
+        gain.append(standing - gain[-1])
+        removed.add(id(attacker))
+        standing = SEE_VALUES[piece_letter(attacker)]
+        color = "B" if color == "W" else "W"
+    # every side may stop taking back when it only loses
+    while len(gain) > 1:
+        last = gain.pop()
+        gain[-1] = -max(-gain[-1], last)
+    return gain[0]
@@ -1,8 +1,35 @@
+import os
+import random
+import shutil
+import tempfile
+import time
 import unittest
 from game.chess import Rook, Bishop, Pawn, Queen, King, Knight
-from game.chess import Board, GameEngine
+from game.chess import Board, GameEngine, move_cache, make_game_engine
+from game.search import perft, parallel_perft, search, engine_from_fen, \
+    make
+from game.ponder import Bot
+from game.pool import EnginePool
+from game.evaluation import tapered, board_scores, pawn_structure, pawn_cache
+from game import evaluation
+from game.see import see, attackers
+from game.search import Search
+from game.uci import UCI, move_name, parse_move
+from game.pgn import san, pgn
+from game.clock import Clock, parse_time_control
+from game import rating
+from metrics import registry
 import game
 
+try:
+    import numpy
+    from game import batch_eval
+    from game.archive import Archive, ArchiveWriter, AnalysisWriter, \
+        encode_move, decode_move
+    from game.positions import PositionIndex
+except ImportError:
+    numpy = None
+
 
 class TestInitialState(unittest.TestCase):
     def setUp(self):
@@ -114,9 +141,8 @@ class TestCastling(unittest.TestCase):
         assert self.game_engine.move((4, 7), (6, 7), "W")
         self.game_engine.undo()
         assert self.game_engine.move((4, 7), (2, 7), "W")
-        # black
-        assert self.game_engine.move((4, 0), (2, 0), "B")
-        self.game_engine.undo()
+        # black, the king can't pass d8 attacked by the rook on d1
+        assert not self.game_engine.move((4, 0), (2, 0), "B")
         assert self.game_engine.move((4, 0), (6, 0), "B")
 
         assert isinstance(self.board[2, 7], King)
@@ -128,6 +154,92 @@ class TestCastling(unittest.TestCase):
         assert isinstance(self.board[0, 0], Rook)
 
 
+class TestStateStack(unittest.TestCase):
+    def setUp(self):
+        self.board = Board(player_down="W", create=True)
+        self.game_engine = GameEngine(self.board)
+
+    def _state(self):
+        return (self.board.castling, self.board.en_passant,
+                self.board.halfmove_clock, len(self.board.state))
+
+    def test_no_drift(self):
+        start = self._state()
+        for i in range(0, 3):
+            self.game_engine.possible_moves()
+        assert self._state() == start
+        assert not self.board.undone_moves
+
+    def test_castling_rights(self):
+        for move in [((4, 6), (4, 4), "W"), ((4, 1), (4, 3), "B"),
+                     ((4, 7), (4, 6), "W")]:
+            assert self.game_engine.move(*move)
+        # white king moved
+        assert self.board.castling == 4 | 8
+        assert self.board.halfmove_clock == 1
+        for i in range(0, 3):
+            self.game_engine.undo()
+        assert self.board.castling == 15
+        assert self.board == Board(player_down="W", create=True)
+
+    def test_en_passant(self):
+        for move in [((4, 6), (4, 4), "W"), ((0, 1), (0, 2), "B"),
+                     ((4, 4), (4, 3), "W"), ((3, 1), (3, 3), "B")]:
+            assert self.game_engine.move(*move)
+        assert self.board.en_passant == 3
+        assert (3, 2) in self.game_engine.possible_moves()[(4, 3)]
+
+        assert self.game_engine.move((4, 3), (3, 2), "W")
+        assert self.board[3, 3] is None
+        assert len(self.board.killed) == 1
+        self.game_engine.undo()
+        assert isinstance(self.board[3, 3], Pawn)
+        assert self.board[3, 2] is None
+        assert self.board.en_passant == 3
+        assert not self.board.killed
+
+    def test_pawn_kill(self):
+        for move in [((4, 6), (4, 4), "W"), ((3, 1), (3, 3), "B")]:
+            assert self.game_engine.move(*move)
+        assert self.game_engine.move((4, 4), (3, 3), "W")
+        assert self.board.halfmove_clock == 0
+        assert [repr(i) for i in self.board.killed] == ["bP"]
+
+
+class TestStartPosition(unittest.TestCase):
+    def test_prototype(self):
+        for player_down in ("W", "B"):
+            created = Board(player_down=player_down, create=True)
+            board = Board.start_position(player_down)
+            assert board == created
+            assert list(board.keys()) == list(created.keys())
+            assert board.fen() == created.fen()
+
+    def test_independent(self):
+        game_engine = GameEngine(Board.start_position("W"))
+        pawn = game_engine.board[4, 6]
+        game_engine.move((4, 6), (4, 4), "W")
+        other = Board.start_position("W")
+        assert other[4, 6] is not pawn and other[4, 6].position == (4, 6)
+        assert other[4, 4] is None and other.turn == "W"
+
+    def test_pool(self):
+        pool = EnginePool(4)
+        pool.fill()
+        engines = [pool.get() for _ in range(0, 5)]
+        assert len(pool) == 0
+        assert len({id(i.board) for i in engines}) == 5
+        pool.start()
+        assert len(pool) == 4
+        # below half, the thread tops it up
+        [pool.get() for _ in range(0, 3)]
+        for _ in range(0, 100):
+            if len(pool) == 4:
+                break
+            time.sleep(0.01)
+        assert len(pool) == 4
+
+
 class TestInitialPossibleMoves(unittest.TestCase):
     """
         Introduced after a bug in a move found
@@ -150,6 +262,609 @@ class TestInitialPossibleMoves(unittest.TestCase):
         assert len([k for i in self.game_engine.possible_moves().values() for k in i]) == 20
 
 
+class TestPieces(unittest.TestCase):
+    def test_no_instance_dict(self):
+        board = Board(player_down="W", create=True)
+        for piece in board.get_pieces("W") | board.get_pieces("B"):
+            assert not hasattr(piece, "__dict__")
+
+    def test_copy(self):
+        game_engine = GameEngine(Board(player_down="W", create=True))
+        assert game_engine.move((4, 6), (4, 4), "W")
+        board = game_engine.board.copy()
+        assert board == game_engine.board
+        assert board.position_key() == game_engine.board.position_key()
+
+        copy_engine = GameEngine(board)
+        assert copy_engine.move((4, 1), (4, 3), "B")
+        assert game_engine.board[4, 1] is not None
+        assert game_engine.board[4, 4].position == (4, 4)
+        assert game_engine.board.turn == "B"
+
+
+class TestPerft(unittest.TestCase):
+    # known node counts, https://www.chessprogramming.org/Perft_Results
+    KIWIPETE = "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R " \
+               "w KQkq - 0 1"
+    ENDGAME = "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1"
+    PROMOTION = "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8"
+
+    def test_start(self):
+        game_engine = GameEngine(Board(player_down="W", create=True))
+        assert perft(game_engine, 1) == 20
+        assert perft(game_engine, 2) == 400
+        assert game_engine.board == Board(player_down="W", create=True)
+
+    def test_positions(self):
+        for player_down in ("W", "B"):
+            assert perft(engine_from_fen(self.KIWIPETE, player_down), 1) == 48
+            assert perft(engine_from_fen(self.ENDGAME, player_down), 2) == 191
+            assert perft(engine_from_fen(self.PROMOTION, player_down), 1) == 44
+
+    def test_fen(self):
+        for fen in (self.KIWIPETE, self.ENDGAME, self.PROMOTION):
+            assert engine_from_fen(fen).board.fen() == fen
+        board = Board(player_down="B", create=True)
+        assert Board.from_fen(board.fen(), player_down="B") == board
+
+    def test_promotion(self):
+        game_engine = engine_from_fen(self.PROMOTION)
+        assert game_engine.move((3, 1), (2, 0), "W", "N")
+        assert isinstance(game_engine.board[2, 0], Knight)
+        game_engine.undo()
+        assert isinstance(game_engine.board[3, 1], Pawn)
+
+    def test_parallel(self):
+        assert parallel_perft(self.ENDGAME, 2, workers=2) == 191
+
+    def test_mate_in_one(self):
+        fen = "r1bqkbnr/pppp1ppp/2n5/4p3/2B1P3/5Q2/PPPP1PPP/RNB1K1NR " \
+              "w KQkq - 0 1"
+        result = search(engine_from_fen(fen), 2)
+        assert result.move == ((5, 5), (5, 1), None)
+
+
+class TestPonder(unittest.TestCase):
+    def setUp(self):
+        self.game_engine = GameEngine(Board(player_down="W", create=True))
+        self.bot = Bot("W", depth=2)
+        assert self.bot.play(self.game_engine).move
+
+    def _counter(self, name):
+        return registry.snapshot().get(name, {}).get("value", 0)
+
+    def test_hit(self):
+        hits = self._counter("bot.ponder_hit")
+        make(self.game_engine, self.bot.predicted)
+        expected = search(GameEngine(self.game_engine.board.copy()), 2)
+        result = self.bot.play(self.game_engine)
+        assert self._counter("bot.ponder_hit") == hits + 1
+        assert result.move == expected.move
+        assert result.score == expected.score
+        self.bot.stop_pondering()
+
+    def test_miss(self):
+        misses = self._counter("bot.ponder_miss")
+        ponder = self.bot._ponder
+        other = [move for move in self.game_engine.legal_moves()
+                 if move != self.bot.predicted][0]
+        make(self.game_engine, other)
+        assert self.bot.play(self.game_engine).move
+        assert self._counter("bot.ponder_miss") == misses + 1
+        assert not ponder.thread.is_alive()
+        self.bot.stop_pondering()
+
+
+class TestClock(unittest.TestCase):
+    def test_increment_and_delay(self):
+        assert parse_time_control("300+2") == (300, 2)
+        clock = Clock(10, increment=1, delay=2)
+        clock.start(0)
+        assert clock.deadline() == 12
+        assert clock.press(5)
+        assert clock.remaining["W"] == 8
+        assert clock.time_left("B", 6) == 10
+        assert not clock.press(20)
+        assert clock.flagged == "B"
+
+
+class TestRating(unittest.TestCase):
+    def test_update(self):
+        assert rating.update(1500, 1500, "1-0") == (1520, 1480)
+        assert rating.update(1500, 1500, "1/2-1/2") == (1500, 1500)
+        white, black = rating.update(1400, 1600, "1/2-1/2", 100, 100)
+        assert round(white - 1400, 1) == round(1600 - black, 1) == 5.2
+
+
+class TestOutcome(unittest.TestCase):
+    def test_checkmate(self):
+        game_engine = engine_from_fen(
+            "r1bqkb1r/pppp1Qpp/2n2n2/4p3/2B1P3/8/PPPP1PPP/RNB1K1NR b KQkq - 0 4")
+        assert game_engine.outcome() == ("1-0", "checkmate")
+
+    def test_stalemate(self):
+        game_engine = engine_from_fen("7k/5Q2/6K1/8/8/8/8/8 b - - 0 1")
+        assert game_engine.outcome() == ("1/2-1/2", "stalemate")
+
+    def test_running(self):
+        game_engine = GameEngine(Board(player_down="W", create=True))
+        assert game_engine.outcome() is None
+        game_engine.finish("0-1", "time")
+        assert game_engine.outcome() == ("0-1", "time")
+
+
+class TestMoveCache(unittest.TestCase):
+    def setUp(self):
+        move_cache.clear()
+        self.game_engine = GameEngine(Board(player_down="W", create=True))
+
+    def test_hits(self):
+        first = self.game_engine.possible_moves()
+        assert move_cache.stats()["misses"] == 1
+        # another game in the same position
+        other = GameEngine(Board(player_down="W", create=True))
+        assert other.possible_moves(json=True) == \
+            {str(k): v for k, v in first.items()}
+        assert move_cache.stats()["hits"] == 1
+        assert move_cache.stats()["memory"] > 0
+
+    def test_key_changes(self):
+        board = self.game_engine.board
+        key = board.position_key()
+        self.game_engine.possible_moves()
+        assert board.position_key() == key
+
+        self.game_engine.move((4, 6), (4, 4), "W")
+        assert board.position_key() != key
+        # double pawn push opens en passant on that file
+        assert board.position_key()[2] == 4
+        assert len([k for i in self.game_engine.possible_moves().values()
+                    for k in i]) == 20
+        self.game_engine.undo()
+        assert board.position_key() == key
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestBatchEvaluation(unittest.TestCase):
+    def test_planes(self):
+        planes = batch_eval.to_planes([Board(player_down="W", create=True)])
+        assert planes.shape == (1, 12, 8, 8)
+        assert planes.sum() == 32
+        # white king on e1 whatever the orientation
+        assert planes[0, batch_eval.plane_index("W", "K"), 7, 4] == 1
+        flipped = batch_eval.to_planes([Board(player_down="B", create=True)])
+        assert (planes == flipped).all()
+
+    def test_evaluate(self):
+        white = GameEngine(Board(player_down="W", create=True))
+        white.move((4, 6), (4, 4), "W")
+        black = GameEngine(Board(player_down="B", create=True))
+        black.move((4, 1), (4, 3), "W")
+        no_queen = Board(player_down="W", create=True)
+        no_queen[3, 0] = None
+
+        scores = batch_eval.evaluate_boards([
+            Board(player_down="W", create=True), white.board, black.board,
+            no_queen])
+        assert scores[0] == 0
+        # e4 gains the pawn square bonus and frees the bishop and queen
+        assert scores[1] > 0
+        assert scores[1] == scores[2]
+        assert scores[3] > 800
+
+    @staticmethod
+    def _mobility(board) -> int:
+        """
+            The mobility term piece by piece, walking the squares
+        """
+        score = 0
+        for (x, y), piece in board.items():
+            if piece is None:
+                continue
+            letter = evaluation.piece_letter(piece)
+            if letter == "N":
+                rays = [[(x + dx, y + dy)]
+                        for dx, dy in batch_eval.KNIGHT_OFFSETS]
+            else:
+                directions = {"B": batch_eval.BISHOP_DIRECTIONS,
+                              "R": batch_eval.ROOK_DIRECTIONS,
+                              "Q": batch_eval.ROOK_DIRECTIONS +
+                              batch_eval.BISHOP_DIRECTIONS}.get(letter, [])
+                rays = [[(x + dx * i, y + dy * i) for i in range(1, 8)]
+                        for dx, dy in directions]
+            count = 0
+            for ray in rays:
+                for square in ray:
+                    if square not in board:
+                        break
+                    other = board[square]
+                    if other is None or other.color != piece.color:
+                        count += 1
+                    if other is not None:
+                        break
+            sign = 1 if piece.color == "W" else -1
+            score += sign * evaluation.MOBILITY[letter] * count
+        return score
+
+    def test_random_positions(self):
+        rng = random.Random(20140102)
+        boards = []
+        for n in range(0, 40):
+            engine = make_game_engine("W" if n % 2 else "B")
+            for _ in range(0, rng.randrange(0, 60)):
+                moves = engine.legal_moves()
+                if not moves:
+                    break
+                make(engine, rng.choice(moves))
+            boards.append(engine.board)
+        scores = batch_eval.evaluate_boards(boards)
+        for board, score in zip(boards, scores):
+            assert score == evaluation.evaluate(board) + \
+                self._mobility(board), board.position_key()
+
+
+class TestTaperedEvaluation(unittest.TestCase):
+    def _walk(self, engine, depth):
+        for move in engine.legal_moves():
+            make(engine, move)
+            assert engine.board.scores == board_scores(engine.board), move
+            if depth > 1:
+                self._walk(engine, depth - 1)
+            engine.unmake()
+
+    def test_incremental(self):
+        # castling, en passant and promotions
+        for fen in (TestPerft.KIWIPETE, TestPerft.PROMOTION,
+                    "4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 1"):
+            for player_down in ("W", "B"):
+                engine = engine_from_fen(fen, player_down)
+                tapered(engine.board)
+                scores = engine.board.scores
+                self._walk(engine, 2)
+                assert engine.board.scores == scores
+
+    def test_start(self):
+        for player_down in ("W", "B"):
+            board = Board.start_position(player_down)
+            assert tapered(board) == 0
+            assert tapered(board.copy()) == 0
+
+    def test_pawn_structure(self):
+        for player_down in ("W", "B"):
+            # isolated and passed on the 7th
+            board = Board.from_fen("4k3/P7/8/8/8/8/8/4K3 w - - 0 1",
+                                   player_down)
+            assert pawn_structure(board) == (50, 95)
+            # doubled, isolated, the front one passed
+            board = Board.from_fen("4k3/8/8/8/8/P7/P7/4K3 w - - 0 1",
+                                   player_down)
+            assert pawn_structure(board) == (-25, -40)
+            board = Board.from_fen("4k3/p7/p7/8/8/8/8/4K3 w - - 0 1",
+                                   player_down)
+            assert pawn_structure(board) == (25, 40)
+            # blocked by the pawn in front on the next file
+            board = Board.from_fen("4k3/1p6/8/P7/8/8/8/4K3 w - - 0 1",
+                                   player_down)
+            assert pawn_structure(board) == (0, 0)
+
+    def test_pawn_cache(self):
+        engine = engine_from_fen(TestPerft.KIWIPETE)
+        tapered(engine.board)
+        hits = pawn_cache.hits
+        # a knight move keeps the pawn structure
+        make(engine, ((2, 5), (1, 3), None))
+        tapered(engine.board)
+        assert pawn_cache.hits == hits + 1
+
+
+class TestSee(unittest.TestCase):
+    def _see(self, fen, start, end):
+        """
+            Same result with either color down, squares given white down
+        """
+        results = set()
+        for player_down in ("W", "B"):
+            board = Board.from_fen(fen, player_down)
+            flip = (lambda i: i) if player_down == "W" else \
+                (lambda i: (i[0], 7 - i[1]))
+            results.add(see(board, flip(start), flip(end)))
+        assert len(results) == 1, results
+        return results.pop()
+
+    def test_exchanges(self):
+        # pawn takes a knight defended by a pawn
+        assert self._see("4k3/8/4p3/3n4/4P3/8/8/4K3 w - - 0 1",
+                         (4, 4), (3, 3)) == 220
+        # rook takes a pawn defended by a pawn
+        assert self._see("4k3/8/2p5/3p4/8/8/3R4/4K3 w - - 0 1",
+                         (3, 6), (3, 3)) == -400
+        # undefended
+        assert self._see("4k3/8/8/3q4/8/8/3R4/4K3 w - - 0 1",
+                         (3, 6), (3, 3)) == 900
+        # the king can't take a defended rook
+        assert self._see("4k3/8/8/8/8/3r4/3r4/4K3 w - - 0 1",
+                         (4, 7), (3, 6)) == -19500
+        # en passant
+        assert self._see("4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 1",
+                         (4, 3), (3, 2)) == 100
+        # NxP NxN RxN BxR QxB QxQ, white stops after NxN losing the knight
+        assert self._see(
+            "1k1r3q/1ppn3p/p4b2/4p3/8/P2N2P1/1PP1R1BP/2K1Q3 w - - 0 1",
+            (3, 5), (4, 3)) == -220
+
+    def test_x_ray(self):
+        single = "3rk3/8/8/3p4/8/8/3R4/4K3 w - - 0 1"
+        doubled = "3rk3/8/8/3p4/8/8/3R4/3RK3 w - - 0 1"
+        assert self._see(single, (3, 6), (3, 3)) == -400
+        # the rook behind takes back
+        assert self._see(doubled, (3, 6), (3, 3)) == 100
+        board = Board.from_fen(doubled)
+        assert {repr(i) for i in attackers(board, (3, 3))} == {"wR", "bR"}
+
+    def test_quiescence_pruning(self):
+        results = [Search(engine_from_fen(TestPerft.KIWIPETE),
+                          prune_captures=prune) for prune in (False, True)]
+        full, pruned = [i.root(1) for i in results]
+        assert pruned.move == full.move and pruned.score == full.score
+        assert results[1].quiescence_nodes < results[0].quiescence_nodes
+
+
+class TestUci(unittest.TestCase):
+    def setUp(self):
+        self.lines = []
+        self.uci = UCI(self.lines.append)
+
+    def _run(self, *commands) -> list:
+        for command in commands:
+            self.uci.handle(command)
+        self.uci.wait()
+        return self.lines
+
+    def test_moves(self):
+        for name in ("e2e4", "e1g1", "e7e8q"):
+            assert move_name(parse_move(name)) == name
+        assert parse_move("e7e8n") == ((4, 1), (4, 0), "N")
+
+    def test_handshake(self):
+        assert self._run("uci", "isready")[-2:] == ["uciok", "readyok"]
+
+    def test_go_depth(self):
+        lines = self._run("position startpos moves e2e4 e7e5", "go depth 2")
+        assert [i.split()[2] for i in lines[:-1]] == ["1", "2"]
+        assert "nps" in lines[1] and " pv " in lines[1]
+        move = parse_move(lines[-1].split()[1])
+        engine = self.uci.engine
+        assert lines[-1].startswith("bestmove")
+        assert move in engine.legal_moves() and engine.board.turn == "W"
+
+    def test_mate(self):
+        lines = self._run(
+            "position fen r1bqkbnr/pppp1ppp/2n5/4p3/2B1P3/5Q2/PPPP1PPP/RNB1K1NR"
+            " w KQkq - 0 1", "go depth 2")
+        assert "score mate 1" in lines[-2]
+        assert lines[-1] == "bestmove f3f7"
+
+    def test_limits(self):
+        lines = self._run("position startpos", "go nodes 30")
+        assert lines[-1].startswith("bestmove")
+        started = time.time()
+        self._run("go movetime 200")
+        assert time.time() - started < 2
+        self.uci.handle("go infinite")
+        time.sleep(0.2)
+        assert not self.lines[-1].startswith("bestmove")
+        self.uci.handle("stop")
+        assert self.lines[-1].startswith("bestmove")
+
+    def test_bad_input(self):
+        lines = self._run("position startpos moves e2e5", "position fen x",
+                          "flip")
+        assert lines[0] == "info string illegal move e2e5"
+        assert lines[1].startswith("info string position: ")
+        assert lines[2] == "info string unknown command flip"
+
+
+class TestPgn(unittest.TestCase):
+    def _sans(self, engine, names) -> list:
+        moves = []
+        for name in names.split():
+            move = parse_move(name)
+            moves.append(san(engine, move))
+            assert make(engine, move)
+        return moves
+
+    def test_san(self):
+        engine = make_game_engine("W")
+        assert self._sans(engine, "e2e4 e7e5 g1f3 b8c6 f1b5 a7a6 b5c6 d7c6 "
+                          "e1g1 d8f6") == \
+            ["e4", "e5", "Nf3", "Nc6", "Bb5", "a6", "Bxc6", "dxc6", "O-O",
+             "Qf6"]
+        engine = make_game_engine("W")
+        assert self._sans(engine, "f2f3 e7e5 g2g4 d8h4")[-1] == "Qh4#"
+
+    def test_disambiguation(self):
+        engine = engine_from_fen("4k3/8/8/8/8/8/1P4K1/R6R w - - 0 1")
+        assert self._sans(engine, "a1d1") == ["Rad1"]
+        engine = engine_from_fen("4k3/P7/8/R7/8/8/6K1/R7 w - - 0 1")
+        assert self._sans(engine, "a1a3 e8d7 a7a8q") == ["R1a3", "Kd7", "a8=Q"]
+
+    def test_pgn(self):
+        text = pgn({"White": "a", "Result": "1-0", "Termination": "x"},
+                   ["e4", "e5"] * 30)
+        lines = text.splitlines()
+        assert lines[0] == '[Event "?"]' and lines[4] == '[White "a"]'
+        assert lines[7] == '[Termination "x"]' and lines[8] == ""
+        assert lines[9].startswith("1. e4 e5 2. e4")
+        assert all(len(i) <= 79 for i in lines) and lines[-1].endswith(" 1-0")
+        assert pgn({}, ["e5"], 1).splitlines()[-1] == "1... e5 *"
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        writer = ArchiveWriter(self.directory)
+        mate = GameEngine(Board(player_down="W", create=True))
+        for start, end in [((5, 6), (5, 5)), ((4, 1), (4, 3)),
+                           ((6, 6), (6, 4)), ((3, 0), (7, 4))]:
+            make(mate, (start, end, None))
+        self.moves = mate.history()
+        writer.add("alice", "bob", "0-1", self.moves, eco="A00", date=100)
+        writer.add("bob", "carol", "1-0", [], eco="C20", date=200)
+        writer.add("carol", "alice", "1-0", [], eco="C20", date=300)
+        writer.flush()
+        self.writer = writer
+        self.archive = Archive(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_moves(self):
+        for move in [((4, 6), (4, 4), None), ((0, 1), (0, 0), "N")]:
+            assert decode_move(encode_move(move, "B"), "B") == move
+            assert decode_move(encode_move(move, "W")) == move
+        archived = self.archive.game(0)
+        assert (archived["white"], archived["result"], archived["eco"]) == \
+            ("alice", "0-1", "A00")
+        assert archived["moves"] == self.moves
+
+    def test_query(self):
+        assert list(self.archive.by_player("alice")) == [0, 2]
+        assert list(self.archive.query(player="alice", color="W")) == [0]
+        assert list(self.archive.query(eco="C20", result="1-0")) == [1, 2]
+        assert list(self.archive.query(player="carol", eco="C20",
+                                       since=250)) == [2]
+        assert list(self.archive.query(result="1/2-1/2")) == []
+        assert len(self.archive.by_player("nobody")) == 0
+
+    def test_append(self):
+        writer = ArchiveWriter(self.directory)
+        assert writer.add("dave", "alice", "1/2-1/2", self.moves) == 3
+        writer.flush()
+        assert len(self.archive) == 3
+        self.archive.reload()
+        assert list(self.archive.by_player("alice")) == [0, 2, 3]
+        assert self.archive.game(3)["moves"] == self.moves
+
+    def test_crashed_flush(self):
+        # a writer died after appending the players and some columns
+        with open(os.path.join(self.directory, "players.txt"), "a") as f:
+            f.write("dave\nerin")
+        for name in ("moves", "white", "black"):
+            with open(os.path.join(self.directory, name), "ab") as f:
+                f.write(b"\x01\x00\x00\x00")
+        writer = ArchiveWriter(self.directory)
+        assert writer.size == 3 and writer.flushed_keys == set()
+        assert writer.add("erin", "alice", "1-0", self.moves) == 3
+        writer.flush(["a", "b"])
+        assert ArchiveWriter(self.directory).flushed_keys == {"a", "b"}
+        self.archive.reload()
+        assert self.archive.players == ["alice", "bob", "carol", "erin"]
+        assert len(self.archive.white) == len(self.archive.result) == 4
+        assert self.archive.game(3)["moves"] == self.moves
+        assert list(self.archive.by_player("erin")) == [3]
+
+    def test_analysis(self):
+        analysis = AnalysisWriter(self.directory)
+        self.assertRaises(ValueError, analysis.add, 0, 0, [1], [])
+        analysis.add(1, int(self.archive.offset[1]), [], [])
+        assert self.archive.analysis(1) is None
+        self.archive.reload()
+        assert self.archive.analysis(1) == {"scores": [], "marks": []}
+        assert self.archive.analysis(0) is None
+        analysis.add(0, 0, [10, -300, 0, -2000], [0, 3, 1, 2])
+        assert self.archive.analysis(2) is None
+        self.archive.reload()
+        assert self.archive.analysis(0) == {
+            "scores": [10, -300, 0, -2000], "marks": [None, "??", "?!", "?"]}
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestPositionIndex(unittest.TestCase):
+    # with white down
+    E4, E5, NF3, NC6 = ((4, 6), (4, 4), None), ((4, 1), (4, 3), None), \
+        ((6, 7), (5, 5), None), ((1, 0), (2, 2), None)
+    F3 = ((5, 6), (5, 5), None)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.writer = ArchiveWriter(self.directory)
+        self.index = PositionIndex(self.directory + "/positions",
+                                   max_segments=2)
+        self.add("1-0", [self.E4, self.E5, self.NF3, self.NC6])
+        self.add("0-1", [self.NF3, self.NC6, self.E4, self.E5])
+        self.add("1-0", [self.E4, self.NC6])
+        self.archive = Archive(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def add(self, result, moves):
+        game_id = self.writer.add("a", "b", result, moves)
+        self.index.add_game(game_id, moves)
+        self.writer.flush()
+        self.index.flush()
+
+    def test_next_moves(self):
+        start = Board(player_down="W", create=True)
+        assert list(self.index.games(start)) == [0, 1, 2]
+        stats = self.index.next_moves(start, self.archive)
+        assert stats[self.E4] == {"games": 2, "1-0": 2, "0-1": 0, "1/2-1/2": 0}
+        assert stats[self.NF3]["0-1"] == 1
+
+    def test_transposition(self):
+        engine = GameEngine(Board(player_down="W", create=True))
+        for move in [self.E4, self.E5, self.NF3, self.NC6]:
+            make(engine, move)
+        assert list(self.index.games(engine.board)) == [0, 1]
+        assert self.index.next_moves(engine.board) == {}
+        # the same position with black down
+        flipped = Board.from_fen(engine.board.fen(), "B")
+        assert list(self.index.games(flipped)) == [0, 1]
+
+    def test_segments(self):
+        # the three flushes were merged
+        assert len(self.index.segments) <= 2
+        assert len(self.index) == 5 + 5 + 3
+        self.add("1/2-1/2", [self.F3])
+        other = PositionIndex(self.directory + "/positions")
+        assert list(other.games(Board(player_down="W", create=True))) == \
+            [0, 1, 2, 3]
+        assert len(os.listdir(self.directory + "/positions")) == \
+            len(other.segments) + 1
+
+    def test_replayed_games(self):
+        # a flush the archive didn't get, the games come again with their ids
+        self.index.add_game(1, [self.E4])
+        self.index.add_game(3, [self.E4])
+        self.index.flush()
+        self.index = PositionIndex(self.directory + "/positions")
+        assert self.index.next_game == 4
+        self.index.add_game(3, [self.E4])
+        self.index.flush()
+        board = make_game_engine("W").board
+        assert list(self.index.games(board)) == [0, 1, 2, 3]
+        assert len(self.index.lookup(board)) == 4
+
+    def test_reload_during_merge(self):
+        self.add("1/2-1/2", [self.F3])
+        reader = PositionIndex(self.directory + "/positions")
+        stale = reader.names
+        read = reader._read_manifest
+        manifests = []
+
+        def read_manifest():
+            # the first read happens before the writer merges
+            manifests.append(stale if not manifests else read())
+            return manifests[-1]
+        reader._read_manifest = read_manifest
+        # merged with the last segment the reader knows
+        self.add("1/2-1/2", [self.F3])
+        assert not all(os.path.exists(reader._path(i)) for i in stale)
+        reader.reload()
+        assert len(manifests) == 2 and reader.names == manifests[1]
+        assert len(reader) == len(self.index)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,235 @@
+"""
+UCI adapter around GameEngine and game.search, for GUIs, match runners and
+benchmarks.
+
+    python -m game.uci
+
+Reads commands on stdin, answers on stdout:
+
+    uci, isready, ucinewgame
+    position [startpos | fen <fen>] [moves e2e4 e7e5 ...]
+    go [depth n] [nodes n] [movetime ms] [wtime ms] [btime ms] [winc ms]
+       [binc ms] [infinite]
+    stop, quit
+
+go runs an iterative deepening search in a thread. Every finished depth
+prints an info line (depth, score, nodes, nps, time, pv), every second in
+between prints the nodes and nps so far. bestmove is the move of the last
+finished depth. The transposition table is kept until ucinewgame. With
+wtime/btime a move gets 1/30 of the clock plus half the increment.
+"""
+from threading import Event, Lock, Thread, Timer
+import sys
+import time
+from game.chess import GameEngine, make_game_engine, square_name, parse_square
+from game.search import Search, TranspositionTable, engine_from_fen, make, \
+    deepen, principal_variation, MATE, MATE_BOUND
+
+NAME = "chess"
+# plain go without limits
+DEFAULT_DEPTH = 4
+MAX_DEPTH = 64
+REPORT_SECONDS = 1.0
+
+
+def move_name(move: tuple) -> str:
+    """
+        ((4, 6), (4, 4), None) -> "e2e4", white down
+    """
+    start, end, promotion = move
+    return square_name(start) + square_name(end) + \
+        (promotion.lower() if promotion else "")
+
+
+def parse_move(name: str) -> tuple:
+    promotion = name[4].upper() if len(name) > 4 else None
+    return parse_square(name[0:2]), parse_square(name[2:4]), promotion
+
+
+def score_name(score: int) -> str:
+    if abs(score) > MATE_BOUND:
+        # plies to mate -> moves, negative when getting mated
+        moves = (MATE - abs(score) + 1) // 2
+        return "mate %i" % (moves if score > 0 else -moves)
+    return "cp %i" % score
+
+
+def parse_go(args: list) -> dict:
+    """
+        {"depth": 5, "movetime": 1000, "infinite": True, ...}
+    """
+    limits = {}
+    args = iter(args)
+    for name in args:
+        if name == "infinite":
+            limits[name] = True
+        elif name in ("depth", "nodes", "movetime", "wtime", "btime", "winc",
+                      "binc", "movestogo"):
+            limits[name] = int(next(args))
+    return limits
+
+
+class UCI:
+    def __init__(self, out=None):
+        """
+        @param out: writes one line, stdout if not given
+        """
+        self.out = out if out is not None else self._print
+        self.engine = make_game_engine("W")
+        self.table = TranspositionTable()
+        self.stop = Event()
+        self.thread = None
+        self.infinite = False
+        self._out_lock = Lock()
+        self.commands = {
+            "uci": self.uci,
+            "isready": self.isready,
+            "ucinewgame": self.ucinewgame,
+            "position": self.position,
+            "go": self.go,
+            "stop": self.stop_search,
+        }
+
+    @staticmethod
+    def _print(line: str):
+        print(line, flush=True)
+
+    def send(self, line: str):
+        with self._out_lock:
+            self.out(line)
+
+    def handle(self, line: str) -> bool:
+        """
+        @return: False on quit
+        """
+        words = line.split()
+        if not words:
+            return True
+        if words[0] == "quit":
+            self.stop_search()
+            return False
+        command = self.commands.get(words[0])
+        if command is None:
+            self.send("info string unknown command %s" % words[0])
+            return True
+        try:
+            command(words[1:])
+        except Exception as e:
+            # a bad line mustn't end the session
+            self.send("info string %s: %r" % (words[0], e))
+        return True
+
+    def uci(self, args):
+        self.send("id name %s" % NAME)
+        self.send("id author %s contributors" % NAME)
+        self.send("uciok")
+
+    def isready(self, args):
+        self.send("readyok")
+
+    def ucinewgame(self, args):
+        self.stop_search()
+        self.table.clear()
+
+    def position(self, args):
+        self.stop_search()
+        moves = args.index("moves") if "moves" in args else len(args)
+        if args and args[0] == "fen":
+            engine = engine_from_fen(" ".join(args[1:moves]))
+        else:
+            engine = make_game_engine("W")
+        for name in args[moves + 1:]:
+            if not make(engine, parse_move(name)):
+                self.send("info string illegal move %s" % name)
+                break
+        self.engine = engine
+
+    def go(self, args):
+        self.stop_search()
+        limits = parse_go(args)
+        movetime = limits.get("movetime")
+        clock = limits.get("wtime" if self.engine.board.turn == "W" else
+                           "btime")
+        if movetime is None and clock is not None:
+            increment = limits.get(
+                "winc" if self.engine.board.turn == "W" else "binc", 0)
+            movetime = clock / 30 + increment / 2
+        depth = limits.get("depth")
+        if depth is None:
+            limited = movetime is not None or "nodes" in limits or \
+                limits.get("infinite")
+            depth = MAX_DEPTH if limited else DEFAULT_DEPTH
+        self.stop = Event()
+        self.infinite = limits.get("infinite", False)
+        if movetime is not None:
+            timer = Timer(movetime / 1000, self.stop.set)
+            timer.daemon = True
+            timer.start()
+        # search a copy, position may replace the engine meanwhile
+        engine = GameEngine(self.engine.board.copy())
+        self.thread = Thread(target=self._search, daemon=True, args=(
+            engine, depth, limits.get("nodes"), self.infinite, self.stop))
+        self.thread.start()
+
+    def wait(self):
+        """
+            Until the search ends by itself, an infinite one is stopped
+        """
+        if self.thread is not None:
+            if self.infinite:
+                self.stop.set()
+            self.thread.join()
+            self.thread = None
+
+    def stop_search(self, args=None):
+        if self.thread is not None:
+            self.stop.set()
+            self.thread.join()
+            self.thread = None
+
+    def _report(self, search: Search, started: float, done: Event):
+        while not done.wait(REPORT_SECONDS):
+            elapsed = time.perf_counter() - started
+            self.send("info nodes %i nps %i time %i" % (
+                search.nodes, search.nodes / elapsed, elapsed * 1000))
+
+    def _search(self, engine: GameEngine, depth: int, nodes: int,
+                infinite: bool, stop: Event):
+        search = Search(engine, self.table, stop, max_nodes=nodes)
+        started = time.perf_counter()
+        done = Event()
+        Thread(target=self._report, args=(search, started, done),
+               daemon=True).start()
+
+        def info(depth, result):
+            elapsed = time.perf_counter() - started
+            self.send("info depth %i score %s nodes %i nps %i time %i pv %s" % (
+                depth, score_name(result.score), search.nodes,
+                search.nodes / max(elapsed, 1e-6), elapsed * 1000,
+                " ".join(move_name(i) for i in principal_variation(engine, self.table, depth))))
+
+        try:
+            best = deepen(search, depth, info)
+        finally:
+            done.set()
+        if infinite:
+            # bestmove only once the GUI says stop
+            stop.wait()
+        if best is None:
+            moves = engine.legal_moves()
+            self.send("bestmove %s" % (move_name(moves[0]) if moves else "0000"))
+        else:
+            self.send("bestmove %s" % move_name(best.move))
+
+
+def main():
+    uci = UCI()
+    for line in sys.stdin:
+        if not uci.handle(line):
+            return
+    # end of input, let the last search finish
+    uci.wait()
+
+
+if __name__ == "__main__":
+    main()
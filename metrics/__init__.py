@@ -0,0 +1,246 @@
+"""
+In process timers, counters and an on demand profiler.
+Request handlers and workers record into the module level registry,
+/metrics renders it. Keep it out of the search, a timer per node costs more
+than the node.
+
+    @timed("ws.received_message")
+    def received_message(...):
+
+    with registry.timer("redis.put"):
+        ...
+
+    profiler.enable(game_id)
+    with profiler.profile(game_id):  # only profiles enabled keys
+        ...
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+import cProfile
+import io
+import pstats
+
+# bucket i counts observations below 2 ** i microseconds, the last one is +inf
+BUCKETS = 26
+
+
+class Counter(object):
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def incr(self, amount=1):
+        self.value += amount
+
+    def snapshot(self) -> dict:
+        return {"value": self.value}
+
+
+class Histogram(object):
+    """
+        Log2 buckets in microseconds, observing is O(1) without locks.
+        A lost update under contention is fine for monitoring.
+    """
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * BUCKETS
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        bucket = int(seconds * 1000000).bit_length()
+        self.buckets[bucket if bucket < BUCKETS else BUCKETS - 1] += 1
+
+    def percentile(self, p: float) -> float:
+        """
+            Upper bound of the bucket holding the p percentile, in seconds
+        """
+        rank = self.count * p / 100
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min((2 ** i) / 1000000, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {"count": self.count,
+                "sum": self.total,
+                "max": self.max,
+                "p50": self.percentile(50),
+                "p99": self.percentile(99)}
+
+
+class Registry(object):
+    def __init__(self):
+        self._lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def _get(self, store: dict, name: str, clazz):
+        item = store.get(name)
+        if item is None:
+            with self._lock:
+                item = store.setdefault(name, clazz())
+        return item
+
+    def counter(self, name: str) -> Counter:
+        return self._get(self.counters, name, Counter)
+
+    def histogram(self, name: str) -> Histogram:
+        return self._get(self.histograms, name, Histogram)
+
+    def gauge(self, name: str, func: callable):
+        """
+            func is called when rendering and must return a dict of numbers
+        """
+        self.gauges[name] = func
+
+    @contextmanager
+    def timer(self, name: str):
+        histogram = self.histogram(name)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            histogram.observe(perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        result = {}
+        for store in (self.counters, self.histograms):
+            for name, item in list(store.items()):
+                result[name] = item.snapshot()
+        for name, func in list(self.gauges.items()):
+            result[name] = func()
+        return result
+
+    def render(self) -> str:
+        """
+            One "name_field value" line per number, sorted by name
+        """
+        lines = []
+        for name, fields in sorted(self.snapshot().items()):
+            for field, value in sorted(fields.items()):
+                lines.append("%s_%s %s" % (name, field, value))
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """
+            Zero everything in place, decorated functions keep their histogram
+        """
+        with self._lock:
+            for store in (self.counters, self.histograms):
+                for item in store.values():
+                    item.__init__()
+
+
+class Profiler(object):
+    """
+        cProfile switched on per key (a game id, a request path...).
+        Disabled keys cost one set lookup. At most max_keys are enabled and
+        the stats of the max_keys last profiled are kept
+    """
+
+    def __init__(self, max_keys: int=64):
+        self.max_keys = max_keys
+        self._enabled = set()
+        self._stats = OrderedDict()
+        self._lock = Lock()
+
+    def enable(self, key: str) -> bool:
+        """
+        @return: False if max_keys are enabled already
+        """
+        with self._lock:
+            if key not in self._enabled and \
+                    len(self._enabled) >= self.max_keys:
+                return False
+            self._enabled.add(key)
+            return True
+
+    def disable(self, key: str):
+        self._enabled.discard(key)
+
+    def enabled(self, key: str) -> bool:
+        return key in self._enabled
+
+    def start(self, key: str):
+        if key not in self._enabled:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is active in this thread
+            return None
+        return profile
+
+    def stop(self, key: str, profile):
+        if profile is None:
+            return
+        profile.disable()
+        with self._lock:
+            if key in self._stats:
+                self._stats[key].add(profile)
+                self._stats.move_to_end(key)
+            else:
+                self._stats[key] = pstats.Stats(profile)
+                while len(self._stats) > self.max_keys:
+                    self._stats.popitem(last=False)
+
+    @contextmanager
+    def profile(self, key: str):
+        profile = self.start(key)
+        try:
+            yield
+        finally:
+            self.stop(key, profile)
+
+    def report(self, key: str, limit=40) -> str:
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                return ""
+            out = io.StringIO()
+            stats.stream = out
+            stats.sort_stats("cumulative").print_stats(limit)
+            return out.getvalue()
+
+    def clear(self, key: str):
+        with self._lock:
+            self._stats.pop(key, None)
+
+
+registry = Registry()
+profiler = Profiler()
+
+
+def timed(name: str):
+    """
+        Decorator recording the duration of every call in registry
+    """
+    def _timed(f):
+        histogram = registry.histogram(name)
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                histogram.observe(perf_counter() - start)
+
+        return wrapper
+
+    return _timed
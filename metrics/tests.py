@@ -0,0 +1,73 @@
+import unittest
+from metrics import Registry, Histogram, Profiler, registry, timed
+
+
+class TestHistogram(unittest.TestCase):
+    def test_observe(self):
+        histogram = Histogram()
+        for i in range(0, 99):
+            histogram.observe(0.000010)
+        histogram.observe(1)
+        snapshot = histogram.snapshot()
+        assert snapshot["count"] == 100
+        assert snapshot["max"] == 1
+        assert 0.000010 <= snapshot["p50"] <= 0.000016
+        assert snapshot["p99"] <= 0.000016
+
+
+class TestRegistry(unittest.TestCase):
+    def test_timed(self):
+        @timed("test.timed")
+        def f(x):
+            return x * 2
+
+        assert f(2) == 4
+        assert registry.snapshot()["test.timed"]["count"] >= 1
+
+    def test_render_and_reset(self):
+        _registry = Registry()
+        _registry.counter("a").incr(3)
+        _registry.gauge("b", lambda: {"size": 5})
+        with _registry.timer("c"):
+            pass
+        text = _registry.render()
+        assert "a_value 3" in text
+        assert "b_size 5" in text
+        assert "c_count 1" in text
+        _registry.reset()
+        assert _registry.snapshot()["a"]["value"] == 0
+
+
+class TestProfiler(unittest.TestCase):
+    def test_only_enabled_keys(self):
+        profiler = Profiler()
+        with profiler.profile("game"):
+            sum(range(0, 100))
+        assert profiler.report("game") == ""
+
+        profiler.enable("game")
+        with profiler.profile("game"):
+            sum(range(0, 100))
+        assert "function calls" in profiler.report("game")
+
+    def test_bounded(self):
+        profiler = Profiler(max_keys=2)
+        for key in ("a", "b", "c"):
+            assert profiler.enable(key) or key == "c"
+        profiler.enable("c")
+        assert not profiler.enabled("c")
+        profiler.disable("a")
+        profiler.enable("c")
+        for key in ("b", "c", "b"):
+            with profiler.profile(key):
+                sum(range(0, 100))
+        profiler.disable("b")
+        assert profiler.enable("a")
+        with profiler.profile("a"):
+            sum(range(0, 100))
+        # c was profiled least recently
+        assert list(profiler._stats) == ["b", "a"]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,34 +1,57 @@
-import os
+"""
+    python server.py                 everything in this process
+    python server.py --workers 4     prefork, see workers/prefork.py
+
+Prefork needs SESSION_STORAGE=redis: the socket upgrade of a player can
+land on another worker than their login.
+"""
+import argparse
+import signal
+import socket
+import sys
 import cherrypy
+from cherrypy._cpwsgi_server import CPWSGIServer
 from ws4py.server.cherrypyserver import WebSocketPlugin, WebSocketTool
 from app import settings
 from app.settings import config
-from app import root, socket_root
-from workers.queue import start_match_process
+from app.application import root, socket_root, static_root
+
+
+class ReusePortServer(CPWSGIServer):
+    """
+        Lets every worker process bind the same port, the kernel balances
+        the connections between them
+    """
 
+    def bind(self, family, type, proto=0):
+        self.socket = socket.socket(family, type, proto)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if self.nodelay and not isinstance(self.bind_addr, str):
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.ssl_adapter is not None:
+            self.socket = self.ssl_adapter.bind(self.socket)
+        self.socket.bind(self.bind_addr)
 
-def make_servers(ports: list, pool_size:int):
+
+def make_servers(ports: list, pool_size:int, reuse_port: bool=False):
     def _make(port: int):
         server = cherrypy._cpserver.Server()
         server.socket_host = "127.0.0.1"
         server.socket_port = port
         server.thread_pool = pool_size
+        if reuse_port:
+            server.httpserver = ReusePortServer(server)
         server.subscribe()
         return server
 
     return [_make(i) for i in ports]
 
 
-if __name__ == "__main__":
-    kwargs = {
-        'section': '/',
-        'dir': os.path.join(settings.current_dir, 'static')
-    }
-    static_handler = cherrypy.tools.staticdir.handler(**kwargs)
-    cherrypy.tree.mount(static_handler, '/static')
-
+def mount():
+    cherrypy.config.update(config.config)
     cherrypy.tree.mount(root)
-    cherrypy.tree.mount(None, '/static', config=config.static_config)
+    cherrypy.tree.mount(static_root, '/static', config=config.static_config)
     cherrypy.tree.mount(socket_root, "/ws", config=config.ws_config)
 
     WebSocketPlugin(cherrypy.engine).subscribe()
@@ -37,11 +60,76 @@ if __name__ == "__main__":
     cherrypy.tree.mount(root, "/")
 
     cherrypy.server.unsubscribe()
-    servers = make_servers([8080, 8081], 10)
 
-    start_match_process()
 
+def serve_worker(health_port: int):
+    """
+        One prefork worker, the public ports plus its private health port
+    """
+    mount()
+    make_servers(settings.SERVER_PORTS, settings.SERVER_THREAD_POOL,
+                 reuse_port=True)
+    make_servers([health_port], 2)
+    # SIGTERM from the supervisor stops the servers gracefully, reloads
+    # are the supervisor's job
+    handler = cherrypy.engine.signal_handler
+    handler.handlers.pop('SIGHUP', None)
+    handler.subscribe()
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
     cherrypy.engine.start()
     cherrypy.engine.block()
 
 
+def run_matcher():
+    from workers.queue import match_players
+    match_players()
+
+
+def run_archiver():
+    from workers.archive import archive_games
+    archive_games()
+
+
+def run_analyzer():
+    from workers.analysis import analyze_games
+    analyze_games()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=settings.SERVER_WORKERS,
+                        help="prefork worker processes, 0 for a single process")
+    args = parser.parse_args()
+
+    if args.workers == 0:
+        from workers.analysis import start_analysis_process
+        from workers.archive import start_archive_process
+        from workers.queue import start_match_process
+        mount()
+        make_servers(settings.SERVER_PORTS, settings.SERVER_THREAD_POOL)
+        # /metrics/profile and /metrics/report only answer here
+        make_servers([settings.SERVER_HEALTH_PORT], 2)
+        start_match_process()
+        start_archive_process()
+        start_analysis_process()
+        cherrypy.engine.start()
+        cherrypy.engine.block()
+        return
+
+    if settings.REDIS_LOCAL:
+        sys.exit("REDIS_LOCAL only works in a single process, "
+                 "run without --workers")
+    if settings.SESSION_STORAGE != "redis":
+        sys.exit("--workers needs SESSION_STORAGE=redis, %s sessions "
+                 "aren't shared between the workers" % settings.SESSION_STORAGE)
+    from workers.prefork import Supervisor
+    health_ports = range(settings.SERVER_HEALTH_PORT,
+                         settings.SERVER_HEALTH_PORT + 2 * args.workers)
+    Supervisor(serve_worker, args.workers, health_ports,
+               services=[run_matcher, run_archiver, run_analyzer],
+               interval=settings.SERVER_HEALTH_INTERVAL,
+               max_failures=settings.SERVER_HEALTH_FAILURES).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,18 @@
 __author__ = 'foobar'
+
+from multiprocessing import Process
+from threading import Thread
+from app.settings import REDIS_LOCAL
+
+
+def start_process(target):
+    """
+        Run target in its own process, or in a daemon thread with
+        REDIS_LOCAL: the local redis stand-in only lives in this process
+    """
+    if REDIS_LOCAL:
+        p = Thread(target=target, daemon=True)
+    else:
+        p = Process(target=target)
+    p.start()
+    return p
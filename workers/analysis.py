@@ -0,0 +1,164 @@
+"""
+Analysis of the archived games, in the background.
+
+The archive worker queues every game it flushed on queue:analysis, a sorted
+set by game id: the most recent games are analyzed first and a backlog only
+delays the old ones. Every position of a game is searched to ANALYSIS_DEPTH,
+in at most ANALYSIS_NODES nodes. A move scoring INACCURACY, MISTAKE or
+BLUNDER centipawns less than the best move of the position before it gets
+that mark. The scores and marks are stored in the archive next to the game,
+see AnalysisWriter.
+
+The results go to the shared AnalysisCache, so the openings most games share
+are searched once on all the nodes. The analyzer must not slow down the live
+games: it runs in its own niced process, and after every search it sleeps so
+that it's busy at most ANALYSIS_DUTY of the time.
+"""
+import os
+import time
+from app.settings import ARCHIVE_PATH, ANALYSIS_DEPTH, ANALYSIS_NODES, \
+    ANALYSIS_DUTY, ANALYSIS_NICE, ANALYSIS_CACHE_SIZE, ANALYSIS_CACHE_TTL
+from common import AnalysisCache, RedisPriorityQueue
+from game.archive import Archive, AnalysisWriter
+from game.chess import make_game_engine
+from game.search import Search, TranspositionTable, deepen, make, \
+    principal_variation
+from metrics import registry
+from workers import start_process
+from workers.archive import ANALYSIS_QUEUE
+
+# losses in centipawns, the marks are MARKS[1:] of game.archive
+INACCURACY, MISTAKE, BLUNDER = 50, 100, 300
+# scores are clamped to this, a mate is a won position like any other
+SCORE_LIMIT = 2000
+POLL_SECONDS = 1.0
+
+analysis_cache = AnalysisCache(max_size=ANALYSIS_CACHE_SIZE,
+                               ttl=ANALYSIS_CACHE_TTL)
+
+
+def mark(loss: int) -> int:
+    """
+        Index in MARKS of a move losing loss centipawns
+    """
+    return sum(loss >= i for i in (INACCURACY, MISTAKE, BLUNDER))
+
+
+class Pace:
+    """
+        Called after every piece of work, sleeps so the work takes at most
+        duty of the time
+    """
+
+    def __init__(self, duty: float, clock=time.monotonic, sleep=time.sleep):
+        self.duty = duty
+        self.clock = clock
+        self.sleep = sleep
+        self.started = clock()
+
+    def __call__(self):
+        if self.duty < 1:
+            busy = self.clock() - self.started
+            self.sleep(busy * (1 - self.duty) / self.duty)
+        self.started = self.clock()
+
+
+def evaluate(engine, depth: int, nodes: int, table: TranspositionTable,
+             cache: AnalysisCache=analysis_cache) -> int:
+    """
+        Score of the position for the side to move, searched to depth in at
+        most nodes nodes unless the cache has it
+    """
+    outcome = engine.outcome()
+    if outcome is not None:
+        return 0 if outcome[0] == "1/2-1/2" else -SCORE_LIMIT
+    key = engine.board.position_key()
+    entry = cache.get(key, depth)
+    if entry is not None:
+        score = entry.score
+    else:
+        search = Search(engine, table, max_nodes=nodes)
+        finished = []
+        result = deepen(search, depth, lambda i, _: finished.append(i))
+        if result is None:
+            # the budget didn't even finish depth 1
+            score = search.evaluate()
+        else:
+            score = result.score
+            # a result cut short by the budget is only good for less depth
+            cache.put(key, finished[-1], score, result.move,
+                      principal_variation(engine, table, finished[-1]))
+    return max(-SCORE_LIMIT, min(SCORE_LIMIT, score))
+
+
+def analyze_game(moves: list, depth: int=ANALYSIS_DEPTH,
+                 nodes: int=ANALYSIS_NODES,
+                 cache: AnalysisCache=analysis_cache, pace=None) -> tuple:
+    """
+    @param moves: (start, end, promotion) with white down, from the start
+    @param pace: called after every position
+    @return: (scores, marks) per move, the scores in centipawns for white
+        after the move, the marks indexes in MARKS
+    """
+    engine = make_game_engine("W")
+    table = TranspositionTable()
+    # for the side to move
+    before = evaluate(engine, depth, nodes, table, cache)
+    scores, marks = [], []
+    for move in moves:
+        white = engine.board.turn == "W"
+        if not make(engine, move):
+            raise ValueError("Illegal move %s" % (move, ))
+        # for the side that moved
+        after = -evaluate(engine, depth, nodes, table, cache)
+        scores.append(after if white else -after)
+        marks.append(mark(before - after))
+        before = -after
+        if pace is not None:
+            pace()
+    return scores, marks
+
+
+def analyze_next(queue: RedisPriorityQueue, archive: Archive,
+                 writer: AnalysisWriter, depth: int=ANALYSIS_DEPTH,
+                 nodes: int=ANALYSIS_NODES,
+                 cache: AnalysisCache=analysis_cache, pace=None) -> int:
+    """
+        Analyze the most recent game queued
+    @return: its id, None if the queue was empty
+    """
+    entry = queue.get_nowait()
+    if entry is None:
+        return None
+    game_id = int(entry)
+    if game_id >= len(archive):
+        archive.reload()
+    with registry.timer("analysis.game"):
+        scores, marks = analyze_game(archive.game_moves(game_id), depth,
+                                     nodes, cache, pace)
+    writer.add(game_id, int(archive.offset[game_id]), scores, marks)
+    registry.counter("analysis.games").incr()
+    registry.counter("analysis.blunders").incr(marks.count(3))
+    return game_id
+
+
+def analyze_games(path: str=ARCHIVE_PATH, depth: int=ANALYSIS_DEPTH,
+                  nodes: int=ANALYSIS_NODES, duty: float=ANALYSIS_DUTY,
+                  niceness: int=ANALYSIS_NICE):
+    if niceness:
+        # in the REDIS_LOCAL thread linux only nices this thread
+        os.nice(niceness)
+    queue = RedisPriorityQueue(ANALYSIS_QUEUE)
+    registry.gauge("analysis.queue", queue.qsize)
+    archive = Archive(path)
+    writer = AnalysisWriter(path)
+    pace = Pace(duty)
+    while True:
+        if analyze_next(queue, archive, writer, depth, nodes,
+                        pace=pace) is None:
+            time.sleep(POLL_SECONDS)
+            pace.started = pace.clock()
+
+
+def start_analysis_process():
+    return start_process(analyze_games)
@@ -0,0 +1,110 @@
+"""
+Moves finished games from the redis queue into the columnar archive.
+
+The server processes put every finished game on queue:finished_games as
+json, this worker is the archive's only writer. The entries it took stay in
+queue:finished_games:processing until their games are flushed, a restarted
+worker queues them again. Games are flushed in batches
+so the posting lists are rebuilt at most every ARCHIVE_FLUSH_SECONDS. The
+positions of every game go to the position index in <archive>/positions.
+Flushed games are queued for workers/analysis.py, newest first.
+"""
+import hashlib
+import json
+import os
+import time
+from app.settings import ARCHIVE_PATH, ARCHIVE_FLUSH_SECONDS
+from common import ReliableQueue, RedisPriorityQueue
+from game.archive import ArchiveWriter
+from game.positions import PositionIndex, game_records
+from game.chess import parse_square, square_name
+from metrics import registry
+from workers import start_process
+
+FINISHED_QUEUE = "finished_games"
+# archived game ids by id, the analyzer takes the highest first
+ANALYSIS_QUEUE = "analysis"
+
+
+def finished_game(game, date: float=None) -> str:
+    """
+        Queue entry of a finished GameEngine
+    """
+    player_down = game.board.player_down
+    return json.dumps({
+        "white": game.players["W"],
+        "black": game.players["B"],
+        "result": game.result,
+        "date": time.time() if date is None else date,
+        "moves": [[square_name(start, player_down), square_name(end, player_down),
+                   promotion] for start, end, promotion in game.history()],
+    })
+
+
+def entry_key(entry) -> str:
+    """
+        Identifies a queue entry in ArchiveWriter.flushed_keys
+    """
+    if isinstance(entry, str):
+        entry = entry.encode("utf-8")
+    return hashlib.sha1(entry).hexdigest()
+
+
+def add_game(writer: ArchiveWriter, entry, positions: PositionIndex=None) -> int:
+    """
+        Add a queue entry to the archive and the position index. An entry
+        that can't be read or replayed raises ValueError or KeyError and
+        leaves both as they were
+    """
+    game = json.loads(entry)
+    moves = [(parse_square(start), parse_square(end), promotion)
+             for start, end, promotion in game["moves"]]
+    # replayed before the archive gets the game, it may have illegal moves
+    records = game_records(writer.size, moves) if positions is not None \
+        else None
+    game_id = writer.add(game["white"], game["black"], game["result"], moves,
+                         eco=game.get("eco"), date=game["date"])
+    if records is not None:
+        positions.add(records)
+    return game_id
+
+
+def archive_games(path: str=ARCHIVE_PATH,
+                  flush_seconds: float=ARCHIVE_FLUSH_SECONDS):
+    queue = ReliableQueue(FINISHED_QUEUE)
+    # the games of a worker that died before its flush
+    registry.counter("archive.recovered").incr(queue.recover())
+    analysis_queue = RedisPriorityQueue(ANALYSIS_QUEUE)
+    writer = ArchiveWriter(path)
+    positions = PositionIndex(os.path.join(path, "positions"))
+    pending, keys = [], []
+    flushed = time.monotonic()
+    while True:
+        entry = queue.get(timeout=max(1, int(flush_seconds)))
+        if entry is not None and entry_key(entry) in writer.flushed_keys:
+            # archived by a worker that died before queue.done
+            registry.counter("archive.duplicates").incr()
+        elif entry is not None:
+            try:
+                pending.append(add_game(writer, entry, positions))
+                keys.append(entry_key(entry))
+            except (ValueError, KeyError, TypeError) as e:
+                # a bad entry mustn't take the games batched with it down
+                registry.counter("archive.errors").incr()
+                print("dropped archive entry %r: %s" % (entry[:200], e))
+        if pending and time.monotonic() - flushed >= flush_seconds:
+            with registry.timer("archive.flush"):
+                positions.flush()
+                writer.flush(keys)
+            # the entries stay in the processing list until they're flushed
+            queue.done()
+            # only flushed games can be read
+            for game_id in pending:
+                analysis_queue.put(str(game_id), game_id)
+            registry.counter("archive.games").incr(len(pending))
+            pending, keys = [], []
+            flushed = time.monotonic()
+
+
+def start_archive_process():
+    return start_process(archive_games)
@@ -0,0 +1,173 @@
+"""
+Flag fall for every game of a worker, driven by one timer wheel thread.
+
+The wheel is an array of slots, one per tick. A timer goes in the slot of
+its deadline modulo the number of slots, so schedule and cancel are O(1)
+whatever the number of games. Every tick the thread fires the timers of one
+slot that are due on that tick, timers a whole wheel turn away stay for
+the next round. Timers fire at most one tick late.
+"""
+import time
+from threading import Lock, Thread, Event
+from metrics import registry
+
+
+class Timer:
+    __slots__ = ("deadline", "tick", "callback", "args", "slot", "cancelled")
+
+    def __init__(self, deadline: float, tick: int, callback, args: tuple,
+                 slot: set):
+        self.deadline = deadline
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.slot = slot
+        self.cancelled = False
+
+
+class TimerWheel:
+    def __init__(self, tick: float=0.002, slots: int=1024, clock=time.monotonic):
+        """
+        @param tick: seconds per slot, how late a timer may fire
+        @param slots: the wheel turns every tick * slots seconds
+        """
+        self.tick = tick
+        self.clock = clock
+        self._wheel = [set() for _ in range(0, slots)]
+        self._origin = clock()
+        # ticks already processed
+        self._ticks = 0
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(slot) for slot in self._wheel)
+
+    def schedule(self, deadline: float, callback, *args) -> Timer:
+        """
+            Call callback(*args) from the wheel thread once deadline passed
+        @param deadline: time as returned by the wheel's clock
+        """
+        with self._lock:
+            tick = max(int((deadline - self._origin) / self.tick), self._ticks)
+            slot = self._wheel[tick % len(self._wheel)]
+            timer = Timer(deadline, tick, callback, args, slot)
+            slot.add(timer)
+        return timer
+
+    def cancel(self, timer: Timer):
+        with self._lock:
+            timer.cancelled = True
+            timer.slot.discard(timer)
+
+    def advance(self, now: float=None) -> int:
+        """
+            Fire the timers of every tick completed by now
+        @return: number of timers fired
+        """
+        now = self.clock() if now is None else now
+        due = []
+        with self._lock:
+            completed = int((now - self._origin) / self.tick)
+            while self._ticks < completed:
+                slot = self._wheel[self._ticks % len(self._wheel)]
+                expired = [i for i in slot if i.tick <= self._ticks]
+                self._ticks += 1
+                for timer in expired:
+                    slot.discard(timer)
+                due.extend(expired)
+        for timer in due:
+            timer.callback(*timer.args)
+        return len(due)
+
+    def run(self):
+        while not self._stop.is_set():
+            fired = self.advance()
+            if fired:
+                registry.counter("clocks.fired").incr(fired)
+            self._stop.wait(self.tick)
+
+    def start(self) -> Thread:
+        self._thread = Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+class FlagScheduler:
+    """
+        Keeps one flag fall timer per running clock
+    """
+
+    def __init__(self, on_flag, wheel: TimerWheel=None):
+        """
+        @param on_flag: called with (game_id, color) when a player runs out of time
+        """
+        self.on_flag = on_flag
+        self.wheel = wheel if wheel is not None else TimerWheel()
+        self.clocks = {}
+        self._timers = {}
+        self._lock = Lock()
+        registry.gauge("clocks", lambda: {"games": len(self.clocks)})
+
+    def __contains__(self, game_id):
+        return game_id in self.clocks
+
+    def start(self, game_id: str, clock):
+        """
+            Start the clock of the game and watch it
+        @param clock: game.clock.Clock
+        """
+        clock.start(self.wheel.clock())
+        with self._lock:
+            self.clocks[game_id] = clock
+            self._reschedule(game_id)
+
+    def moved(self, game_id: str) -> bool:
+        """
+            Press the clock of the game after a move
+        @return: False if the player ran out of time
+        """
+        with self._lock:
+            clock = self.clocks[game_id]
+            pressed = clock.press(self.wheel.clock())
+            if pressed:
+                self._reschedule(game_id)
+        return pressed
+
+    def expired(self, game_id: str) -> bool:
+        clock = self.clocks.get(game_id)
+        return clock is not None and clock.expired(self.wheel.clock())
+
+    def remove(self, game_id: str):
+        with self._lock:
+            self.clocks.pop(game_id, None)
+            entry = self._timers.pop(game_id, None)
+        if entry is not None:
+            self.wheel.cancel(entry[1])
+
+    def _reschedule(self, game_id: str):
+        entry = self._timers.pop(game_id, None)
+        if entry is not None:
+            self.wheel.cancel(entry[1])
+        clock = self.clocks[game_id]
+        token = object()
+        timer = self.wheel.schedule(
+            clock.deadline(), self._flag, game_id, clock, token)
+        self._timers[game_id] = (token, timer)
+
+    def _flag(self, game_id: str, clock, token):
+        with self._lock:
+            # moved or removed while the timer was firing
+            entry = self._timers.get(game_id)
+            if entry is None or entry[0] is not token or clock.flagged:
+                return
+            clock.flag()
+            self._timers.pop(game_id, None)
+        self.on_flag(game_id, clock.flagged)
@@ -0,0 +1,201 @@
+"""
+Prefork supervisor, N server processes accepting on the same ports.
+
+    supervisor = Supervisor(serve_worker, 4, health_ports=range(9100, 9108))
+    supervisor.run()
+
+Every worker binds the public ports with SO_REUSEPORT, the kernel spreads the
+connections between them so each has its own GIL. A worker also serves
+/metrics/health on a private 127.0.0.1 port, the supervisor polls it and
+replaces a worker that died or failed too many checks in a row.
+
+Signals to the supervisor:
+    SIGHUP           rolling restart, one worker at a time the replacement is
+                     started and must answer its health check before the old
+                     one gets SIGTERM and finishes its requests
+    SIGTERM, SIGINT  stop every worker and exit
+
+Workers are started with the spawn method: they import the application
+themselves instead of inheriting the supervisor's threads and connections.
+"""
+import json
+import signal
+import time
+from multiprocessing import get_context
+from urllib.error import URLError
+from urllib.request import urlopen
+
+HEALTH_PATH = "/metrics/health"
+
+
+class Worker:
+    __slots__ = ("process", "health_port", "started", "failures")
+
+    def __init__(self, process, health_port: int):
+        self.process = process
+        self.health_port = health_port
+        self.started = time.monotonic()
+        # health checks failed in a row
+        self.failures = 0
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+
+def check_health(port: int, timeout: float=1.0) -> dict:
+    """
+    @return: the worker's health report, None if it didn't answer
+    """
+    url = "http://127.0.0.1:%i%s" % (port, HEALTH_PATH)
+    try:
+        with urlopen(url, timeout=timeout) as response:
+            return json.loads(response.read().decode("utf-8"))
+    except (URLError, OSError, ValueError):
+        return None
+
+
+class Supervisor:
+    def __init__(self, target, workers: int, health_ports, services=(),
+                 interval: float=2.0, max_failures: int=3,
+                 start_timeout: float=30.0, stop_timeout: float=30.0):
+        """
+        @param target: called as target(health_port) in every worker process
+        @param health_ports: at least two per worker, a replacement runs
+            beside the worker it replaces during a rolling restart
+        @param services: functions run once in their own process, restarted
+            when they exit, like the matcher
+        @param interval: seconds between health checks
+        @param max_failures: failed checks in a row before a worker is replaced
+        """
+        self.health_ports = list(health_ports)
+        if len(self.health_ports) < 2 * workers:
+            raise ValueError("Need %i health ports, got %i"
+                             % (2 * workers, len(self.health_ports)))
+        self.target = target
+        self.size = workers
+        self.interval = interval
+        self.max_failures = max_failures
+        self.start_timeout = start_timeout
+        self.stop_timeout = stop_timeout
+        self.workers = []
+        self.services = {i: None for i in services}
+        self.restarts = 0
+        self._context = get_context("spawn")
+        self._reload = False
+        self._running = False
+
+    def _free_port(self) -> int:
+        used = {i.health_port for i in self.workers}
+        return next(i for i in self.health_ports if i not in used)
+
+    def spawn(self) -> Worker:
+        port = self._free_port()
+        process = self._context.Process(
+            target=self.target, args=(port,), daemon=False)
+        process.start()
+        worker = Worker(process, port)
+        self.workers.append(worker)
+        return worker
+
+    def _start_services(self):
+        for target, process in self.services.items():
+            if process is None or not process.is_alive():
+                process = self._context.Process(target=target)
+                process.start()
+                self.services[target] = process
+
+    def stop_worker(self, worker: Worker):
+        """
+            SIGTERM lets the worker finish its requests, killed if it
+            doesn't exit within stop_timeout
+        """
+        if worker in self.workers:
+            self.workers.remove(worker)
+        worker.process.terminate()
+        worker.process.join(self.stop_timeout)
+        if worker.process.is_alive():
+            worker.process.kill()
+            worker.process.join()
+
+    def wait_healthy(self, worker: Worker) -> bool:
+        deadline = time.monotonic() + self.start_timeout
+        while time.monotonic() < deadline and worker.process.is_alive():
+            if check_health(worker.health_port) is not None:
+                return True
+            time.sleep(0.2)
+        return False
+
+    def check(self):
+        """
+            Replace dead and unhealthy workers, start missing ones
+        """
+        for worker in list(self.workers):
+            if not worker.process.is_alive():
+                print("worker %i exited with %s" % (
+                    worker.pid, worker.process.exitcode))
+                self.workers.remove(worker)
+                continue
+            if check_health(worker.health_port) is not None:
+                worker.failures = 0
+            # a new worker has start_timeout to come up
+            elif time.monotonic() - worker.started >= self.start_timeout:
+                worker.failures += 1
+                if worker.failures >= self.max_failures:
+                    print("worker %i failed %i health checks" % (
+                        worker.pid, worker.failures))
+                    self.stop_worker(worker)
+        while len(self.workers) < self.size:
+            self.restarts += 1
+            self.spawn()
+        self._start_services()
+
+    def rolling_restart(self):
+        """
+            Replace the workers one by one, there are always at least
+            size workers accepting connections
+        """
+        for old in list(self.workers):
+            new = self.spawn()
+            if not self.wait_healthy(new):
+                print("worker %i didn't start, keeping %i" % (new.pid, old.pid))
+                self.stop_worker(new)
+                return False
+            self.stop_worker(old)
+        return True
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def _on_stop(self, signum, frame):
+        self._running = False
+
+    def stop(self):
+        self._running = False
+        processes = [i.process for i in self.workers] + \
+            [i for i in self.services.values() if i is not None]
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(self.stop_timeout)
+            if process.is_alive():
+                process.kill()
+        self.workers = []
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        self._running = True
+        for _ in range(0, self.size):
+            self.spawn()
+        self._start_services()
+        try:
+            while self._running:
+                time.sleep(self.interval)
+                if self._reload:
+                    self._reload = False
+                    self.rolling_restart()
+                self.check()
+        finally:
+            self.stop()
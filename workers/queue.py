@@ -1,26 +1,59 @@
+import json
 import time
 from uuid import uuid4
-from redis import StrictRedis
-from app.settings import REDIS_QUEUE_KWARGS
-from common import RedisQueue
-from multiprocessing import Process
+from app.settings import MATCH_RATING_WINDOW, QUEUE_TTL
+from common import RedisQueue, Ratings, Presence, redis_client
+from metrics import registry
+from workers import start_process
 
+QUEUE = "all_players"
+# wakes the join_queue thread of a dropped entry, it frees its channel
+CANCELLED = json.dumps({"cancelled": True})
+
+
+def reap_queue(queue: RedisQueue, presence: Presence, ratings: Ratings,
+               _redis) -> int:
+    """
+        Drop the queued channels the heartbeat stopped refreshing. Only
+        entries still in the queue are cancelled, a channel matched
+        meanwhile gets its game
+    @return: entries dropped
+    """
+    reaped = 0
+    for channel in presence.stale():
+        if queue.remove(channel):
+            ratings.unqueue(channel)
+            _redis.publish(channel, CANCELLED)
+            reaped += 1
+        presence.forget(channel)
+    if reaped:
+        registry.counter("matchmaker.reaped").incr(reaped)
+    return reaped
 
 
 def match_players():
-    queue = RedisQueue("all_players")
-    _redis = StrictRedis(**REDIS_QUEUE_KWARGS)
+    queue = RedisQueue(QUEUE)
+    ratings = Ratings()
+    presence = Presence(QUEUE, QUEUE_TTL)
+    _redis = redis_client()
     while True:
+        # same thread as the matching, an entry is either matched or reaped
+        reap_queue(queue, presence, ratings, _redis)
         if queue.qsize() < 2:
             time.sleep(0.5)
             continue
 
-        left, right = queue.get(), queue.get()
+        # the longest waiting player gets the closest rated opponent
+        left = queue.get()
+        right = ratings.nearest(left, MATCH_RATING_WINDOW)
+        if right is None or not queue.remove(right):
+            right = queue.get()
+        ratings.unqueue(left, right)
+        presence.forget(left, right)
         game_id = str(uuid4())
-        _redis.publish(left, game_id)
-        _redis.publish(right, game_id)
+        _redis.publish(left, json.dumps({"game": game_id, "color": "W"}))
+        _redis.publish(right, json.dumps({"game": game_id, "color": "B"}))
 
 
 def start_match_process():
-    p = Process(target=match_players)
-    p.start()
+    return start_process(match_players)
@@ -0,0 +1,64 @@
+"""
+Rebuild every rating from the finished games, oldest first.
+
+    python -m workers.ratings games.txt
+
+games.txt has one game per line: "white black result", result being 1-0,
+0-1 or 1/2-1/2. The ratings are computed in memory and written in one
+pipeline, the leaderboard is swapped with a rename so readers never see a
+half built one.
+"""
+import argparse
+from collections import defaultdict
+from common import Ratings
+from game.rating import DEFAULT_RATING, update
+
+
+def _new_player() -> dict:
+    return {"rating": DEFAULT_RATING, "games": 0, "wins": 0, "losses": 0,
+            "draws": 0}
+
+
+def recompute(games, ratings: Ratings=None) -> dict:
+    """
+    @param games: iterable of (white, black, result) in the order played
+    @param ratings: Ratings to replace, nothing is written if None
+    @return: {player: {"rating": .., "games": .., ...}}
+    """
+    players = defaultdict(_new_player)
+    for white, black, result in games:
+        w, b = players[white], players[black]
+        w["rating"], b["rating"] = update(
+            w["rating"], b["rating"], result, w["games"], b["games"])
+        w["games"] += 1
+        b["games"] += 1
+        if result == "1/2-1/2":
+            w["draws"] += 1
+            b["draws"] += 1
+        else:
+            winner, loser = (w, b) if result == "1-0" else (b, w)
+            winner["wins"] += 1
+            loser["losses"] += 1
+    players = dict(players)
+    if ratings is not None:
+        ratings.replace_all(players)
+    return players
+
+
+def read_games(path: str):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield tuple(line.split())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("games", help="file with one 'white black result' per line")
+    args = parser.parse_args()
+    players = recompute(read_games(args.games), Ratings())
+    print("%i players rated" % len(players))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from game.clock import Clock
+from workers.clocks import TimerWheel, FlagScheduler
+from game.archive import Archive, ArchiveWriter, AnalysisWriter
+from game.positions import PositionIndex
+from game.chess import make_game_engine
+from game.uci import parse_move
+from workers.analysis import Pace, analyze_next, mark, BLUNDER
+from workers.archive import add_game, entry_key, finished_game
+from workers.prefork import Supervisor, check_health
+from workers.queue import reap_queue
+from workers.ratings import recompute
+from workers.tournament import Match, parse_engine, random_openings, run
+from common import LocalRedis, Ratings, Presence, RedisQueue, \
+    RedisPriorityQueue, WebSocketPubSubPool, AnalysisCache
+from metrics import registry
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.time = FakeTime()
+        self.wheel = TimerWheel(tick=0.01, slots=8, clock=self.time)
+        self.fired = []
+
+    def test_fire_and_cancel(self):
+        self.wheel.schedule(100.05, self.fired.append, "a")
+        timer = self.wheel.schedule(100.05, self.fired.append, "b")
+        self.wheel.cancel(timer)
+        self.wheel.advance(100.04)
+        assert self.fired == []
+        self.wheel.advance(100.065)
+        assert self.fired == ["a"]
+        assert len(self.wheel) == 0
+
+    def test_later_rounds(self):
+        # the wheel turns every 0.08s
+        self.wheel.schedule(100.25, self.fired.append, "late")
+        self.wheel.schedule(100.01, self.fired.append, "soon")
+        self.wheel.advance(100.1)
+        assert self.fired == ["soon"]
+        self.wheel.advance(100.27)
+        assert self.fired == ["soon", "late"]
+
+    def test_past_deadline(self):
+        self.wheel.advance(100.5)
+        self.wheel.schedule(100.0, self.fired.append, "past")
+        self.wheel.advance(100.52)
+        assert self.fired == ["past"]
+
+
+class TestFlagScheduler(unittest.TestCase):
+    def setUp(self):
+        self.time = FakeTime()
+        self.flagged = []
+        self.flags = FlagScheduler(
+            lambda *args: self.flagged.append(args),
+            TimerWheel(tick=0.01, slots=64, clock=self.time))
+
+    def test_flag_fall(self):
+        self.flags.start("game", Clock(1, increment=0.5))
+        self.time.now += 0.8
+        assert self.flags.moved("game")
+        # black moves in time, white has 0.7s left
+        self.time.now += 0.9
+        assert self.flags.moved("game")
+        self.time.now += 0.65
+        self.flags.wheel.advance()
+        assert self.flagged == []
+        self.time.now += 0.1
+        self.flags.wheel.advance()
+        assert self.flagged == [("game", "W")]
+        assert not self.flags.moved("game")
+
+    def test_remove(self):
+        self.flags.start("game", Clock(1))
+        self.flags.remove("game")
+        self.time.now += 2
+        self.flags.wheel.advance()
+        assert self.flagged == []
+
+
+class TestRecompute(unittest.TestCase):
+    def test_replace(self):
+        ratings = Ratings(client=LocalRedis())
+        ratings.record_game("old", "a", "1-0")
+        players = recompute(
+            [("a", "b", "1-0"), ("b", "a", "0-1"), ("a", "c", "1/2-1/2")],
+            ratings)
+        assert players["a"]["games"] == 3
+        assert ratings.get("a")["wins"] == 2
+        assert ratings.rank("a") == 1
+        assert ratings.rank("old") is None
+        assert len(ratings.top()) == 3
+
+
+class TestReapQueue(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeTime()
+        # the one the pool subscribes with
+        self.redis = LocalRedis()
+        self.queue = RedisQueue("reap_test", client=self.redis)
+        self.ratings = Ratings("reap_test", self.redis)
+        self.presence = Presence("reap_test", 30, self.redis, self.clock)
+        self.pool = WebSocketPubSubPool("reap_test", 2, client=self.redis)
+
+    def _queue(self, channel):
+        self.presence.touch(channel)
+        self.ratings.queue(channel, 1500)
+        self.queue.put(channel)
+
+    def test_reap(self):
+        ghost, pubsub = self.pool.join()
+        live = self.pool.join()[0]
+        self._queue(ghost)
+        self._queue(live)
+        self.clock.now = 120
+        self.presence.touch(live)
+        assert reap_queue(self.queue, self.presence, self.ratings, self.redis) == 0
+        self.clock.now = 140
+        assert reap_queue(self.queue, self.presence, self.ratings, self.redis) == 1
+        assert self.queue.qsize() == 1
+        # wakes the waiting join_queue
+        msg = self.pool.next_message(ghost, pubsub)
+        assert json.loads(msg["data"].decode("utf-8")) == {"cancelled": True}
+        assert self.ratings.nearest(live, 1000) is None
+        assert self.presence.stale() == []
+
+    def test_matched_not_cancelled(self):
+        channel = self.pool.join()[0]
+        self._queue(channel)
+        # the matcher took it
+        self.queue.get()
+        self.clock.now = 140
+        assert reap_queue(self.queue, self.presence, self.ratings, self.redis) == 0
+        assert self.presence.stale() == []
+
+
+class TestArchiveQueue(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        # black down, the archive doesn't depend on the orientation
+        game = make_game_engine("B")
+        game.join_game("alice", "W")
+        game.join_game("bob", "B")
+        game.move((4, 1), (4, 3), "W")
+        game.finish("1-0", "time")
+        writer = ArchiveWriter(self.directory)
+        assert add_game(writer, finished_game(game, date=10)) == 0
+        writer.flush()
+        archived = Archive(self.directory).game(0, player_down="B")
+        assert (archived["white"], archived["result"], archived["date"]) == \
+            ("alice", "1-0", 10)
+        assert archived["moves"] == game.history()
+
+    def test_bad_entry(self):
+        writer = ArchiveWriter(self.directory)
+        positions = PositionIndex(os.path.join(self.directory, "positions"))
+        entry = {"white": "alice", "black": "bob", "result": "1-0",
+                 "date": 10, "moves": [["e2", "e4", None], ["e4", "e6", None]]}
+        with self.assertRaises(ValueError):
+            add_game(writer, json.dumps(entry), positions)
+        entry["moves"] = [["e2", "e4", None]]
+        with self.assertRaises(ValueError):
+            add_game(writer, json.dumps(dict(entry, result="?")), positions)
+        # nothing half added, the next game gets id 0
+        assert add_game(writer, json.dumps(entry), positions) == 0
+        writer.flush()
+        positions.flush()
+        assert len(Archive(self.directory)) == 1 and len(positions) == 2
+
+    def test_flushed_keys(self):
+        entry = json.dumps({"white": "alice", "black": "bob", "result": "1-0",
+                            "date": 10, "moves": [["e2", "e4", None]]})
+        writer = ArchiveWriter(self.directory)
+        add_game(writer, entry)
+        writer.flush([entry_key(entry)])
+        # a recovered entry in redis' bytes is known to the next writer
+        assert entry_key(entry.encode("utf-8")) in \
+            ArchiveWriter(self.directory).flushed_keys
+
+
+class TestAnalysis(unittest.TestCase):
+    MATE = "e2e4 e7e5 f1c4 b8c6 d1h5 g8f6 h5f7"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_mark(self):
+        assert [mark(i) for i in (-20, 0, 49, 50, 150, BLUNDER)] == \
+            [0, 0, 0, 1, 2, 3]
+
+    def test_pace(self):
+        clock, slept = FakeTime(), []
+        pace = Pace(0.25, clock, slept.append)
+        clock.now += 2
+        pace()
+        assert slept == [6]
+        pace = Pace(1, clock, slept.append)
+        clock.now += 2
+        pace()
+        assert slept == [6]
+
+    def test_analyze_next(self):
+        writer = ArchiveWriter(self.directory)
+        for names in (self.MATE.split()[:2], self.MATE.split()):
+            writer.add("alice", "bob", "1-0", [parse_move(i) for i in names])
+        writer.flush()
+        archive = Archive(self.directory)
+        analysis = AnalysisWriter(self.directory)
+        queue = RedisPriorityQueue("analysis", client=LocalRedis())
+        queue.put("0", 0)
+        queue.put("1", 1)
+        cache = AnalysisCache("test_analysis", client=LocalRedis())
+        misses = registry.counter("test_analysis.misses")
+        # the newest game first, the positions of the older one are cached.
+        # No node budget, a search cut short is only cached for less depth
+        assert analyze_next(queue, archive, analysis, 2, None, cache) == 1
+        searched = misses.value
+        assert analyze_next(queue, archive, analysis, 2, None, cache) == 0
+        assert misses.value == searched
+        assert analyze_next(queue, archive, analysis, 2, None, cache) is None
+        archive.reload()
+        game = archive.analysis(1)
+        # 3... Nf6 allows mate
+        assert game["marks"][5] == "??" and game["scores"][-1] == 2000
+        assert archive.analysis(0)["scores"] == game["scores"][:2]
+
+
+class TestTournament(unittest.TestCase):
+    def test_parse_engine(self):
+        assert parse_engine("name=a,depth=2,prune_captures=0") == \
+            {"name": "a", "depth": 2, "prune_captures": False}
+        self.assertRaises(ValueError, parse_engine, "name=a,speed=2")
+
+    def test_sprt(self):
+        match = Match(elo0=0, elo1=10)
+        assert match.decision() is None and match.elo() == (0.0, 0.0)
+        for _ in range(0, 300):
+            match.add(1)
+            match.add(0.5)
+            match.add(0)
+        assert match.score() == 0.5 and abs(match.elo()[0]) < 1e-9
+        assert match.llr() < 0 and match.decision() is None
+        for _ in range(0, 300):
+            match.add(1)
+        assert match.decision() == "H1" and match.elo()[0] > 50
+
+    def test_run(self):
+        openings = random_openings(2, seed=1)
+        assert len(set(openings)) == 2
+        assert all(len(i.split()) == 4 for i in openings)
+        pgn = io.StringIO()
+        summary = run({"name": "a", "depth": 1}, {"name": "b", "nodes": 20},
+                      openings, 4, workers=1, max_plies=12, pgn_file=pgn)
+        assert summary["games"] == 4 and summary["decision"] is None
+        assert sum(summary["reasons"].values()) == 4
+        assert summary["engines"]["a"]["nps"] > 0
+        games = pgn.getvalue().split("[Event ")[1:]
+        assert len(games) == 4 and '[White "b"]' in games[1]
+        assert "\n1. " in games[0] and " 7. " not in games[0]
+
+    def test_pool(self):
+        summary = run({"name": "a", "depth": 1}, {"name": "b", "depth": 1},
+                      random_openings(1), 2, workers=2, max_plies=6)
+        assert summary["games"] == 2
+        assert summary["reasons"] == {"max plies": 2}
+
+
+class _Health(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps({"pid": os.getpid()}).encode("utf-8")
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _health_worker(port):
+    HTTPServer(("127.0.0.1", port), _Health).serve_forever()
+
+
+class TestSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.supervisor = Supervisor(
+            _health_worker, 2, range(19310, 19314), interval=0.1,
+            start_timeout=10, stop_timeout=5)
+
+    def tearDown(self):
+        self.supervisor.stop()
+
+    def _start(self):
+        for _ in range(0, 2):
+            self.supervisor.spawn()
+        for worker in self.supervisor.workers:
+            assert self.supervisor.wait_healthy(worker)
+
+    def test_restart_crashed(self):
+        self._start()
+        crashed = self.supervisor.workers[0]
+        crashed.process.kill()
+        crashed.process.join()
+        self.supervisor.check()
+        assert crashed not in self.supervisor.workers
+        assert len(self.supervisor.workers) == 2
+        assert self.supervisor.restarts == 1
+
+    def test_rolling_restart(self):
+        self._start()
+        old = {i.pid for i in self.supervisor.workers}
+        assert self.supervisor.rolling_restart()
+        assert len(self.supervisor.workers) == 2
+        assert not old & {i.pid for i in self.supervisor.workers}
+        for worker in self.supervisor.workers:
+            assert check_health(worker.health_port)["pid"] == worker.pid
+
+    def test_unhealthy(self):
+        self.supervisor.start_timeout = 0
+        self.supervisor.max_failures = 2
+        worker = self.supervisor.spawn()
+        # never answers, not started
+        worker.health_port = 19399
+        self.supervisor.check()
+        assert worker.failures == 1
+        self.supervisor.check()
+        assert worker not in self.supervisor.workers
+        assert not worker.process.is_alive()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,367 @@
+"""
+Engine against engine matches, to tell whether a change to the search made it
+stronger or faster.
+
+    python -m workers.tournament --engine name=new,depth=3 \
+        --engine name=base,depth=3,prune_captures=0 --games 2000 --pgn out.pgn
+
+An engine is a search configuration: depth, nodes (per move), movetime
+(milliseconds per move) and prune_captures. Every opening is played twice
+with the colors swapped, the games run in worker processes. The openings are
+the lines of --openings (UCI moves from the start, or a FEN) or random
+legal moves from the start. Games end by the GameEngine rules (mate,
+stalemate, fifty moves) or as a draw after --max-plies.
+
+After every game the sequential probability ratio test of elo1 against elo0
+(for the first engine) is updated, the match stops once it accepts one of
+them. The report gives the Elo difference with its 95% interval, and the
+nodes per second and time per move of both engines.
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+from math import log, log10, sqrt
+from threading import Timer, Event
+import random
+import time
+from game.chess import make_game_engine
+from game.pgn import pgn, san
+from game.search import Search, TranspositionTable, engine_from_fen, make, \
+    deepen
+from game.uci import move_name, parse_move
+
+MAX_DEPTH = 64
+OPENING_PLIES = 4
+MAX_PLIES = 300
+
+
+def parse_engine(text: str) -> dict:
+    """
+        "name=new,depth=3,prune_captures=0" -> {"name": "new", "depth": 3,
+        "prune_captures": False}
+    """
+    config = {}
+    for pair in text.split(","):
+        key, value = pair.split("=", 1)
+        if key == "name":
+            config[key] = value
+        elif key == "prune_captures":
+            config[key] = value not in ("0", "false", "no")
+        elif key in ("depth", "nodes", "movetime"):
+            config[key] = int(value)
+        else:
+            raise ValueError("Unknown engine option %s" % key)
+    return config
+
+
+def random_openings(count: int, plies: int=OPENING_PLIES, seed: int=0) -> list:
+    """
+        count lines of plies random legal moves from the start, as UCI moves
+    """
+    rng = random.Random(seed)
+    openings = []
+    while len(openings) < count:
+        engine = make_game_engine("W")
+        line = []
+        for _ in range(0, plies):
+            moves = engine.legal_moves()
+            if not moves:
+                break
+            move = rng.choice(moves)
+            make(engine, move)
+            line.append(move_name(move))
+        if len(line) == plies and engine.outcome() is None:
+            openings.append(" ".join(line))
+    return openings
+
+
+def read_openings(path: str) -> list:
+    with open(path) as f:
+        return [i.strip() for i in f if i.strip() and not i.startswith("#")]
+
+
+def _opening_engine(opening: str):
+    """
+    @return: engine in the position, the opening moves played, FEN if it
+        started from one
+    """
+    if "/" in opening:
+        return engine_from_fen(opening), [], opening
+    engine = make_game_engine("W")
+    moves = []
+    for name in opening.split():
+        move = parse_move(name)
+        if not make(engine, move):
+            raise ValueError("Illegal opening move %s in %s" % (name, opening))
+        moves.append(move)
+    return engine, moves, None
+
+
+def choose_move(engine, config: dict, table: TranspositionTable):
+    """
+    @return: (move, nodes)
+    """
+    stop = Event()
+    timer = None
+    if "movetime" in config:
+        timer = Timer(config["movetime"] / 1000, stop.set)
+        timer.start()
+    limited = "nodes" in config or "movetime" in config
+    search = Search(engine, table, stop,
+                    prune_captures=config.get("prune_captures", True),
+                    max_nodes=config.get("nodes"))
+    try:
+        result = deepen(search, config.get(
+            "depth", MAX_DEPTH if limited else 3))
+    finally:
+        if timer is not None:
+            timer.cancel()
+    if result is None:
+        # not even depth 1 finished
+        return engine.legal_moves()[0], search.nodes
+    return result.move, search.nodes
+
+
+def play_game(job: tuple) -> dict:
+    """
+        One game in a worker process
+    @param job: (round, opening, white config, black config, max plies)
+    """
+    number, opening, white, black, max_plies = job
+    engine, opening_moves, fen = _opening_engine(opening)
+    replay = engine_from_fen(fen) if fen else make_game_engine("W")
+    start_ply = replay.board.start_ply
+    sans = []
+    for move in opening_moves:
+        sans.append(san(replay, move))
+        make(replay, move)
+    configs = {"W": white, "B": black}
+    tables = {"W": TranspositionTable(), "B": TranspositionTable()}
+    stats = {"W": [0, 0.0, 0], "B": [0, 0.0, 0]}
+    result = None
+    while result is None:
+        outcome = engine.outcome()
+        if outcome is not None:
+            result, reason = outcome
+            break
+        if len(engine.board.moves) >= max_plies:
+            result, reason = "1/2-1/2", "max plies"
+            break
+        turn = engine.board.turn
+        started = time.perf_counter()
+        move, nodes = choose_move(engine, configs[turn], tables[turn])
+        elapsed = time.perf_counter() - started
+        stats[turn][0] += nodes
+        stats[turn][1] += elapsed
+        stats[turn][2] += 1
+        sans.append(san(engine, move))
+        make(engine, move)
+    tags = {"Event": "tournament", "Site": "local",
+            "Date": date.today().strftime("%Y.%m.%d"), "Round": number,
+            "White": white["name"], "Black": black["name"], "Result": result,
+            "Termination": reason}
+    if fen:
+        tags.update(SetUp="1", FEN=fen)
+    return {"round": number, "white": white["name"], "black": black["name"],
+            "result": result, "reason": reason, "stats": stats,
+            "pgn": pgn(tags, sans, start_ply)}
+
+
+def elo(score: float) -> float:
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    return -400 * log10(1 / score - 1)
+
+
+def expected_score(elo_difference: float) -> float:
+    return 1 / (1 + 10 ** (-elo_difference / 400))
+
+
+class Match:
+    """
+        Wins, draws and losses of the first engine, with the SPRT state
+    """
+
+    def __init__(self, elo0: float=0, elo1: float=5, alpha: float=0.05,
+                 beta: float=0.05):
+        self.elo0, self.elo1 = elo0, elo1
+        self.lower = log(beta / (1 - alpha))
+        self.upper = log((1 - beta) / alpha)
+        self.wins = self.draws = self.losses = 0
+
+    def __len__(self):
+        return self.wins + self.draws + self.losses
+
+    def add(self, score: float):
+        if score == 1:
+            self.wins += 1
+        elif score == 0:
+            self.losses += 1
+        else:
+            self.draws += 1
+
+    def score(self) -> float:
+        return (self.wins + self.draws / 2) / len(self) if len(self) else 0.5
+
+    def variance(self) -> float:
+        """
+            Of the score of one game
+        """
+        score = self.score()
+        return (self.wins * (1 - score) ** 2 + self.draws * (0.5 - score) ** 2
+                + self.losses * score ** 2) / len(self) if len(self) else 0
+
+    def llr(self) -> float:
+        """
+            Log likelihood ratio of elo1 against elo0, normal approximation
+            of the game scores
+        """
+        variance = self.variance()
+        if not variance:
+            return 0.0
+        s0, s1 = expected_score(self.elo0), expected_score(self.elo1)
+        return len(self) * (s1 - s0) * (2 * self.score() - s0 - s1) / \
+            (2 * variance)
+
+    def decision(self):
+        """
+            "H1" (elo1 accepted), "H0" or None while undecided
+        """
+        llr = self.llr()
+        if llr >= self.upper:
+            return "H1"
+        if llr <= self.lower:
+            return "H0"
+        return None
+
+    def elo(self) -> tuple:
+        """
+            (Elo difference, half width of the 95% interval)
+        """
+        if not len(self):
+            return 0.0, 0.0
+        score = self.score()
+        margin = 1.96 * sqrt(self.variance() / len(self))
+        return elo(score), (elo(score + margin) - elo(score - margin)) / 2
+
+
+def _jobs(first: dict, second: dict, openings: list, games: int,
+          max_plies: int):
+    for number in range(0, games):
+        opening = openings[(number // 2) % len(openings)]
+        # the pair of an opening swaps the colors
+        if number % 2 == 0:
+            yield number + 1, opening, first, second, max_plies
+        else:
+            yield number + 1, opening, second, first, max_plies
+
+
+def run(first: dict, second: dict, openings: list, games: int,
+        workers: int=None, match: Match=None, max_plies: int=MAX_PLIES,
+        pgn_file=None, report=None) -> dict:
+    """
+        Play up to games games, fewer once the SPRT decides
+    @param workers: processes, os.cpu_count() if not given, 1 plays in this
+        process
+    @param pgn_file: open file the games are written to as they finish
+    @param report: report(summary) after every game
+    """
+    match = match if match is not None else Match()
+    totals = {first["name"]: [0, 0.0, 0], second["name"]: [0, 0.0, 0]}
+    reasons = {}
+
+    def finished(game: dict):
+        score = {"1-0": 1, "0-1": 0}.get(game["result"], 0.5)
+        match.add(score if game["white"] == first["name"] else 1 - score)
+        reasons[game["reason"]] = reasons.get(game["reason"], 0) + 1
+        for color, name in (("W", game["white"]), ("B", game["black"])):
+            for i, value in enumerate(game["stats"][color]):
+                totals[name][i] += value
+        if pgn_file is not None:
+            pgn_file.write(game["pgn"] + "\n")
+        if report is not None:
+            report(summary())
+        return match.decision() is not None
+
+    def summary() -> dict:
+        difference, margin = match.elo()
+        engines = {}
+        for name, (nodes, seconds, moves) in totals.items():
+            engines[name] = {
+                "nps": nodes / seconds if seconds else 0.0,
+                "ms_per_move": 1000 * seconds / moves if moves else 0.0}
+        return {"games": len(match), "wins": match.wins,
+                "draws": match.draws, "losses": match.losses,
+                "elo": difference, "elo_margin": margin, "llr": match.llr(),
+                "bounds": (match.lower, match.upper),
+                "decision": match.decision(), "reasons": dict(reasons),
+                "engines": engines}
+
+    jobs = _jobs(first, second, openings, games, max_plies)
+    if workers == 1:
+        for job in jobs:
+            if finished(play_game(job)):
+                break
+        return summary()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(play_game, job) for job in jobs]
+        for future in as_completed(futures):
+            if finished(future.result()):
+                for i in futures:
+                    i.cancel()
+                break
+    return summary()
+
+
+def _print(summary: dict):
+    print("games %(games)i +%(wins)i =%(draws)i -%(losses)i "
+          "elo %(elo).1f +- %(elo_margin).1f llr %(llr).2f" % summary,
+          "[%.2f, %.2f]" % summary["bounds"], summary["decision"] or "")
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--engine", action="append", type=parse_engine,
+                        required=True, help="name=new,depth=3, twice")
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--openings", help="file of UCI move lines or FENs")
+    parser.add_argument("--opening-plies", type=int, default=OPENING_PLIES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="processes, one per core by default")
+    parser.add_argument("--max-plies", type=int, default=MAX_PLIES)
+    parser.add_argument("--elo0", type=float, default=0)
+    parser.add_argument("--elo1", type=float, default=5)
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--beta", type=float, default=0.05)
+    parser.add_argument("--pgn", help="write the games to this file")
+    args = parser.parse_args()
+    if len(args.engine) != 2:
+        parser.error("give --engine twice")
+    first, second = args.engine
+    for i, config in enumerate(args.engine):
+        config.setdefault("name", "engine%i" % (i + 1))
+    if first["name"] == second["name"]:
+        parser.error("the engines need different names")
+
+    if args.openings:
+        openings = read_openings(args.openings)
+    else:
+        openings = random_openings((args.games + 1) // 2, args.opening_plies,
+                                   args.seed)
+    match = Match(args.elo0, args.elo1, args.alpha, args.beta)
+    pgn_file = open(args.pgn, "w") if args.pgn else None
+    try:
+        summary = run(first, second, openings, args.games, args.workers,
+                      match, args.max_plies, pgn_file, _print)
+    finally:
+        if pgn_file is not None:
+            pgn_file.close()
+    _print(summary)
+    print("endings", summary["reasons"])
+    for name, values in summary["engines"].items():
+        print("%s: %.0f nodes/s, %.1f ms per move" % (
+            name, values["nps"], values["ms_per_move"]))
+
+
+if __name__ == "__main__":
+    main()